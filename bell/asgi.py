@@ -1,7 +1,8 @@
 """
-ASGI config for python222_admin3 project.
+ASGI config for bell project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP请求仍由Django处理，/ws/下的WebSocket连接由channels路由到device.routing中的consumer，
+生产环境由daphne运行。
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
@@ -11,6 +12,16 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'python222_admin3.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bell.settings')
 
-application = get_asgi_application()
+# 先初始化Django，再导入依赖模型的路由
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+
+from device.routing import websocket_urlpatterns  # noqa: E402
+
+application = ProtocolTypeRouter({
+    'http': django_asgi_app,
+    'websocket': URLRouter(websocket_urlpatterns),
+})
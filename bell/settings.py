@@ -35,6 +35,7 @@ ALLOWED_HOSTS = DEFAULT_ALLOWED_HOSTS + [host.strip() for host in ENV_ALLOWED_HO
 
 INSTALLED_APPS = [
     "django_apscheduler",
+    'channels',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -97,6 +98,23 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'bell.wsgi.application'
+# WebSocket推送由daphne运行ASGI应用
+ASGI_APPLICATION = 'bell.asgi.application'
+
+# channel layer：配置REDIS_URL时接入进程与daphne通过Redis传递推送，
+# 未配置时使用进程内的InMemoryChannelLayer，只适用于开发环境runserver同时运行接入
+REDIS_URL = os.getenv('REDIS_URL', '')
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [REDIS_URL]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+    }
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -168,6 +186,103 @@ MQTT_PORT = int(os.getenv('MQTT_PORT', '6183'))
 MQTT_USERNAME = os.getenv('MQTT_USERNAME', 'xinxiangliantong')
 MQTT_PASSWORD = os.getenv('MQTT_PASSWORD', 'xxlt250524')
 
+# MQTT接入模式: all(单进程订阅全部网关) / shared(共享订阅) / hash(按uuid哈希分片)
+MQTT_CONSUMER_MODE = os.getenv('MQTT_CONSUMER_MODE', 'all')
+# 共享订阅组名
+MQTT_SHARE_GROUP = os.getenv('MQTT_SHARE_GROUP', 'bell-ingest')
+# hash模式下的进程标识(默认 主机名-进程号)与成员声明主题
+MQTT_WORKER_ID = os.getenv('MQTT_WORKER_ID', '')
+MQTT_MEMBERS_TOPIC = os.getenv('MQTT_MEMBERS_TOPIC', 'bell/ingest/members')
+
+# 未配置协议的网关默认使用的GatewayCodec型号
+MQTT_DEFAULT_GATEWAY_CODEC = os.getenv('MQTT_DEFAULT_GATEWAY_CODEC', 'default')
+
+# MQTT上报数据写库缓冲：刷新间隔(毫秒)、每批最大设备数、队列容量
+MQTT_INGEST_FLUSH_INTERVAL_MS = int(os.getenv('MQTT_INGEST_FLUSH_INTERVAL_MS', '500'))
+MQTT_INGEST_BATCH_SIZE = int(os.getenv('MQTT_INGEST_BATCH_SIZE', '500'))
+MQTT_INGEST_QUEUE_SIZE = int(os.getenv('MQTT_INGEST_QUEUE_SIZE', '100000'))
+# 状态未变化的设备统一刷新last_updated的间隔(秒)，0表示不刷新
+MQTT_INGEST_SEEN_INTERVAL = int(os.getenv('MQTT_INGEST_SEEN_INTERVAL', '60'))
+# 当前温度变化小于该值时视为未变化，不写库
+MQTT_TEMP_DEADBAND = float(os.getenv('MQTT_TEMP_DEADBAND', '0.2'))
+# 网关心跳时间批量写库的间隔(秒)
+MQTT_HEARTBEAT_FLUSH_INTERVAL = int(os.getenv('MQTT_HEARTBEAT_FLUSH_INTERVAL', '30'))
+
+# 写库线程数，同一网关的数据固定由一个线程写入
+MQTT_INGEST_WORKERS = int(os.getenv('MQTT_INGEST_WORKERS', '1'))
+# 接入进程重新加载网关、设备状态并更新订阅的间隔(秒)，0表示不刷新
+MQTT_INGEST_REFRESH_INTERVAL = int(os.getenv('MQTT_INGEST_REFRESH_INTERVAL', '300'))
+# 接入进程发布运行指标和网关心跳时间的间隔(秒)，Web进程通过Redis读取
+MQTT_STATS_INTERVAL = int(os.getenv('MQTT_STATS_INTERVAL', '10'))
+# 开发服务器(runserver)中是否启动MQTT接入，独立运行run_mqtt_ingest时设为False
+MQTT_INGEST_IN_RUNSERVER = os.getenv('MQTT_INGEST_IN_RUNSERVER', 'True') == 'True'
+
+# MQTT客户端实现: thread(paho loop_start线程) / asyncio(AsyncMQTTClient)
+MQTT_CLIENT = os.getenv('MQTT_CLIENT', 'thread')
+# asyncio客户端执行数据库操作的线程数，以及处理中消息数上限(超过后暂停读取)
+MQTT_ASYNC_DB_WORKERS = int(os.getenv('MQTT_ASYNC_DB_WORKERS', '4'))
+MQTT_ASYNC_MAX_INFLIGHT = int(os.getenv('MQTT_ASYNC_MAX_INFLIGHT', '10000'))
+
+# 设备状态历史记录开关
+DEVICE_HISTORY_ENABLED = os.getenv('DEVICE_HISTORY_ENABLED', 'True') == 'True'
+# 各字段变化后记录历史的最小间隔(秒)，格式 字段:秒，未列出的字段变化不记录
+DEVICE_HISTORY_SAMPLING = {
+    field: int(interval) for field, interval in (
+        item.split(':') for item in os.getenv(
+            'DEVICE_HISTORY_SAMPLING', 'status:0,mode:0,set_temp:0,fan_speed:0,current_temp:60'
+        ).split(',') if item
+    )
+}
+# 历史记录批量写库：刷新间隔(秒)、每批条数、队列容量
+DEVICE_HISTORY_FLUSH_INTERVAL = int(os.getenv('DEVICE_HISTORY_FLUSH_INTERVAL', '5'))
+DEVICE_HISTORY_BATCH_SIZE = int(os.getenv('DEVICE_HISTORY_BATCH_SIZE', '1000'))
+DEVICE_HISTORY_QUEUE_SIZE = int(os.getenv('DEVICE_HISTORY_QUEUE_SIZE', '100000'))
+
+# 设备状态聚合：定时任务间隔(分钟)、等待历史写入的延迟(秒)、每次处理的时间窗口(秒)
+DEVICE_ROLLUP_INTERVAL = int(os.getenv('DEVICE_ROLLUP_INTERVAL', '5'))
+DEVICE_ROLLUP_LAG = int(os.getenv('DEVICE_ROLLUP_LAG', '120'))
+DEVICE_ROLLUP_WINDOW = int(os.getenv('DEVICE_ROLLUP_WINDOW', '900'))
+# 查询聚合数据时未指定分辨率，返回的最大点数
+DEVICE_ROLLUP_MAX_POINTS = int(os.getenv('DEVICE_ROLLUP_MAX_POINTS', '500'))
+# 设备状态历史分区(仅MySQL)：提前创建的月分区数、保留月数(0为不删除)
+DEVICE_STATUS_PARTITIONS_AHEAD = int(os.getenv('DEVICE_STATUS_PARTITIONS_AHEAD', '3'))
+DEVICE_STATUS_RETENTION_MONTHS = int(os.getenv('DEVICE_STATUS_RETENTION_MONTHS', '12'))
+# 设备运行时间累计值写库间隔(秒)
+DEVICE_RUNTIME_FLUSH_INTERVAL = int(os.getenv('DEVICE_RUNTIME_FLUSH_INTERVAL', '60'))
+# 批量控制：下发后查询设备状态的延时(秒)、查询后校验结果的延时(秒)
+CONTROL_VERIFY_DELAY = float(os.getenv('CONTROL_VERIFY_DELAY', '2'))
+CONTROL_CHECK_DELAY = float(os.getenv('CONTROL_CHECK_DELAY', '5'))
+# 网关下发队列：每个网关每秒下发的命令数、突发上限、合并后一条命令的最大设备数
+# 配置REDIS_URL时各进程共用同一个令牌桶，速率为所有进程合计
+MQTT_GATEWAY_RATE = float(os.getenv('MQTT_GATEWAY_RATE', '2'))
+MQTT_GATEWAY_BURST = int(os.getenv('MQTT_GATEWAY_BURST', '5'))
+MQTT_COMMAND_MAX_ADDRS = int(os.getenv('MQTT_COMMAND_MAX_ADDRS', '64'))
+# 单条下发命令的最大字节数，超出时按设备拆分，与网关的接收缓冲区一致
+MQTT_COMMAND_MAX_BYTES = int(os.getenv('MQTT_COMMAND_MAX_BYTES', '1024'))
+# 设备状态轮询：基准间隔(秒，0为不轮询)、自适应间隔的上下限(秒)、每次间隔的随机抖动比例
+DEVICE_POLL_INTERVAL = int(os.getenv('DEVICE_POLL_INTERVAL', '300'))
+DEVICE_POLL_MIN_INTERVAL = int(os.getenv('DEVICE_POLL_MIN_INTERVAL', '60'))
+DEVICE_POLL_MAX_INTERVAL = int(os.getenv('DEVICE_POLL_MAX_INTERVAL', '1800'))
+DEVICE_POLL_JITTER = float(os.getenv('DEVICE_POLL_JITTER', '0.2'))
+# 手动查询所有设备状态时，各网关的查询分散在该时间窗口(秒)内下发
+DEVICE_POLL_SPREAD = int(os.getenv('DEVICE_POLL_SPREAD', '30'))
+# 命令确认：未确认命令的超时时间(秒)、接口wait参数的上限(毫秒)
+COMMAND_ACK_TIMEOUT = float(os.getenv('COMMAND_ACK_TIMEOUT', '10'))
+COMMAND_MAX_WAIT_MS = int(os.getenv('COMMAND_MAX_WAIT_MS', '10000'))
+# 设备实时状态存储：redis(多个Web节点共享，使用REDIS_URL)、shm(同一主机共享内存)或local(进程内)
+DEVICE_LIVE_STORE = os.getenv('DEVICE_LIVE_STORE', 'redis' if REDIS_URL else 'local')
+# shm实时状态的共享内存名称和最大设备数；接入与Web不在同一容器时需要共享IPC命名空间(如ipc: host)
+DEVICE_SHM_NAME = os.getenv('DEVICE_SHM_NAME', 'bell_live')
+DEVICE_SHM_CAPACITY = int(os.getenv('DEVICE_SHM_CAPACITY', '200000'))
+# 进程内缓存(网关路由、设备状态表)检查其他进程修改的间隔(秒)，需要配置REDIS_URL
+DEVICE_VERSION_CHECK_INTERVAL = float(os.getenv('DEVICE_VERSION_CHECK_INTERVAL', '5'))
+# 树形结构缓存的最长保留时间(秒)，未配置REDIS_URL时其他进程的修改最多延迟这么久
+DEVICE_TREE_CACHE_TTL = int(os.getenv('DEVICE_TREE_CACHE_TTL', '10'))
+# WebSocket推送设备状态变化的合并窗口(秒)
+DEVICE_PUSH_INTERVAL = float(os.getenv('DEVICE_PUSH_INTERVAL', '1'))
+# 导出设备状态历史时每次查询的行数
+DEVICE_EXPORT_CHUNK_SIZE = int(os.getenv('DEVICE_EXPORT_CHUNK_SIZE', '5000'))
+
 # 日志设置，可调等级
 LOGGING = {
     'version': 1,
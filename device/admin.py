@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Device, Topic, Company, Department, Building, Floor, DeviceStatus
+from .models import Device, Topic, Company, Department, Building, Floor, DeviceStatus, DeviceStatusRollup, GatewayCodec, ControlJob
 
 @admin.register(Device)
 class DeviceAdmin(admin.ModelAdmin):
@@ -9,9 +9,14 @@ class DeviceAdmin(admin.ModelAdmin):
 
 @admin.register(Topic)
 class TopicAdmin(admin.ModelAdmin):
-    list_display = ['uuid', 'subscribe_topic', 'publish_topic', 'online_status', 'description', 'created_at', 'updated_at']
+    list_display = ['uuid', 'subscribe_topic', 'publish_topic', 'codec', 'online_status', 'description', 'created_at', 'updated_at']
     search_fields = ['uuid', 'subscribe_topic', 'publish_topic', 'description']
-    list_filter = ['created_at', 'updated_at', 'online_status']
+    list_filter = ['created_at', 'updated_at', 'online_status', 'codec']
+
+@admin.register(GatewayCodec)
+class GatewayCodecAdmin(admin.ModelAdmin):
+    list_display = ['model', 'status_map', 'mode_map', 'fan_speed_map', 'online_map', 'description', 'updated_at']
+    search_fields = ['model', 'description']
 
 @admin.register(Company)
 class CompanyAdmin(admin.ModelAdmin):
@@ -40,3 +45,14 @@ class DeviceStatusAdmin(admin.ModelAdmin):
     list_display = ('device', 'current_temp', 'set_temp', 'status', 'mode', 'fan_speed', 'timestamp')
     list_filter = ('status', 'mode', 'fan_speed')
     search_fields = ('device__name', 'device__device_id')
+
+@admin.register(DeviceStatusRollup)
+class DeviceStatusRollupAdmin(admin.ModelAdmin):
+    list_display = ('device', 'period', 'bucket', 'current_temp_min', 'current_temp_max', 'samples', 'seconds')
+    list_filter = ('period',)
+    search_fields = ('device__name', 'device__device_id')
+
+@admin.register(ControlJob)
+class ControlJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'total', 'created_at', 'updated_at')
+    list_filter = ('status',)
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 import os
 import sys
 
@@ -8,14 +9,21 @@ class DeviceConfig(AppConfig):
     name = "device"
 
     def ready(self):
+        # 注册模型变更信号，保持网关路由缓存与数据库一致
+        from . import signals  # noqa: F401
+
         # 只在主进程中启动MQTT客户端
         # Django开发服务器会启动两次，一次是主进程，一次是重载进程
         # RUN_MAIN=true 表示这是在重载进程中运行
         if os.environ.get('RUN_MAIN') == 'true':
-            # 确保不在管理命令中运行
-            if 'runserver' in sys.argv:
+            # 确保不在管理命令中运行；生产环境由 manage.py run_mqtt_ingest 单独运行接入
+            if 'runserver' in sys.argv and settings.MQTT_INGEST_IN_RUNSERVER:
+                from .metrics import ingest_metrics
                 from .mqtt_client import mqtt_client
-                mqtt_client.start()
+                from .poller import status_poller
+                if mqtt_client.start():
+                    status_poller.start(mqtt_client)
+                    ingest_metrics.start()
 
 
             """Django启动时自动加载定时任务"""
@@ -0,0 +1,154 @@
+"""
+设备状态推送
+写库线程在设备状态变化后调用record()，同一设备在一个推送窗口内的多次变化合并为一条；
+每个窗口按设备所属的建筑、楼层、公司、部门、网关分组，每组一次group_send，
+由channel layer分发给订阅该范围的WebSocket连接，连接数再多也只推送一次
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import Device
+from .trees import DEVICES, ORG
+from .versions import version_counter
+
+logger = logging.getLogger(__name__)
+
+# 可订阅的范围 -> Device上的字段
+SCOPES = {
+    'building': 'building_id',
+    'floor': 'floor_id',
+    'company': 'company_id',
+    'department': 'department_id',
+    'gateway': 'uuid_id',
+}
+
+
+def group_name(scope, key):
+    """订阅范围对应的channel layer组名，网关使用Topic主键"""
+    return f"devices.{scope}.{key}"
+
+
+class StateBroadcaster:
+    """合并设备状态变化并按订阅范围推送"""
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.DEVICE_PUSH_INTERVAL
+        self._lock = threading.Lock()
+        self._pending = {}  # 设备主键 -> 合并后的变化
+        self._groups = {}  # 设备主键 -> 所属的组名
+        self._groups_version = None  # 分组缓存对应的设备与组织架构版本号
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.batches = 0
+        self.group_sends = 0
+        self.pushed = 0
+        self.errors = 0
+
+    def record(self, pk, changes, at):
+        """设备状态写库后调用，同一窗口内的变化合并"""
+        with self._lock:
+            delta = self._pending.setdefault(pk, {'id': pk})
+            delta.update(changes)
+            delta['last_updated'] = at.isoformat()
+        self.start()
+
+    def forget(self, pk):
+        """设备删除或所属范围修改后清除分组缓存"""
+        with self._lock:
+            self._groups.pop(pk, None)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='state-broadcaster', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """推送剩余的变化后停止"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        started = time.monotonic()
+        try:
+            close_old_connections()
+            batches = {}
+            for pk, groups in self._resolve(pending).items():
+                for group in groups:
+                    batches.setdefault(group, []).append(pending[pk])
+            async_to_sync(self._send)(batches)
+            self.batches += 1
+            self.group_sends += len(batches)
+            self.pushed += len(pending)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"State broadcast error: {e}")
+        latency = time.monotonic() - started
+        if latency > self.interval:
+            logger.warning(f"State broadcast took {latency:.3f}s for {len(pending)} devices")
+
+    @staticmethod
+    async def _send(batches):
+        """一个窗口的所有组在同一个事件循环中发送"""
+        layer = get_channel_layer()
+        await asyncio.gather(*[
+            layer.group_send(group, {'type': 'device.delta', 'devices': devices})
+            for group, devices in batches.items()
+        ])
+
+    def _resolve(self, pending):
+        """
+        设备主键 -> 组名，缓存中没有的设备用一条查询补齐
+        其他进程修改设备所属范围或组织架构后版本号变化，分组缓存整体重新加载
+        """
+        version = version_counter.current(DEVICES, ORG)
+        with self._lock:
+            if version != self._groups_version:
+                self._groups = {}
+                self._groups_version = version
+            resolved = {pk: self._groups[pk] for pk in pending if pk in self._groups}
+        missing = [pk for pk in pending if pk not in resolved]
+        for i in range(0, len(missing), 1000):
+            rows = Device.objects.filter(id__in=missing[i:i + 1000]).values('id', 'floor__building_id', *SCOPES.values())
+            for row in rows:
+                groups = [group_name(scope, row[field]) for scope, field in SCOPES.items() if row[field] is not None]
+                # 只设置楼层的设备也推送给所在建筑
+                building = row['floor__building_id']
+                if building is not None and building != row['building_id']:
+                    groups.append(group_name('building', building))
+                resolved[row['id']] = groups
+        with self._lock:
+            self._groups.update({pk: resolved[pk] for pk in missing if pk in resolved})
+        return resolved
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'interval': self.interval,
+            'batches': self.batches,
+            'group_sends': self.group_sends,
+            'pushed': self.pushed,
+            'errors': self.errors,
+        }
+
+
+# 全局状态推送实例
+state_broadcaster = StateBroadcaster()
@@ -0,0 +1,80 @@
+from .models import GatewayCodec
+
+# 网关上报字段 -> 设备字段
+_TEMP_FIELDS = (('rt', 'current_temp'), ('ts', 'set_temp'))
+
+
+class CompiledCodec:
+    """
+    预编译的网关协议转换表
+    上报解析(o/w/fs/acs)与控制下发(onOff/workMode/fanSpeed)都只做一次字典查找
+    """
+
+    __slots__ = ('id', 'model', '_status', '_mode', '_fan_speed', '_online', '_encode')
+
+    def __init__(self, codec):
+        self.id = codec.id
+        self.model = codec.model
+        self._status = {str(k): v for k, v in codec.status_map.items()}
+        self._mode = {str(k): v for k, v in codec.mode_map.items()}
+        self._fan_speed = {str(k): int(v) for k, v in (codec.fan_speed_map or {}).items()}
+        self._online = dict(codec.online_map)
+        # 下发编码表由解析表反转得到
+        self._encode = {
+            'onOff': {v: _gateway_code(k) for k, v in self._status.items()},
+            'workMode': {v: _gateway_code(k) for k, v in self._mode.items()},
+            'fanSpeed': {str(v): _gateway_code(k) for k, v in self._fan_speed.items()},
+        }
+
+    def decode(self, unit):
+        """解析一条内机上报数据，返回需要更新的设备字段"""
+        fields = {}
+        for key, field in _TEMP_FIELDS:
+            value = unit.get(key)
+            if value is not None:
+                fields[field] = value
+        status = self._status.get(str(unit.get('o')))
+        if status is not None:
+            fields['status'] = status
+        mode = self._mode.get(str(unit.get('w')))
+        if mode is not None:
+            fields['mode'] = mode
+        fan_speed = unit.get('fs')
+        if fan_speed is not None:
+            fields['fan_speed'] = self._fan_speed.get(str(fan_speed), fan_speed) if self._fan_speed else fan_speed
+        online_status = self._online.get(unit.get('acs'))
+        if online_status is not None:
+            fields['online_status'] = online_status
+        return fields
+
+    def decode_units(self, units):
+        """解析整批inUnitMessages，返回[(设备地址, 设备字段)]"""
+        return [(unit.get('a'), self.decode(unit)) for unit in units if unit.get('a')]
+
+    def encode(self, issue_property, value):
+        """
+        编码单个控制属性
+        :param issue_property: onOff/workMode/fanSpeed/tempSet
+        :param value: 系统中的状态值，如running、cooling
+        """
+        if issue_property == 'tempSet':
+            return float(value)
+        table = self._encode[issue_property]
+        if issue_property == 'fanSpeed' and not table:
+            return int(value)
+        return table[str(value)]
+
+
+def compile_codec(codec):
+    """预编译GatewayCodec"""
+    return CompiledCodec(codec)
+
+
+def load_codecs():
+    """加载并预编译所有网关协议，返回 {GatewayCodec主键: CompiledCodec}"""
+    return {codec.id: compile_codec(codec) for codec in GatewayCodec.objects.all()}
+
+
+def _gateway_code(code):
+    """网关编码为数字时按数字下发"""
+    return int(code) if isinstance(code, str) and code.isdigit() else code
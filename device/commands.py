@@ -0,0 +1,266 @@
+"""
+控制命令确认
+每条下发命令使用唯一的sn，并登记到待确认表；网关的status_read/status_report上报按sn或按设备状态与命令匹配，
+匹配完成后记录往返耗时，按网关统计p50/p95/p99
+"""
+import itertools
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+from .state import _normalize
+
+logger = logging.getLogger(__name__)
+
+# 控制属性 -> 设备字段
+PROPERTY_FIELDS = {
+    'onOff': 'status',
+    'tempSet': 'set_temp',
+    'workMode': 'mode',
+    'fanSpeed': 'fan_speed',
+}
+
+_MAX_SN = 2 ** 31 - 1
+
+
+class LatencyHistogram:
+    """固定分桶的耗时直方图(毫秒)，分位数取所在桶的上界"""
+
+    BOUNDS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect_left(self.BOUNDS, ms)] += 1
+        self.total += 1
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.BOUNDS[index] if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.total,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max, 3),
+        }
+
+
+class PendingCommand:
+    """一条等待网关确认的命令"""
+
+    def __init__(self, tracker, sn, uuid, cmd, addrs, expected, timeout):
+        self.tracker = tracker
+        self.timeout = timeout
+        self.sn = sn
+        self.uuid = uuid
+        self.cmd = cmd
+        self.expected = expected or {}
+        self.waiting = set(addrs)
+        self.states = {}  # 设备地址 -> 确认时上报的状态
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout
+        self.latency_ms = None
+        self.timed_out = False
+        self.failed = False
+        self.event = threading.Event()
+        self.on_done = None  # 命令结束(确认、超时、覆盖或失败)时的回调
+
+    @property
+    def done(self):
+        return self.event.is_set()
+
+    def matches(self, fields):
+        """上报状态是否已达到命令的期望值"""
+        for field, value in self.expected.items():
+            if field not in fields or _normalize(field, fields[field]) != value:
+                return False
+        return True
+
+    def wait(self, timeout):
+        return self.event.wait(timeout)
+
+    def finish(self):
+        if self.event.is_set():
+            return
+        self.event.set()
+        if self.on_done is not None:
+            try:
+                self.on_done(self)
+            except Exception as e:
+                logger.error(f"Command done callback error: {e}")
+
+    def mark_sent(self):
+        """从下发队列实际发出时调用，耗时与超时从此时开始计算"""
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + self.timeout
+
+    def supersede(self, addrs):
+        """这些设备的命令在发出前被新命令覆盖，不再等待确认"""
+        self.tracker.release(self, addrs)
+
+    def fail(self):
+        """发送失败"""
+        self.failed = True
+        self.tracker.release(self, self.waiting)
+
+    @property
+    def confirmed(self):
+        return self.done and not self.timed_out and not self.failed
+
+
+class CommandTracker:
+    """待确认命令表，按网关uuid分组"""
+
+    def __init__(self, timeout=None):
+        self.timeout = settings.COMMAND_ACK_TIMEOUT if timeout is None else timeout
+        self._lock = threading.Lock()
+        self._sn = itertools.count(random.randint(1, _MAX_SN))
+        self._pending = {}  # uuid -> {sn: PendingCommand}
+        self._latency = {}  # uuid -> LatencyHistogram
+        self._timeouts = {}  # uuid -> 超时命令数
+
+    def next_sn(self):
+        return next(self._sn) % _MAX_SN + 1
+
+    def register(self, uuid, sn, cmd, addrs, expected=None):
+        command = PendingCommand(self, sn, uuid, cmd, addrs, expected, self.timeout)
+        with self._lock:
+            self._sweep()
+            self._pending.setdefault(uuid, {})[sn] = command
+        return command
+
+    def discard(self, command):
+        with self._lock:
+            self._remove(command)
+
+    def release(self, command, addrs):
+        """不再等待这些设备，全部释放后结束命令，不计入耗时统计"""
+        with self._lock:
+            command.waiting.difference_update(set(addrs))
+            if not command.waiting:
+                self._remove(command)
+                command.finish()
+
+    def has_pending(self, uuid):
+        return uuid in self._pending
+
+    def observe(self, gateway, message):
+        """处理网关上报，完成与之匹配的命令"""
+        if gateway.uuid not in self._pending:
+            return
+        cmd = message.get('cmd')
+        if cmd not in ('status_read', 'status_report'):
+            return
+        units = (message.get('body') or {}).get('inUnitMessages')
+        reported = {}
+        if isinstance(units, list) and gateway.codec is not None:
+            reported = dict(gateway.codec.decode_units(units))
+        sn = message.get('sn')
+        with self._lock:
+            self._sweep()
+            pending = self._pending.get(gateway.uuid, {})
+            for command in list(pending.values()):
+                if sn is not None and sn == command.sn:
+                    # 网关回带了命令的sn，视为对该命令的应答
+                    command.states.update({addr: fields for addr, fields in reported.items()
+                                           if addr in command.waiting})
+                    command.waiting.clear()
+                else:
+                    for addr in command.waiting & reported.keys():
+                        if command.matches(reported[addr]):
+                            command.states[addr] = reported[addr]
+                            command.waiting.discard(addr)
+                if not command.waiting:
+                    self._complete(command)
+
+    def _complete(self, command):
+        command.latency_ms = (time.monotonic() - command.sent_at) * 1000
+        self._latency.setdefault(command.uuid, LatencyHistogram()).observe(command.latency_ms)
+        self._remove(command)
+        command.finish()
+
+    def _remove(self, command):
+        pending = self._pending.get(command.uuid)
+        if pending is not None:
+            pending.pop(command.sn, None)
+            if not pending:
+                del self._pending[command.uuid]
+
+    def sweep(self):
+        with self._lock:
+            self._sweep()
+
+    def _sweep(self):
+        """移除超时未确认的命令"""
+        now = time.monotonic()
+        for uuid, pending in list(self._pending.items()):
+            for command in list(pending.values()):
+                if command.deadline <= now:
+                    command.timed_out = True
+                    self._timeouts[uuid] = self._timeouts.get(uuid, 0) + 1
+                    self._remove(command)
+                    command.finish()
+
+    def wait_all(self, commands, timeout):
+        """等待多条命令确认，共用一个超时时间(秒)"""
+        deadline = time.monotonic() + timeout
+        for command in commands:
+            command.wait(max(deadline - time.monotonic(), 0))
+        return all(command.confirmed for command in commands)
+
+    def stats(self):
+        with self._lock:
+            self._sweep()
+            gateways = {
+                uuid: dict(histogram.snapshot(), timeouts=self._timeouts.get(uuid, 0))
+                for uuid, histogram in self._latency.items()
+            }
+            for uuid, count in self._timeouts.items():
+                gateways.setdefault(uuid, dict(LatencyHistogram().snapshot(), timeouts=count))
+            return {
+                'pending': sum(len(pending) for pending in self._pending.values()),
+                'timeout': self.timeout,
+                'gateways': gateways,
+            }
+
+
+def expected_for(issue_property, value):
+    """单个控制属性对应的期望设备字段值"""
+    field = PROPERTY_FIELDS.get(issue_property)
+    return {field: _normalize(field, value)} if field else {}
+
+
+def parse_wait(value):
+    """解析wait参数(毫秒)，返回等待秒数，不等待返回0"""
+    if value in (None, ''):
+        return 0
+    try:
+        wait = int(value)
+    except (TypeError, ValueError):
+        # JSON请求体中的wait可能是列表或对象
+        raise ValueError(f"wait must be an integer, got {value!r}")
+    if wait < 0:
+        raise ValueError("wait must not be negative")
+    return min(wait, settings.COMMAND_MAX_WAIT_MS) / 1000
+
+
+# 全局命令确认实例
+command_tracker = CommandTracker()
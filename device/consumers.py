@@ -0,0 +1,74 @@
+import logging
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from jwt import PyJWTError
+from rest_framework_jwt.settings import api_settings
+
+from .broadcast import SCOPES, group_name
+from .registry import gateway_registry
+
+logger = logging.getLogger(__name__)
+
+# 每个连接最多订阅的范围数
+MAX_SUBSCRIPTIONS = 100
+
+
+class DeviceStateConsumer(AsyncJsonWebsocketConsumer):
+    """
+    设备状态推送
+    连接: ws/devices/?token=<JWT>
+    订阅: {"action": "subscribe", "scope": "building", "id": 1}，scope可选building/floor/company/department/gateway，
+          gateway的id为网关uuid；取消订阅使用"action": "unsubscribe"
+    推送: {"type": "delta", "devices": [{"id": 设备主键, 变化的字段..., "last_updated": 时间}]}
+    """
+
+    async def connect(self):
+        token = parse_qs(self.scope['query_string'].decode()).get('token', [None])[0]
+        try:
+            api_settings.JWT_DECODE_HANDLER(token)
+        except PyJWTError:
+            await self.close(code=4001)
+            return
+        self.subscriptions = set()
+        await self.accept()
+
+    async def disconnect(self, code):
+        for group in getattr(self, 'subscriptions', ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        action = content.get('action')
+        if action not in ('subscribe', 'unsubscribe'):
+            await self.send_json({'type': 'error', 'message': f'unknown action: {action}'})
+            return
+        group = await self.resolve(content.get('scope'), content.get('id'))
+        if group is None:
+            await self.send_json({'type': 'error', 'message': 'invalid scope or id'})
+            return
+        if action == 'subscribe':
+            if group not in self.subscriptions and len(self.subscriptions) >= MAX_SUBSCRIPTIONS:
+                await self.send_json({'type': 'error', 'message': 'too many subscriptions'})
+                return
+            self.subscriptions.add(group)
+            await self.channel_layer.group_add(group, self.channel_name)
+        else:
+            self.subscriptions.discard(group)
+            await self.channel_layer.group_discard(group, self.channel_name)
+        await self.send_json({'type': f'{action}d', 'scope': content['scope'], 'id': content['id']})
+
+    async def resolve(self, scope, key):
+        """订阅范围和id转换为组名，无效时返回None"""
+        if scope not in SCOPES or key in (None, ''):
+            return None
+        if scope == 'gateway':
+            gateway = await database_sync_to_async(gateway_registry.get_gateway)(str(key))
+            return group_name(scope, gateway.id) if gateway is not None else None
+        try:
+            return group_name(scope, int(key))
+        except (TypeError, ValueError):
+            return None
+
+    async def device_delta(self, event):
+        await self.send_json({'type': 'delta', 'devices': event['devices']})
@@ -0,0 +1,199 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import ControlJob, Device
+from .mqtt_client import mqtt_client
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredScheduler:
+    """
+    延时任务线程
+    按到期时间依次执行回调，替代请求线程中的time.sleep，一个线程处理所有待执行任务
+    任务只保存在进程内存中，worker重启或退出时尚未执行的任务会丢失；
+    控制任务的校验由run_scheduler定时调用check_stale_jobs补做
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, func, *args):
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), func, args))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='deferred-scheduler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def pending(self):
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._heap:
+                        remaining = self._heap[0][0] - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                _, _, func, args = heapq.heappop(self._heap)
+            try:
+                close_old_connections()
+                func(*args)
+            except Exception as e:
+                logger.error(f"Deferred task {getattr(func, '__name__', func)} failed: {e}")
+
+
+def build_control_body(codec, control):
+    """按网关协议编码控制参数"""
+    body = {}
+    if 'running' in control:
+        body["onOff"] = codec.encode("onOff", "running" if control['running'] else "stopped")
+    if 'temp' in control:
+        body["tempSet"] = codec.encode("tempSet", control['temp'])
+    if 'mode' in control:
+        body["workMode"] = codec.encode("workMode", control['mode'])
+    if 'fan_speed' in control:
+        body["fanSpeed"] = codec.encode("fanSpeed", control['fan_speed'])
+    return body
+
+
+def expected_state(control):
+    """控制参数对应的设备字段值，用于校验"""
+    expected = {}
+    if 'running' in control:
+        expected['status'] = 'running' if control['running'] else 'stopped'
+    if 'temp' in control:
+        expected['set_temp'] = float(control['temp'])
+    if 'mode' in control:
+        expected['mode'] = control['mode']
+    if 'fan_speed' in control:
+        expected['fan_speed'] = int(control['fan_speed'])
+    return expected
+
+
+def submit_job(control, gateways, failed):
+    """
+    下发批量控制并创建任务，立即返回
+    :param gateways: [(网关, [(设备主键, 设备地址)])]
+    :param failed: {设备主键: 失败原因}，无法下发的设备
+    :return: (任务, [(待确认命令, 该网关的设备)])
+    """
+    results = {str(pk): {'state': 'failed', 'detail': detail} for pk, detail in failed.items()}
+    expected = expected_state(control)
+    sent = []
+    commands = []
+    for gateway, devices in gateways:
+        addrs = [device_id for _, device_id in devices]
+        try:
+            body = build_control_body(gateway.codec, control)
+        except Exception as e:
+            error_msg = f"构建控制参数失败: {str(e)}"
+            logger.error(error_msg)
+            results.update({str(pk): {'state': 'failed', 'detail': error_msg} for pk, _ in devices})
+            continue
+        # 放入网关的下发队列，由发送线程按速率发出，不等待
+        command = mqtt_client.send_command(gateway, "control_write", addrs, body=body, expected=expected)
+        results.update({str(pk): {'state': 'sent'} for pk, _ in devices})
+        sent.append((gateway, addrs))
+        commands.append((command, devices))
+
+    job = ControlJob.objects.create(
+        control=control,
+        status='sent' if sent else 'done',
+        total=len(results),
+        results=results,
+    )
+    if sent:
+        deferred.call_later(settings.CONTROL_VERIFY_DELAY, request_status, job.id, sent)
+    return job, commands
+
+
+def confirmed_states(commands):
+    """已确认设备的上报状态，{设备主键: 状态}"""
+    states = {}
+    for command, devices in commands:
+        for pk, device_id in devices:
+            if device_id in command.states:
+                states[pk] = command.states[device_id]
+    return states
+
+
+def request_status(job_id, sent):
+    """控制命令下发后查询设备状态，等待上报后校验"""
+    for gateway, addrs in sent:
+        # 校验读取数据库中的状态，查询不需要确认
+        mqtt_client.send_untracked(gateway, "status_read", addrs, body={"cmd": "addrs"})
+    ControlJob.objects.filter(id=job_id).update(status='verifying')
+    deferred.call_later(settings.CONTROL_CHECK_DELAY, check_job, job_id)
+
+
+def check_job(job_id):
+    """比较设备当前状态与控制参数，记录每台设备是否已生效"""
+    job = ControlJob.objects.filter(id=job_id).first()
+    if job is None:
+        return
+    expected = expected_state(job.control)
+    pks = [int(pk) for pk, result in job.results.items() if result['state'] == 'sent']
+    states = {row.pop('id'): row for row in Device.objects.filter(id__in=pks).values('id', *expected)}
+    for pk in pks:
+        state = states.get(pk)
+        if state is None:
+            job.results[str(pk)] = {'state': 'failed', 'detail': '设备不存在'}
+            continue
+        mismatched = {field: state[field] for field, value in expected.items() if state[field] != value}
+        if mismatched:
+            job.results[str(pk)] = {'state': 'mismatch', 'detail': mismatched}
+        else:
+            job.results[str(pk)] = {'state': 'confirmed'}
+    job.status = 'done'
+    job.save(update_fields=['results', 'status', 'updated_at'])
+
+
+def check_stale_jobs(grace=60):
+    """
+    校验超过预期时间仍未完成的控制任务，下发任务的worker重启后延时校验丢失时由调度进程补做
+    :param grace: 在两次延时之外额外等待的秒数
+    """
+    delay = settings.CONTROL_VERIFY_DELAY + settings.CONTROL_CHECK_DELAY + grace
+    stale = ControlJob.objects.filter(status__in=('sent', 'verifying'),
+                                      created_at__lt=timezone.now() - timedelta(seconds=delay))
+    job_ids = list(stale.values_list('id', flat=True))
+    for job_id in job_ids:
+        check_job(job_id)
+    return len(job_ids)
+
+
+def job_summary(job):
+    """任务状态及各结果的设备数"""
+    counts = {}
+    for result in job.results.values():
+        counts[result['state']] = counts.get(result['state'], 0) + 1
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'total': job.total,
+        'counts': counts,
+        'created_at': job.created_at,
+        'updated_at': job.updated_at,
+    }
+
+
+# 全局延时任务实例
+deferred = DeferredScheduler()
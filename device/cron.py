@@ -1,5 +1,6 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from django_apscheduler.jobstores import DjangoJobStore
+from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
 import logging
@@ -10,6 +11,8 @@ logger = logging.getLogger(__name__)
 def check_online_status():
     """检查设备在线状态"""
     from device.models import Topic, Device
+    from device.live import live_store
+    from device.state import device_state
     # 设置时间阈值（生产环境建议用hours=1，测试用seconds=2）
     threshold = timezone.now() - timedelta(hours=1)
 
@@ -20,9 +23,12 @@ def check_online_status():
 
     offline_topics = Topic.objects.filter(online_status=False)
 
-    device_updated = Device.objects.filter(
-        uuid__in=offline_topics.values_list('id', flat=True)
-    ).update(online_status=False)
+    offline_devices = Device.objects.filter(uuid__in=offline_topics.values_list('id', flat=True))
+    pks = list(offline_devices.filter(online_status=True).values_list('id', flat=True))
+    device_updated = Device.objects.filter(id__in=pks).update(online_status=False) if pks else 0
+    # 网关恢复后设备上报的在线状态要与False比较，才会重新写库
+    device_state.updated(pks, {'online_status': False})
+    live_store.write({pk: {'online_status': False} for pk in pks})
 
     logger.info(
         f"Marked {updated_topics} topics as offline, "
@@ -30,6 +36,38 @@ def check_online_status():
     )
 
 
+def rollup_device_status():
+    """增量聚合设备状态历史"""
+    from device.rollups import rollup_device_status as run_rollup
+    try:
+        run_rollup()
+    except Exception as e:
+        logger.error(f"Device status rollup failed: {e}")
+
+
+def check_stale_control_jobs():
+    """补做因worker重启而丢失的批量控制校验"""
+    from device.control import check_stale_jobs
+    try:
+        checked = check_stale_jobs()
+        if checked:
+            logger.info(f"Checked {checked} stale control jobs")
+    except Exception as e:
+        logger.error(f"Stale control job check failed: {e}")
+
+
+def maintain_status_partitions():
+    """提前创建设备状态历史的月分区并删除过期分区"""
+    from device import partitions
+    if not partitions.is_supported():
+        return
+    try:
+        partitions.add_partitions(settings.DEVICE_STATUS_PARTITIONS_AHEAD)
+        partitions.drop_partitions(settings.DEVICE_STATUS_RETENTION_MONTHS)
+    except Exception as e:
+        logger.error(f"Device status partition maintenance failed: {e}")
+
+
 # 初始化调度器
 scheduler = BackgroundScheduler()
 scheduler.add_jobstore(DjangoJobStore(), "default")
@@ -43,6 +81,36 @@ scheduler.add_job(
     replace_existing=True
 )
 
+# 增量聚合设备状态历史
+scheduler.add_job(
+    rollup_device_status,
+    'interval',
+    minutes=settings.DEVICE_ROLLUP_INTERVAL,
+    id='device_status_rollup',
+    max_instances=1,
+    replace_existing=True
+)
+
+# 每分钟检查未完成校验的批量控制任务
+scheduler.add_job(
+    check_stale_control_jobs,
+    'interval',
+    minutes=1,
+    id='control_job_check',
+    max_instances=1,
+    replace_existing=True
+)
+
+# 每天维护设备状态历史分区
+scheduler.add_job(
+    maintain_status_partitions,
+    'interval',
+    days=1,
+    id='device_status_partitions',
+    max_instances=1,
+    replace_existing=True
+)
+
 # 安全启动
 try:
     scheduler.start()
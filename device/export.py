@@ -0,0 +1,146 @@
+"""
+设备状态历史导出
+按设备逐个读取，每个设备按(timestamp, id)分块查询，每块都是(device, timestamp)索引上的范围扫描；
+MySQL驱动会把整个结果集读入内存，所以不依赖单条大查询的iterator()，内存占用与导出行数无关。
+支持CSV，安装pyarrow时支持Arrow IPC和Parquet
+"""
+import csv
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Device, DeviceStatus
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+COLUMNS = ('device', 'gateway', 'device_id', 'name', 'timestamp',
+           'current_temp', 'set_temp', 'status', 'mode', 'fan_speed')
+
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8-sig', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+_VALUES = ('id', 'timestamp', 'current_temp', 'set_temp', 'status', 'mode', 'fan_speed')
+
+
+def scope_devices(device_id=None, floor_id=None, building_id=None, company_id=None):
+    """按设备/楼层/建筑/公司选择导出的设备，返回 [(pk, 网关, 内机ID, 名称)]"""
+    devices = Device.objects.all()
+    if device_id:
+        devices = devices.filter(id=device_id)
+    if floor_id:
+        devices = devices.filter(floor_id=floor_id)
+    if building_id:
+        devices = devices.filter(Q(building_id=building_id) | Q(floor__building_id=building_id))
+    if company_id:
+        devices = devices.filter(company_id=company_id)
+    return list(devices.order_by('id').values_list('id', 'uuid__uuid', 'device_id', 'name'))
+
+
+def iter_chunks(devices, start, end, chunk_size=None):
+    """逐块产出导出行(与COLUMNS对应的元组列表)"""
+    chunk_size = chunk_size or settings.DEVICE_EXPORT_CHUNK_SIZE
+    for pk, gateway, code, name in devices:
+        history = (DeviceStatus.objects
+                   .filter(device_id=pk, timestamp__gte=start, timestamp__lt=end)
+                   .order_by('timestamp', 'id')
+                   .values_list(*_VALUES))
+        last = None
+        while True:
+            chunk = history
+            if last:
+                chunk = chunk.filter(Q(timestamp__gt=last[0]) | Q(timestamp=last[0], id__gt=last[1]))
+            rows = list(chunk[:chunk_size])
+            if not rows:
+                break
+            yield [(pk, gateway, code, name, *row[1:]) for row in rows]
+            if len(rows) < chunk_size:
+                break
+            last = (rows[-1][1], rows[-1][0])
+
+
+def stream(fmt, devices, start, end, chunk_size=None):
+    """按格式产出导出内容的字节块"""
+    chunks = iter_chunks(devices, start, end, chunk_size)
+    if fmt == 'csv':
+        return _stream_csv(chunks)
+    if pa is None:
+        raise ValueError(f"{fmt} export requires pyarrow")
+    return _stream_arrow(chunks, parquet=fmt == 'parquet')
+
+
+class _Buffer:
+    """收集写入的数据，供生成器按块取出"""
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        # csv.writer写入str，pyarrow写入bytes
+        self.parts.append(data.encode('utf-8') if isinstance(data, str) else bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _stream_csv(chunks):
+    buffer = _Buffer()
+    # 与设备导出一致，带BOM方便Excel打开
+    yield '\ufeff'.encode()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.take()
+    yield buffer.take()
+
+
+def _arrow_schema():
+    return pa.schema([
+        ('device', pa.int64()),
+        ('gateway', pa.string()),
+        ('device_id', pa.string()),
+        ('name', pa.string()),
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('current_temp', pa.float64()),
+        ('set_temp', pa.float64()),
+        ('status', pa.string()),
+        ('mode', pa.string()),
+        ('fan_speed', pa.int32()),
+    ])
+
+
+def _stream_arrow(chunks, parquet=False):
+    schema = _arrow_schema()
+    buffer = _Buffer()
+    sink = pa.PythonFile(buffer, mode='w')
+    writer = pq.ParquetWriter(sink, schema) if parquet else pa.ipc.new_stream(sink, schema)
+    try:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            batch = pa.RecordBatch.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+            if parquet:
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+            yield buffer.take()
+    finally:
+        writer.close()
+    yield buffer.take()
@@ -0,0 +1,186 @@
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.utils import timezone
+
+from .models import Device, DeviceStatus
+from .state import device_state
+
+logger = logging.getLogger(__name__)
+
+# 记录到DeviceStatus的状态字段
+HISTORY_FIELDS = ('current_temp', 'set_temp', 'status', 'mode', 'fan_speed')
+
+
+class HistoryWriter:
+    """
+    设备状态历史写入
+    写库缓冲在设备状态变化后调用record()，按DEVICE_HISTORY_SAMPLING中字段的最小间隔决定是否采样；
+    间隔内被跳过的变化在到期后补记一条最新状态。采样进入独立队列，由后台线程批量bulk_create，
+    历史写入慢或出错都不影响实时状态写库
+    """
+
+    def __init__(self, sampling=None, flush_interval=None, batch_size=None, queue_size=None, enabled=None):
+        self.enabled = settings.DEVICE_HISTORY_ENABLED if enabled is None else enabled
+        self.sampling = dict(settings.DEVICE_HISTORY_SAMPLING if sampling is None else sampling)
+        self.flush_interval = flush_interval or settings.DEVICE_HISTORY_FLUSH_INTERVAL
+        self.batch_size = batch_size or settings.DEVICE_HISTORY_BATCH_SIZE
+        self.queue = queue.Queue(maxsize=queue_size or settings.DEVICE_HISTORY_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._last_sample = {}  # 设备主键 -> 最近一次采样时间
+        self._deferred = {}  # 设备主键 -> (被跳过的最近一次变化时间, 最小间隔)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.samples = 0
+        self.deferred_samples = 0
+        self.dropped = 0
+        self.incomplete = 0
+        self.written = 0
+        self.last_flush_latency = 0.0
+
+    def record(self, pk, changes, at):
+        """
+        设备状态变化后调用
+        :param pk: 设备主键
+        :param changes: 本次变化的字段
+        :param at: 上报时间
+        """
+        if not self.enabled:
+            return
+        intervals = [self.sampling[field] for field in changes if field in self.sampling]
+        if not intervals:
+            return
+        interval = min(intervals)
+        last = self._last_sample.get(pk)
+        if last is not None and (at - last).total_seconds() < interval:
+            with self._lock:
+                self._deferred[pk] = (at, interval)
+            return
+        sample = self._sample(pk, at)
+        if sample is None:
+            return
+        self.start()
+        try:
+            self.queue.put_nowait(sample)
+        except queue.Full:
+            self.dropped += 1
+
+    def forget(self, pk):
+        """设备删除后清除采样记录"""
+        with self._lock:
+            self._last_sample.pop(pk, None)
+            self._deferred.pop(pk, None)
+
+    def _sample(self, pk, at):
+        """按设备当前状态生成一条历史记录，状态不完整(如新发现的设备尚未上报全部字段)时跳过"""
+        state = device_state.get(pk)
+        if state is None or any(state.get(field) is None for field in HISTORY_FIELDS):
+            with self._lock:
+                self._deferred.pop(pk, None)
+            self.incomplete += 1
+            return None
+        self._last_sample[pk] = at
+        with self._lock:
+            self._deferred.pop(pk, None)
+        self.samples += 1
+        return DeviceStatus(device_id=pk, timestamp=at, **{field: state[field] for field in HISTORY_FIELDS})
+
+    def _due_samples(self, force=False):
+        """补记间隔已到期的被跳过变化"""
+        now = timezone.now()
+        with self._lock:
+            due = [(pk, at) for pk, (at, interval) in self._deferred.items()
+                   if force or (now - self._last_sample[pk]).total_seconds() >= interval]
+        samples = [sample for sample in (self._sample(pk, at) for pk, at in due) if sample is not None]
+        self.deferred_samples += len(samples)
+        return samples
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='device-history-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """停止后台线程，写完队列中和间隔内被跳过的记录"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.drain()
+
+    def drain(self):
+        samples = self._collect(block=False)
+        while samples:
+            self.write(samples)
+            samples = self._collect(block=False)
+        self.write(self._due_samples(force=True))
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            samples = self._collect()
+            if len(samples) < self.batch_size:
+                samples.extend(self._due_samples())
+            self.write(samples)
+        connection.close()
+
+    def _collect(self, block=True):
+        samples = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(samples) < self.batch_size:
+            try:
+                if block:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    samples.append(self.queue.get(timeout=remaining))
+                else:
+                    samples.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return samples
+
+    def write(self, samples):
+        """批量写入历史记录，设备已被删除时跳过对应记录"""
+        if not samples:
+            return
+        started = time.monotonic()
+        try:
+            try:
+                DeviceStatus.objects.bulk_create(samples, batch_size=self.batch_size)
+            except IntegrityError:
+                existing = set(Device.objects.filter(id__in={s.device_id for s in samples}).values_list('id', flat=True))
+                samples = [s for s in samples if s.device_id in existing]
+                DeviceStatus.objects.bulk_create(samples, batch_size=self.batch_size)
+            self.written += len(samples)
+        except Exception as e:
+            logger.error(f"Device history write error: {e}")
+            connection.close()
+        self.last_flush_latency = time.monotonic() - started
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'sampling': self.sampling,
+            'queue_depth': self.queue.qsize(),
+            'deferred': len(self._deferred),
+            'samples': self.samples,
+            'deferred_samples': self.deferred_samples,
+            'dropped': self.dropped,
+            'incomplete': self.incomplete,
+            'written': self.written,
+            'last_flush_latency_ms': round(self.last_flush_latency * 1000, 3),
+        }
+
+
+# 全局设备状态历史写入实例
+history_writer = HistoryWriter()
@@ -0,0 +1,364 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, connection, transaction
+from django.utils import timezone
+
+from .broadcast import state_broadcaster
+from .history import history_writer
+from .live import live_store
+from .models import Device, Topic
+from .registry import gateway_registry
+from .runtime import running_time_tracker
+from .state import device_state
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayHeartbeats:
+    """
+    网关心跳记录
+    online消息在MQTT网络线程中调用beat，只在内存中记录，不访问数据库；
+    写库线程按间隔用一条bulk_update批量写入心跳时间，有网关离线->在线时在下一次检查时立即写入
+    """
+
+    def __init__(self, flush_interval=None):
+        self.flush_interval = settings.MQTT_HEARTBEAT_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._lock = threading.Lock()
+        self._online = {}  # Topic主键 -> 已写入数据库的在线状态，未知为None
+        self._last_seen = {}  # uuid -> 最近心跳时间
+        self._pending = {}  # Topic主键 -> 待写库的心跳时间
+        self._transitions = 0  # 待写库的离线->在线网关数
+        self._next_flush = time.monotonic() + self.flush_interval
+
+        self.beats = 0
+        self.immediate_writes = 0
+        self.flushed_rows = 0
+
+    def beat(self, gateway, seen_at):
+        """记录一次网关心跳"""
+        self.beats += 1
+        self._last_seen[gateway.uuid] = seen_at
+        with self._lock:
+            if not self._online.get(gateway.id) and gateway.id not in self._pending:
+                # 离线或尚未确认在线，由写库线程尽快写入
+                self._transitions += 1
+            self._pending[gateway.id] = seen_at
+
+    def set_online(self, topic_id, online_status):
+        """Topic保存后同步在线状态"""
+        self._online[topic_id] = online_status
+
+    def last_seen(self, uuid):
+        """网关最近一次心跳时间，本进程未收到过心跳返回None"""
+        return self._last_seen.get(uuid)
+
+    def snapshot(self):
+        return dict(self._last_seen)
+
+    def due(self):
+        return self._transitions > 0 or time.monotonic() >= self._next_flush
+
+    def flush(self):
+        """批量写入心跳时间，同时保证在线状态为True"""
+        self._next_flush = time.monotonic() + self.flush_interval
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            transitions, self._transitions = self._transitions, 0
+        if not pending:
+            return
+        try:
+            Topic.objects.bulk_update(
+                [Topic(id=pk, online_status=True, updated_at=seen_at) for pk, seen_at in pending.items()],
+                ['online_status', 'updated_at'],
+            )
+            self.flushed_rows += len(pending)
+            self.immediate_writes += transitions
+            for pk in pending:
+                self._online[pk] = True
+        except Exception as e:
+            logger.error(f"Heartbeat flush error: {e}")
+            connection.close()
+            # 未写入的心跳留到下一个间隔
+            with self._lock:
+                for pk, seen_at in pending.items():
+                    self._pending.setdefault(pk, seen_at)
+
+    def stats(self):
+        return {
+            'gateways': len(self._last_seen),
+            'beats': self.beats,
+            'pending': len(self._pending),
+            'immediate_writes': self.immediate_writes,
+            'flushed_rows': self.flushed_rows,
+            'flush_interval': self.flush_interval,
+        }
+
+
+class IngestPipeline:
+    """
+    MQTT上报数据写库缓冲
+    on_message只负责入队，后台线程按(uuid, device_id)合并同一设备的多次上报，
+    每隔flush_interval毫秒或攒够batch_size个设备时批量写入数据库。
+    与设备最新状态比较后只写变化的字段；状态未变化的设备只记录上报时间，
+    每隔seen_interval秒用一条语句统一刷新last_updated。
+    workers大于1时每个写库线程有独立队列，同一网关的数据按uuid固定进入一个队列，保证写入顺序
+    """
+
+    def __init__(self, flush_interval_ms=None, batch_size=None, queue_size=None, seen_interval=None, workers=None):
+        self.flush_interval = (flush_interval_ms or settings.MQTT_INGEST_FLUSH_INTERVAL_MS) / 1000
+        self.batch_size = batch_size or settings.MQTT_INGEST_BATCH_SIZE
+        self.queue_size = queue_size or settings.MQTT_INGEST_QUEUE_SIZE
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in range(workers or settings.MQTT_INGEST_WORKERS)]
+        self.seen_interval = settings.MQTT_INGEST_SEEN_INTERVAL if seen_interval is None else seen_interval
+        self._seen_lock = threading.Lock()
+        self._seen = {}  # 状态未变化的设备主键 -> 最近一次上报时间
+        self._next_seen_flush = time.monotonic() + self.seen_interval
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._stats_lock = threading.Lock()
+
+        # 运行指标
+        self.dropped = 0
+        self.hook_errors = 0
+        self.flush_count = 0
+        self.flushed_rows = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def submit(self, uuid, device_id, fields):
+        """
+        提交一条设备状态更新，不阻塞MQTT网络线程
+        :param uuid: 网关uuid
+        :param device_id: 设备地址
+        :param fields: 需要更新的字段
+        """
+        queues = self.queues
+        target = queues[zlib.crc32(str(uuid).encode()) % len(queues)] if len(queues) > 1 else queues[0]
+        try:
+            target.put_nowait(((uuid, device_id), fields))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Ingest queue full, dropped update of {uuid}-{device_id}")
+
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def set_workers(self, workers):
+        """调整写库线程数，只能在启动前调用"""
+        if self.running:
+            raise RuntimeError("Ingest pipeline is running")
+        if workers < 1 or workers == len(self.queues):
+            return
+        self.drain()
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in range(workers)]
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        # 本进程负责写入实时状态(shm存储只允许一个写入进程)
+        live_store.attach_writer()
+        self._threads = [
+            threading.Thread(target=self._run, args=(index,), name=f'mqtt-ingest-flusher-{index}', daemon=True)
+            for index in range(len(self.queues))
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Ingest pipeline started with {len(self._threads)} workers")
+
+    def stop(self, timeout=None):
+        """停止后台线程，退出前写完队列中剩余的数据"""
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self.drain()
+        history_writer.stop(timeout)
+        state_broadcaster.stop()
+
+    def drain(self):
+        """立即把队列中的数据全部写入数据库"""
+        for q in self.queues:
+            while True:
+                pending = self._collect(q, block=False)
+                if not pending:
+                    break
+                self._flush(pending)
+        self.flush_seen()
+        gateway_heartbeats.flush()
+        running_time_tracker.flush()
+
+    def _run(self, index):
+        q = self.queues[index]
+        while not self._stop_event.is_set():
+            pending = self._collect(q)
+            if pending:
+                self._flush(pending)
+            # 未变化设备的last_updated与网关心跳由第一个线程统一刷新
+            if index == 0:
+                self.flush_due()
+        connection.close()
+
+    def flush_queue(self, index):
+        """不等待地写完一个队列中已有的数据，供不使用后台线程的调用方(如AsyncMQTTClient)定时调用"""
+        q = self.queues[index]
+        while True:
+            pending = self._collect(q, block=False)
+            if not pending:
+                break
+            self._flush(pending)
+        if index == 0:
+            self.flush_due()
+
+    def flush_due(self):
+        """到期时刷新未变化设备的last_updated、网关心跳和运行时间"""
+        if self.seen_interval and time.monotonic() >= self._next_seen_flush:
+            self.flush_seen()
+        if gateway_heartbeats.due():
+            gateway_heartbeats.flush()
+        if running_time_tracker.due():
+            running_time_tracker.flush()
+
+    def _collect(self, q, block=True):
+        """从队列中取出一批数据并按设备合并，达到批量大小或超过刷新间隔即返回"""
+        pending = {}
+        deadline = time.monotonic() + self.flush_interval
+        while len(pending) < self.batch_size:
+            try:
+                if block:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    key, fields = q.get(timeout=remaining)
+                else:
+                    key, fields = q.get_nowait()
+            except queue.Empty:
+                break
+            pending.setdefault(key, {}).update(fields)
+        return pending
+
+    def _flush(self, pending):
+        started = time.monotonic()
+        try:
+            try:
+                self.write(pending)
+            except (OperationalError, InterfaceError):
+                # 长时间空闲后连接可能已被数据库关闭，重新建立连接后重试一次
+                connection.close()
+                self.write(pending)
+        except Exception as e:
+            logger.error(f"Ingest flush error: {e}")
+            # 连接可能已失效，关闭后下次写入时重新建立
+            connection.close()
+            return
+        latency = time.monotonic() - started
+        with self._stats_lock:
+            self.flush_count += 1
+            self.flushed_rows += len(pending)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+
+    def write(self, pending):
+        """只写入发生变化的字段，按更新字段分组，每组一条bulk_update语句"""
+        now = timezone.now()
+        # 首次写库前按数据库中的状态初始化运行时间累计，之后只跟随本进程写入的变化
+        running_time_tracker.ensure_loaded()
+        groups = defaultdict(list)
+        applied = []
+        live = {}
+        for (uuid, device_id), fields in pending.items():
+            pk = gateway_registry.get_device_pk(uuid, device_id, fallback=False)
+            if pk is None:
+                # 设备尚未创建，等自动发现后由下一次上报写入
+                continue
+            fields = dict(fields)
+            seen_at = fields.pop('last_updated', None) or now
+            device_state.touch(pk, seen_at)
+            changes = device_state.diff(pk, fields)
+            with self._seen_lock:
+                if not changes:
+                    # 状态未变化，只记录上报时间
+                    self._seen[pk] = seen_at
+                    live[pk] = {'last_updated': seen_at}
+                    continue
+                self._seen.pop(pk, None)
+            applied.append((pk, changes, seen_at))
+            update_fields = dict(changes, last_updated=seen_at)
+            groups[tuple(sorted(update_fields))].append(Device(id=pk, **update_fields))
+
+        if groups:
+            with transaction.atomic():
+                for field_names, objs in groups.items():
+                    Device.objects.bulk_update(objs, field_names, batch_size=self.batch_size)
+        # 已经提交，之后的步骤出错只记录日志，不影响其他设备和本批的后续步骤
+        for pk, changes, seen_at in applied:
+            device_state.apply(pk, changes)
+            live[pk] = dict(changes, last_updated=seen_at)
+            try:
+                if 'status' in changes:
+                    running_time_tracker.observe(pk, seen_at)
+                # 历史记录由独立线程批量写入，不阻塞状态写库
+                history_writer.record(pk, changes, seen_at)
+                # 推送给订阅的WebSocket连接，按窗口合并
+                state_broadcaster.record(pk, changes, seen_at)
+            except Exception as e:
+                self.hook_errors += 1
+                logger.error(f"Ingest post-write error for device {pk}: {e}")
+        try:
+            # 写库之后再更新实时状态，MySQL仍是持久化的数据；树形结构读取时从这里取设备状态，不需要重建
+            if live:
+                live_store.write(live)
+            running_time_tracker.publish()
+        except Exception as e:
+            self.hook_errors += 1
+            logger.error(f"Ingest post-write error: {e}")
+
+    def flush_seen(self):
+        """刷新状态未变化设备的last_updated，每批一条bulk_update语句"""
+        self._next_seen_flush = time.monotonic() + self.seen_interval
+        with self._seen_lock:
+            seen, self._seen = self._seen, {}
+        if not seen:
+            return
+        try:
+            # 每台设备写入自己的最近上报时间
+            Device.objects.bulk_update([Device(id=pk, last_updated=seen_at) for pk, seen_at in seen.items()],
+                                       ['last_updated'], batch_size=self.batch_size)
+        except Exception as e:
+            logger.error(f"Ingest seen flush error: {e}")
+            connection.close()
+
+    def stats(self):
+        """队列深度与写库耗时指标"""
+        return {
+            'workers': len(self.queues),
+            'queue_depth': sum(q.qsize() for q in self.queues),
+            'queue_depths': [q.qsize() for q in self.queues],
+            'queue_size': self.queue_size,
+            'dropped': self.dropped,
+            'hook_errors': self.hook_errors,
+            'flush_count': self.flush_count,
+            'flushed_rows': self.flushed_rows,
+            'last_flush_latency_ms': round(self.last_flush_latency * 1000, 3),
+            'max_flush_latency_ms': round(self.max_flush_latency * 1000, 3),
+            'avg_flush_latency_ms': round(self.total_flush_latency * 1000 / self.flush_count, 3)
+            if self.flush_count else 0.0,
+            'flush_interval_ms': int(self.flush_interval * 1000),
+            'batch_size': self.batch_size,
+            'seen_pending': len(self._seen),
+            'seen_interval': self.seen_interval,
+        }
+
+
+# 全局网关心跳记录与写库缓冲实例
+gateway_heartbeats = GatewayHeartbeats()
+ingest_pipeline = IngestPipeline()
@@ -0,0 +1,203 @@
+"""
+设备实时状态存储
+设备的当前温度、运行状态、在线状态等只由MQTT接入写入，接入写库后同时写入实时状态存储，
+接口读取时用它覆盖数据库中的值，MySQL仍是持久化的数据源；存储中没有的设备直接使用数据库的值。
+设备接口查询时defer实时字段，只从存储读取，存储中缺少的设备再一次批量查库补齐。
+DEVICE_LIVE_STORE:
+    redis: 每个字段一个Redis哈希(设备主键 -> 值)，多个Web节点共享，一次往返读取一批设备
+    shm: 同一主机上的进程共用的共享内存列存储，由接入进程写入，见device/shm.py
+    local: 进程内字典，只在接入与Web在同一进程(开发环境runserver)时有数据
+"""
+import json
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from .models import Device
+from .state import STATE_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# 实时状态字段
+LIVE_FIELDS = STATE_FIELDS + ('last_updated',)
+# 运行时间累计由接入进程发布，Web进程据此计算当前运行时间：本段开始累计的时间(未运行为空)、尚未写库的秒数
+RUNNING_FIELDS = ('running_since', 'running_pending')
+# 存储中保存的全部字段
+STORE_FIELDS = LIVE_FIELDS + RUNNING_FIELDS
+
+
+def overlay(row, state):
+    """用实时状态覆盖row中已有的字段，返回值有变化的字段数"""
+    changed = 0
+    if state:
+        for field, value in state.items():
+            if field in row and row[field] != value:
+                row[field] = value
+                changed += 1
+    return changed
+
+
+def overlay_rows(rows):
+    """rows为{设备主键: dict}，一次读取所有设备的实时状态并覆盖，返回值有变化的字段数"""
+    return sum(overlay(rows[pk], state) for pk, state in live_store.read(rows).items())
+
+
+def load_live(devices):
+    """
+    用实时状态设置一批设备实例的实时字段
+    查询时defer的字段存储中没有的，一次查库补齐，不会在序列化时逐个实例查库
+    """
+    devices = list(devices)
+    states = live_store.read([device.pk for device in devices])
+    missing = {}
+    for device in devices:
+        fields = device.get_deferred_fields() - set(states.get(device.pk, ()))
+        if fields:
+            missing[device.pk] = fields
+    rows = {}
+    if missing:
+        fields = set().union(*missing.values())
+        rows = {row.pop('id'): row for row in Device.objects.filter(id__in=list(missing)).values('id', *fields)}
+    for device in devices:
+        for field, value in rows.get(device.pk, {}).items():
+            setattr(device, field, value)
+        for field, value in states.get(device.pk, {}).items():
+            setattr(device, field, value)
+    return devices
+
+
+class LocalLiveStore:
+    """进程内实时状态"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}  # 设备主键 -> {字段: 值}
+
+    def write(self, states):
+        """写入变化的字段，{设备主键: {字段: 值}}"""
+        with self._lock:
+            for pk, fields in states.items():
+                self._states.setdefault(pk, {}).update(
+                    (field, value) for field, value in fields.items() if field in STORE_FIELDS)
+
+    def read(self, pks):
+        """读取一批设备的实时状态，没有记录的设备不在结果中"""
+        with self._lock:
+            return {pk: dict(self._states[pk]) for pk in pks if pk in self._states}
+
+    def get(self, pk):
+        return self.read([pk]).get(pk)
+
+    def attach_writer(self):
+        pass
+
+    def remove(self, pk):
+        with self._lock:
+            self._states.pop(pk, None)
+
+    def stats(self):
+        return {'backend': 'local', 'devices': len(self._states)}
+
+
+class RedisLiveStore:
+    """Redis实时状态，键为 <prefix>:<字段>，哈希字段为设备主键"""
+
+    def __init__(self, url, prefix='bell:live'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.errors = 0
+
+    def _key(self, field):
+        return f"{self.prefix}:{field}"
+
+    def write(self, states):
+        columns = defaultdict(dict)
+        for pk, fields in states.items():
+            for field, value in fields.items():
+                if field in STORE_FIELDS:
+                    columns[field][pk] = _dump(value)
+        if not columns:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for field, mapping in columns.items():
+                pipe.hset(self._key(field), mapping=mapping)
+            pipe.execute()
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Live state write error: {e}")
+
+    def read(self, pks):
+        pks = list(pks)
+        if not pks:
+            return {}
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for field in STORE_FIELDS:
+                pipe.hmget(self._key(field), pks)
+            columns = pipe.execute()
+        except Exception as e:
+            # Redis不可用时退回数据库中的值
+            self.errors += 1
+            logger.error(f"Live state read error: {e}")
+            return {}
+        states = {}
+        for field, column in zip(STORE_FIELDS, columns):
+            for pk, raw in zip(pks, column):
+                if raw is not None:
+                    states.setdefault(pk, {})[field] = _load(field, raw)
+        return states
+
+    def get(self, pk):
+        return self.read([pk]).get(pk)
+
+    def attach_writer(self):
+        pass
+
+    def remove(self, pk):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for field in STORE_FIELDS:
+                pipe.hdel(self._key(field), pk)
+            pipe.execute()
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Live state remove error: {e}")
+
+    def stats(self):
+        try:
+            devices = self.client.hlen(self._key('last_updated'))
+        except Exception:
+            devices = None
+        return {'backend': 'redis', 'devices': devices, 'errors': self.errors}
+
+
+def _dump(value):
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return json.dumps(value)
+
+
+def _load(field, raw):
+    value = json.loads(raw)
+    if field in ('last_updated', 'running_since') and value is not None:
+        return parse_datetime(value)
+    return value
+
+
+def create_store(backend=None):
+    backend = backend or settings.DEVICE_LIVE_STORE
+    if backend == 'redis':
+        return RedisLiveStore(settings.REDIS_URL)
+    if backend == 'shm':
+        from .shm import SharedMemoryLiveStore
+        return SharedMemoryLiveStore(settings.DEVICE_SHM_NAME, settings.DEVICE_SHM_CAPACITY)
+    return LocalLiveStore()
+
+
+# 全局实时状态实例
+live_store = create_store()
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Case, FloatField, Value, When
+from django.utils import timezone
+
+from device.models import Device
+from device.runtime import backfill_running_time
+
+
+class Command(BaseCommand):
+    help = ('根据设备状态历史重新计算running_time。'
+            '当前仍在运行的设备会计算到执行时刻，应在接入进程停止时运行，避免与接入进程的累计重复')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', type=int, action='append', help='只处理指定设备，可重复')
+        parser.add_argument('--dry-run', action='store_true', help='只输出计算结果，不写库')
+
+    def handle(self, *args, **options):
+        until = timezone.now()
+        devices = Device.objects.order_by('id')
+        if options['device']:
+            devices = devices.filter(id__in=options['device'])
+        results = []
+        for pk, name, stored in devices.values_list('id', 'name', 'running_time'):
+            hours = backfill_running_time(pk, until=until)
+            results.append((pk, hours))
+            if options['verbosity'] > 1 or options['dry_run']:
+                self.stdout.write(f'{pk} {name}: {stored:.3f} -> {hours:.3f} 小时')
+        if options['dry_run']:
+            return
+        for i in range(0, len(results), 500):
+            chunk = results[i:i + 500]
+            Device.objects.filter(id__in=[pk for pk, _ in chunk]).update(running_time=Case(
+                *[When(id=pk, then=Value(hours)) for pk, hours in chunk],
+                output_field=FloatField(),
+            ))
+        self.stdout.write(self.style.SUCCESS(f'已更新 {len(results)} 台设备的运行时间'))
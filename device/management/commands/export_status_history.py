@@ -0,0 +1,46 @@
+import sys
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from device import export
+from device.pagination import parse_time_range
+
+
+class Command(BaseCommand):
+    help = '导出设备状态历史到文件，支持CSV、Arrow IPC和Parquet(后两种需要安装pyarrow)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='开始时间(ISO8601，不带时区按本地时间)，默认结束时间前30天')
+        parser.add_argument('--end', help='结束时间，默认当前时间')
+        parser.add_argument('--device', type=int, help='设备ID')
+        parser.add_argument('--floor', type=int, help='楼层ID')
+        parser.add_argument('--building', type=int, help='建筑ID')
+        parser.add_argument('--company', type=int, help='公司ID')
+        parser.add_argument('--output', choices=sorted(export.FORMATS), default='csv', help='导出格式')
+        parser.add_argument('--chunk-size', type=int, help='每次查询的行数')
+        parser.add_argument('file', help='输出文件，- 表示标准输出')
+
+    def handle(self, *args, **options):
+        try:
+            start, end = parse_time_range(options, default_span=timedelta(days=30))
+            devices = export.scope_devices(
+                device_id=options['device'],
+                floor_id=options['floor'],
+                building_id=options['building'],
+                company_id=options['company'],
+            )
+            content = export.stream(options['output'], devices, start, end, options['chunk_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        size = 0
+        out = sys.stdout.buffer if options['file'] == '-' else open(options['file'], 'wb')
+        try:
+            for data in content:
+                out.write(data)
+                size += len(data)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        self.stderr.write(self.style.SUCCESS(f'已导出 {len(devices)} 台设备的历史，共 {size} 字节'))
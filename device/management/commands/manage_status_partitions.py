@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from device import partitions
+
+
+class Command(BaseCommand):
+    help = ('维护设备状态历史的月分区(仅MySQL)：表尚未分区时先改为按月分区(重写整张表，应在维护窗口执行)，'
+            '之后提前创建未来月份的分区，删除超过保留期的分区')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=settings.DEVICE_STATUS_PARTITIONS_AHEAD,
+                            help='提前创建的月分区数')
+        parser.add_argument('--retention-months', type=int, default=settings.DEVICE_STATUS_RETENTION_MONTHS,
+                            help='保留的月数，0为不删除')
+        parser.add_argument('--dry-run', action='store_true', help='只输出将要执行的SQL')
+
+    def handle(self, *args, **options):
+        if not partitions.is_supported(connection):
+            self.stdout.write(self.style.WARNING(f'{connection.vendor} 不支持分区，跳过'))
+            return
+        execute = not options['dry_run']
+        statements = partitions.partition_table(options['ahead'], execute=execute)
+        if statements and not execute:
+            # 表尚未分区，后续操作依赖分区结果
+            self._report(statements, execute)
+            return
+        statements += partitions.add_partitions(options['ahead'], execute=execute)
+        statements += partitions.drop_partitions(options['retention_months'], execute=execute)
+        self._report(statements, execute)
+
+    def _report(self, statements, execute):
+        if not statements:
+            self.stdout.write(self.style.SUCCESS('分区无需调整'))
+            return
+        for sql in statements:
+            self.stdout.write(sql)
+        if execute:
+            self.stdout.write(self.style.SUCCESS(f'已执行 {len(statements)} 条分区语句'))
@@ -0,0 +1,86 @@
+import logging
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+from device.ingest import ingest_pipeline
+from device.metrics import ingest_metrics
+from device.mqtt_client import mqtt_client
+from device.poller import status_poller
+from device.registry import gateway_registry
+from device.state import device_state
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = '运行MQTT数据接入进程，与Web服务分开部署和扩容'
+    # 不做系统检查，避免加载URL配置和REST接口，接入进程只依赖模型
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.MQTT_INGEST_WORKERS,
+                            help='写库线程数')
+        parser.add_argument('--refresh-interval', type=int, default=settings.MQTT_INGEST_REFRESH_INTERVAL,
+                            help='重新加载网关、设备状态并更新订阅的间隔(秒)，0表示不刷新')
+        parser.add_argument('--scheduler', action='store_true',
+                            help='在本进程中运行设备在线检查等定时任务，多个接入进程时只能有一个使用该参数，'
+                                 '也可以单独运行 manage.py run_scheduler')
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+
+        def shutdown(signum, frame):
+            self.stdout.write(f'收到信号 {signum}，正在停止接入...')
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        ingest_pipeline.set_workers(options['workers'])
+        if not mqtt_client.start():
+            ingest_pipeline.stop()
+            raise CommandError('MQTT连接失败')
+
+        # 分散查询本进程负责的网关的设备状态
+        status_poller.start(mqtt_client)
+
+        # 发布运行指标，Web进程通过Redis读取
+        ingest_metrics.start()
+
+        scheduler = None
+        if options['scheduler']:
+            from device.cron import scheduler  # 导入即启动定时任务
+
+        self.stdout.write(self.style.SUCCESS(
+            f'MQTT接入已启动: 模式 {mqtt_client.consumer_mode}，写库线程 {options["workers"]}'
+        ))
+        refresh_interval = options['refresh_interval']
+        try:
+            while not stop_event.wait(refresh_interval or 60):
+                if refresh_interval:
+                    self.refresh()
+        finally:
+            # 先停止接收，再写完队列中剩余的数据
+            status_poller.stop()
+            mqtt_client.stop()
+            ingest_pipeline.stop()
+            ingest_metrics.stop()
+            if scheduler is not None:
+                scheduler.shutdown(wait=False)
+            connections.close_all()
+            self.stdout.write(self.style.SUCCESS('MQTT接入已停止'))
+
+    @staticmethod
+    def refresh():
+        """同步Web进程中对网关和设备的修改，并按新的网关列表更新订阅"""
+        try:
+            close_old_connections()
+            gateway_registry.load()
+            device_state.load()
+            mqtt_client.resubscribe()
+        except Exception as e:
+            logger.error(f"Ingest refresh error: {e}")
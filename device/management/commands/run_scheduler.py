@@ -0,0 +1,24 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = '运行设备在线检查、状态聚合、分区维护等定时任务；任务保存在DjangoJobStore中，只应运行一个进程'
+    requires_system_checks = []
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+
+        def shutdown(signum, frame):
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        from device.cron import scheduler  # 导入即启动定时任务
+        self.stdout.write(self.style.SUCCESS('定时任务已启动'))
+        stop_event.wait()
+        scheduler.shutdown(wait=True)
+        self.stdout.write(self.style.SUCCESS('定时任务已停止'))
@@ -0,0 +1,160 @@
+"""
+接入进程运行指标
+Web进程不运行接入，进程内的写库缓冲、心跳等对象都是空闲的。run_mqtt_ingest每隔MQTT_STATS_INTERVAL秒
+把各组件的指标写入Redis(bell:ingest:stats:<worker_id>，过期时间为三个间隔，进程退出后自动消失)，
+网关最近心跳时间写入哈希bell:gateway:last_seen；Web进程的ingest/stats/与gateway/heartbeats/从Redis读取
+所有接入进程的数据。未配置REDIS_URL时(开发环境runserver同时运行接入)直接返回本进程的数据
+"""
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .broadcast import state_broadcaster
+from .commands import command_tracker
+from .history import history_writer
+from .ingest import gateway_heartbeats, ingest_pipeline
+from .live import live_store
+from .mqtt_client import mqtt_client
+from .poller import status_poller
+from .registry import gateway_registry
+from .runtime import running_time_tracker
+from .sharding import default_worker_id
+from .state import device_state
+from .trees import tree_cache
+
+logger = logging.getLogger(__name__)
+
+_STATS_PREFIX = 'bell:ingest:stats'
+_LAST_SEEN_KEY = 'bell:gateway:last_seen'
+
+
+def ingest_stats():
+    """本进程接入链路各组件的指标"""
+    return {
+        'client': mqtt_client.stats(),
+        'pipeline': ingest_pipeline.stats(),
+        'registry': gateway_registry.stats(),
+        'state': device_state.stats(),
+        'heartbeats': gateway_heartbeats.stats(),
+        'history': history_writer.stats(),
+        'running_time': running_time_tracker.stats(),
+        'commands': command_tracker.stats(),
+        'poller': status_poller.stats(),
+        'broadcast': state_broadcaster.stats(),
+        'live': live_store.stats(),
+    }
+
+
+def web_stats():
+    """Web进程自身相关的指标：下发命令、路由缓存、树缓存和实时状态"""
+    return {
+        'client': mqtt_client.stats(),
+        'registry': gateway_registry.stats(),
+        'commands': command_tracker.stats(),
+        'live': live_store.stats(),
+        'trees': tree_cache.stats(),
+    }
+
+
+class IngestMetrics:
+    """接入进程定时发布指标，Web进程读取"""
+
+    def __init__(self, url=None, interval=None):
+        self.interval = interval or settings.MQTT_STATS_INTERVAL
+        self.client = None
+        if url:
+            import redis
+            self.client = redis.Redis.from_url(url)
+        self.worker_id = None
+        self._published_seen = {}  # uuid -> 已发布的心跳时间
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.errors = 0
+
+    @property
+    def shared(self):
+        return self.client is not None
+
+    def start(self):
+        """接入进程启动后调用"""
+        if self.client is None or (self._thread is not None and self._thread.is_alive()):
+            return
+        self.worker_id = default_worker_id()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='ingest-metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self.client is not None and self.worker_id:
+            try:
+                self.client.delete(f"{_STATS_PREFIX}:{self.worker_id}")
+            except Exception as e:
+                logger.error(f"Ingest stats cleanup error: {e}")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.publish()
+            self._stop_event.wait(self.interval)
+
+    def publish(self):
+        try:
+            stats = dict(ingest_stats(), published_at=timezone.now())
+            seen = {uuid: at for uuid, at in gateway_heartbeats.snapshot().items()
+                    if self._published_seen.get(uuid) != at}
+            pipe = self.client.pipeline(transaction=False)
+            pipe.set(f"{_STATS_PREFIX}:{self.worker_id}", json.dumps(stats, cls=DjangoJSONEncoder),
+                     ex=int(self.interval * 3) + 1)
+            if seen:
+                # 只写入有新心跳的网关
+                pipe.hset(_LAST_SEEN_KEY, mapping={uuid: at.isoformat() for uuid, at in seen.items()})
+            pipe.execute()
+            self._published_seen.update(seen)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Ingest stats publish error: {e}")
+
+    def read(self):
+        """所有接入进程的指标，{worker_id: 指标}"""
+        if self.client is None:
+            return {default_worker_id(): ingest_stats()}
+        workers = {}
+        try:
+            keys = sorted(self.client.scan_iter(f"{_STATS_PREFIX}:*"))
+            for key, raw in zip(keys, self.client.mget(keys) if keys else []):
+                if raw is not None:
+                    workers[key.decode()[len(_STATS_PREFIX) + 1:]] = json.loads(raw)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Ingest stats read error: {e}")
+        return workers
+
+    def last_seen(self, uuid=None):
+        """网关最近一次心跳时间，指定uuid时只返回该网关"""
+        if self.client is None:
+            if uuid:
+                return {uuid: gateway_heartbeats.last_seen(uuid)}
+            return gateway_heartbeats.snapshot()
+        try:
+            if uuid:
+                raw = self.client.hget(_LAST_SEEN_KEY, uuid)
+                return {uuid: parse_datetime(raw.decode()) if raw else None}
+            return {key.decode(): parse_datetime(value.decode())
+                    for key, value in self.client.hgetall(_LAST_SEEN_KEY).items()}
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Gateway last seen read error: {e}")
+            return {}
+
+
+# 全局接入指标实例
+ingest_metrics = IngestMetrics(settings.REDIS_URL)
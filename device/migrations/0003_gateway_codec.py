@@ -0,0 +1,66 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+DEFAULT_CODEC = {
+    'model': 'default',
+    'status_map': {'1': 'running', '0': 'stopped'},
+    'mode_map': {'0': 'auto', '1': 'cooling', '2': 'heating', '3': 'fan', '4': 'dehumidify'},
+    'fan_speed_map': {},
+    'online_map': {'LOST': False, '': True},
+    'description': '默认网关协议',
+}
+
+# 原send_command中example_0网关的开关编码与默认相反
+INVERTED_ONOFF_CODEC = dict(
+    DEFAULT_CODEC,
+    model='inverted_onoff',
+    status_map={'0': 'running', '1': 'stopped'},
+    description='开关编码相反的网关协议(example_0)',
+)
+INVERTED_ONOFF_GATEWAYS = ('example_0',)
+
+
+def create_default_codec(apps, schema_editor):
+    GatewayCodec = apps.get_model('device', 'GatewayCodec')
+    Topic = apps.get_model('device', 'Topic')
+    inverted, _ = GatewayCodec.objects.get_or_create(model=INVERTED_ONOFF_CODEC['model'],
+                                                     defaults=INVERTED_ONOFF_CODEC)
+    Topic.objects.filter(codec__isnull=True, uuid__in=INVERTED_ONOFF_GATEWAYS).update(codec=inverted)
+    codec, _ = GatewayCodec.objects.get_or_create(model=DEFAULT_CODEC['model'], defaults=DEFAULT_CODEC)
+    Topic.objects.filter(codec__isnull=True).update(codec=codec)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0002_add_online_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GatewayCodec',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100, unique=True, verbose_name='网关型号')),
+                ('status_map', models.JSONField(default=dict, verbose_name='开关状态映射')),
+                ('mode_map', models.JSONField(default=dict, verbose_name='运行模式映射')),
+                ('fan_speed_map', models.JSONField(blank=True, default=dict, verbose_name='风速映射')),
+                ('online_map', models.JSONField(default=dict, verbose_name='在线状态映射')),
+                ('description', models.TextField(blank=True, null=True, verbose_name='描述')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '网关协议',
+                'verbose_name_plural': '网关协议',
+                'db_table': 'device_gateway_codec',
+            },
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='codec',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='topics', to='device.gatewaycodec', verbose_name='网关协议'),
+        ),
+        migrations.RunPython(create_default_codec, migrations.RunPython.noop),
+    ]
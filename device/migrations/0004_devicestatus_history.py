@@ -0,0 +1,55 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def create_status_table(apps, schema_editor):
+    """DeviceStatus表此前在迁移之外创建，已存在时只补充(device, timestamp)索引"""
+    DeviceStatus = apps.get_model('device', 'DeviceStatus')
+    table = DeviceStatus._meta.db_table
+    introspection = schema_editor.connection.introspection
+    with schema_editor.connection.cursor() as cursor:
+        if table not in introspection.table_names(cursor):
+            schema_editor.create_model(DeviceStatus)
+            return
+        existing = introspection.get_constraints(cursor, table)
+    for index in DeviceStatus._meta.indexes:
+        if index.name not in existing:
+            schema_editor.add_index(DeviceStatus, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0003_gateway_codec'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='DeviceStatus',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('current_temp', models.FloatField(verbose_name='当前温度')),
+                        ('set_temp', models.FloatField(verbose_name='设定温度')),
+                        ('status', models.CharField(max_length=20, verbose_name='运行状态')),
+                        ('mode', models.CharField(max_length=20, verbose_name='运行模式')),
+                        ('fan_speed', models.IntegerField(default=0, verbose_name='风速')),
+                        ('timestamp', models.DateTimeField(default=django.utils.timezone.now, verbose_name='记录时间')),
+                        ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_history', to='device.device', verbose_name='设备')),
+                    ],
+                    options={
+                        'verbose_name': '设备状态记录',
+                        'verbose_name_plural': '设备状态历史',
+                        'ordering': ['-timestamp'],
+                    },
+                ),
+                migrations.AddIndex(
+                    model_name='devicestatus',
+                    index=models.Index(fields=['device', 'timestamp'], name='device_status_time_idx'),
+                ),
+            ],
+        ),
+        migrations.RunPython(create_status_table, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0004_devicestatus_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceStatusRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('minute', '分钟'), ('hour', '小时'), ('day', '天')], max_length=10, verbose_name='聚合粒度')),
+                ('bucket', models.DateTimeField(verbose_name='时间段开始')),
+                ('seconds', models.FloatField(default=0, verbose_name='统计时长(秒)')),
+                ('samples', models.IntegerField(default=0, verbose_name='记录条数')),
+                ('current_temp_min', models.FloatField(null=True, verbose_name='最低当前温度')),
+                ('current_temp_max', models.FloatField(null=True, verbose_name='最高当前温度')),
+                ('current_temp_sum', models.FloatField(default=0, verbose_name='当前温度×秒')),
+                ('set_temp_min', models.FloatField(null=True, verbose_name='最低设定温度')),
+                ('set_temp_max', models.FloatField(null=True, verbose_name='最高设定温度')),
+                ('set_temp_sum', models.FloatField(default=0, verbose_name='设定温度×秒')),
+                ('status_seconds', models.JSONField(default=dict, verbose_name='各运行状态时长(秒)')),
+                ('mode_seconds', models.JSONField(default=dict, verbose_name='各运行模式时长(秒)')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_rollups', to='device.device', verbose_name='设备')),
+            ],
+            options={
+                'verbose_name': '设备状态聚合',
+                'verbose_name_plural': '设备状态聚合',
+                'unique_together': {('device', 'period', 'bucket')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='devicestatusrollup',
+            index=models.Index(fields=['period', 'bucket'], name='device_rollup_bucket_idx'),
+        ),
+        migrations.CreateModel(
+            name='DeviceStatusRollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='名称')),
+                ('processed_until', models.DateTimeField(verbose_name='已处理到')),
+                ('carry', models.JSONField(default=dict, verbose_name='各设备在处理时间点的状态')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '设备状态聚合进度',
+                'verbose_name_plural': '设备状态聚合进度',
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    去掉设备状态历史的外键约束(分区表不支持外键)，只修改表结构元数据，不重写数据。
+    按月分区需要重写整张表，不在迁移中执行，在维护窗口运行 manage.py manage_status_partitions
+    """
+
+    dependencies = [
+        ('device', '0005_devicestatus_rollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='devicestatus',
+            name='device',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='status_history', to='device.device', verbose_name='设备'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0006_devicestatus_partitions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ControlJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('control', models.JSONField(default=dict, verbose_name='控制参数')),
+                ('status', models.CharField(choices=[('sent', '已下发'), ('verifying', '校验中'), ('done', '已完成')], default='sent', max_length=20, verbose_name='任务状态')),
+                ('total', models.IntegerField(default=0, verbose_name='设备数')),
+                ('results', models.JSONField(default=dict, verbose_name='各设备结果')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '批量控制任务',
+                'verbose_name_plural': '批量控制任务',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
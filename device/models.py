@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 
@@ -61,11 +62,31 @@ class Floor(models.Model):
         verbose_name_plural = "楼层管理"
         ordering = ['building', 'floor_number']
 
+class GatewayCodec(models.Model):
+    """网关协议转换表，按网关型号配置上报解析与控制下发的编码映射"""
+    model = models.CharField(max_length=100, unique=True, verbose_name='网关型号')
+    status_map = models.JSONField(default=dict, verbose_name='开关状态映射')
+    mode_map = models.JSONField(default=dict, verbose_name='运行模式映射')
+    fan_speed_map = models.JSONField(default=dict, blank=True, verbose_name='风速映射')
+    online_map = models.JSONField(default=dict, verbose_name='在线状态映射')
+    description = models.TextField(blank=True, null=True, verbose_name='描述')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+
+    class Meta:
+        verbose_name = '网关协议'
+        verbose_name_plural = verbose_name
+        db_table = 'device_gateway_codec'
+
+    def __str__(self):
+        return self.model
+
 class Topic(models.Model):
     """MQTT Topic模型"""
     uuid = models.CharField(max_length=100, unique=True, verbose_name='UUID')
     subscribe_topic = models.CharField(max_length=255, verbose_name='订阅Topic路径', db_index=True)
     publish_topic = models.CharField(max_length=255, verbose_name='发布Topic路径', db_index=True)
+    codec = models.ForeignKey(GatewayCodec, on_delete=models.SET_NULL, null=True, blank=True, related_name='topics', verbose_name='网关协议')
     description = models.TextField(blank=True, null=True, verbose_name='描述')
     online_status = models.BooleanField(default=False, verbose_name='网关在线状态')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
@@ -147,16 +168,96 @@ class Device(models.Model):
         unique_together = [('device_id', 'uuid')]
 
 class DeviceStatus(models.Model):
-    """设备状态历史记录"""
-    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name="status_history", verbose_name="设备")
+    """设备状态历史记录，MySQL下按月分区(见device/partitions.py)，分区表不支持外键约束"""
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name="status_history",
+                               db_constraint=False, verbose_name="设备")
     current_temp = models.FloatField(verbose_name="当前温度")
     set_temp = models.FloatField(verbose_name="设定温度")
     status = models.CharField(max_length=20, verbose_name="运行状态")
     mode = models.CharField(max_length=20, verbose_name="运行模式")
     fan_speed = models.IntegerField(verbose_name="风速", default=0)
-    timestamp = models.DateTimeField(auto_now_add=True, verbose_name="记录时间")
+    timestamp = models.DateTimeField(default=timezone.now, verbose_name="记录时间")
 
     class Meta:
         verbose_name = "设备状态记录"
         verbose_name_plural = "设备状态历史"
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['device', 'timestamp'], name='device_status_time_idx'),
+        ]
+
+
+class DeviceStatusRollup(models.Model):
+    """设备状态聚合，按分钟/小时/天统计温度与各状态、模式的持续时间"""
+    PERIOD_CHOICES = (
+        ('minute', '分钟'),
+        ('hour', '小时'),
+        ('day', '天'),
+    )
+
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name="status_rollups", verbose_name="设备")
+    period = models.CharField(max_length=10, choices=PERIOD_CHOICES, verbose_name="聚合粒度")
+    bucket = models.DateTimeField(verbose_name="时间段开始")
+    seconds = models.FloatField(default=0, verbose_name="统计时长(秒)")
+    samples = models.IntegerField(default=0, verbose_name="记录条数")
+    current_temp_min = models.FloatField(null=True, verbose_name="最低当前温度")
+    current_temp_max = models.FloatField(null=True, verbose_name="最高当前温度")
+    current_temp_sum = models.FloatField(default=0, verbose_name="当前温度×秒")
+    set_temp_min = models.FloatField(null=True, verbose_name="最低设定温度")
+    set_temp_max = models.FloatField(null=True, verbose_name="最高设定温度")
+    set_temp_sum = models.FloatField(default=0, verbose_name="设定温度×秒")
+    status_seconds = models.JSONField(default=dict, verbose_name="各运行状态时长(秒)")
+    mode_seconds = models.JSONField(default=dict, verbose_name="各运行模式时长(秒)")
+
+    class Meta:
+        verbose_name = "设备状态聚合"
+        verbose_name_plural = "设备状态聚合"
+        unique_together = [('device', 'period', 'bucket')]
+        indexes = [
+            models.Index(fields=['period', 'bucket'], name='device_rollup_bucket_idx'),
+        ]
+
+    @property
+    def current_temp_avg(self):
+        """按时长加权的平均当前温度"""
+        return self.current_temp_sum / self.seconds if self.seconds else self.current_temp_max
+
+    @property
+    def set_temp_avg(self):
+        return self.set_temp_sum / self.seconds if self.seconds else self.set_temp_max
+
+
+class DeviceStatusRollupWatermark(models.Model):
+    """设备状态聚合进度，记录已处理到的时间及各设备在该时间点的状态"""
+    name = models.CharField(max_length=50, unique=True, verbose_name="名称")
+    processed_until = models.DateTimeField(verbose_name="已处理到")
+    carry = models.JSONField(default=dict, verbose_name="各设备在处理时间点的状态")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "设备状态聚合进度"
+        verbose_name_plural = "设备状态聚合进度"
+
+    def __str__(self):
+        return f"{self.name}: {self.processed_until}"
+
+
+class ControlJob(models.Model):
+    """批量控制任务，记录下发结果及延时校验后各设备的状态"""
+    STATUS_CHOICES = (
+        ('sent', '已下发'),
+        ('verifying', '校验中'),
+        ('done', '已完成'),
+    )
+
+    control = models.JSONField(default=dict, verbose_name="控制参数")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='sent', verbose_name="任务状态")
+    total = models.IntegerField(default=0, verbose_name="设备数")
+    results = models.JSONField(default=dict, verbose_name="各设备结果")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="创建时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "批量控制任务"
+        verbose_name_plural = "批量控制任务"
+        ordering = ['-created_at']
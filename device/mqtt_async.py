@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+from django.utils import timezone
+
+from .ingest import ingest_pipeline, gateway_heartbeats
+from .live import live_store
+from .mqtt_client import MQTTClient
+from .poller import status_poller
+from .registry import gateway_registry
+from .runtime import running_time_tracker
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMQTTClient(MQTTClient):
+    """
+    基于asyncio的MQTT接入客户端，消息处理语义和publish接口与MQTTClient相同
+    paho的socket读写由一个事件循环线程驱动，每条消息作为一个协程任务并发解析和分发，
+    同一网关的消息按到达顺序串行处理；数据库操作交给有界线程池执行，
+    慢查询只占用一个线程池线程，不会阻塞其他网关的消息。
+    处理中的消息超过max_inflight时暂停读socket，由TCP流控向broker反压
+    """
+
+    def __init__(self, client=None, consumer_mode=None, db_workers=None, max_inflight=None):
+        super().__init__(client, consumer_mode)
+        self.db_workers = db_workers or settings.MQTT_ASYNC_DB_WORKERS
+        self.max_inflight = max_inflight or settings.MQTT_ASYNC_MAX_INFLIGHT
+
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+        self.loop = None
+        self._loop_thread = None
+        self._loop_thread_id = None
+        self._executor = None
+        self._db_slots = None
+        self._sock = None
+        self._reading = False
+        self._tasks = []
+        self._gateway_locks = {}  # uuid -> asyncio.Lock，保证同一网关的消息顺序
+        self._inflight_tasks = set()
+
+        self.read_pauses = 0
+        self.reconnects = 0
+
+    # ---- paho socket回调，全部切换到事件循环线程中执行 ----
+
+    def _in_loop(self, func, *args):
+        """Web线程的publish和线程池中的重连也会触发socket回调，需要切换到事件循环线程"""
+        if threading.get_ident() == self._loop_thread_id:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._in_loop(self._socket_opened, sock)
+
+    def _socket_opened(self, sock):
+        self._sock = sock
+        self._resume_reading()
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._in_loop(self._socket_closed, sock)
+
+    def _socket_closed(self, sock):
+        if self._sock is not sock:
+            self.loop.remove_reader(sock)
+        else:
+            self._pause_reading(count=False)
+            self._sock = None
+        self.loop.remove_writer(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, sock, self.client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_writer, sock)
+
+    def _pause_reading(self, count=True):
+        if self._reading and self._sock is not None:
+            self.loop.remove_reader(self._sock)
+            self._reading = False
+            if count:
+                self.read_pauses += 1
+
+    def _resume_reading(self):
+        if not self._reading and self._sock is not None:
+            self.loop.add_reader(self._sock, self.client.loop_read)
+            self._reading = True
+
+    # ---- 消息分发 ----
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0 or self.publish_only:
+            return super().on_connect(client, userdata, flags, rc)
+        logger.info("Connected to MQTT Broker!")
+        # Django不允许在事件循环中访问数据库，网关路由缓存在线程池中加载后再订阅
+        self.loop.create_task(self._subscribe_all())
+
+    async def _subscribe_all(self):
+        try:
+            await self.run_db(gateway_registry.load)
+            self._subscribed = set()
+            if self.shard is not None:
+                self.shard.join()
+            self.resubscribe()
+        except Exception as e:
+            logger.error(f"MQTT subscribe error: {e}")
+
+    def rebalance(self):
+        """成员消息在事件循环中处理，运行时间累计的调整需要查库，放到线程池中执行"""
+        self.resubscribe()
+        self.loop.create_task(self._rebalance_running_time())
+
+    async def _rebalance_running_time(self):
+        try:
+            await self.run_db(running_time_tracker.rebalance)
+        except Exception as e:
+            logger.error(f"Running time rebalance error: {e}")
+
+    def on_message(self, client, userdata, msg):
+        """只创建处理任务，解析和写库都不在socket读回调中进行"""
+        if threading.get_ident() == self._loop_thread_id:
+            self._accept(msg)
+        else:
+            self.loop.call_soon_threadsafe(self._accept, msg)
+
+    def _accept(self, msg):
+        task = self.loop.create_task(self._dispatch(msg))
+        self._inflight_tasks.add(task)
+        task.add_done_callback(self._done)
+        if len(self._inflight_tasks) >= self.max_inflight:
+            self._pause_reading()
+
+    def _done(self, task):
+        self._inflight_tasks.discard(task)
+        if not self._reading and len(self._inflight_tasks) <= self.max_inflight // 2:
+            self._resume_reading()
+
+    async def _dispatch(self, msg):
+        try:
+            message = self.decode(msg)
+            if message is None:
+                return
+            gateway = gateway_registry.get_gateway(message["uuid"], fallback=False)
+            if gateway is None:
+                # 缓存未命中时在线程池中查询数据库
+                gateway = await self.run_db(gateway_registry.get_gateway, message["uuid"])
+            self.confirm(gateway, message)
+            if self.publish_only or not self.owns(gateway):
+                return
+            lock = self._gateway_locks.get(gateway.uuid)
+            if lock is None:
+                lock = self._gateway_locks[gateway.uuid] = asyncio.Lock()
+            async with lock:
+                await self.handle_async(msg.topic, message, gateway)
+        except Exception as e:
+            logger.error(f"MQTT process message error: {e}")
+
+    async def handle_async(self, topic, message, gateway):
+        """与MQTTClient.handle相同，需要访问数据库的步骤在线程池中执行"""
+        cmd = message.get("cmd")
+        status_poller.observe(gateway.uuid, cmd)
+        if cmd == "status_read":
+            if self.new_device_ids(message, gateway):
+                await self.run_db(self.create_device, message, gateway)
+            self.process_message(message, gateway)
+            logger.info(f"所有数据状态上报 `{message}` from topic：`{topic}` ")
+        elif cmd == "status_report":
+            self.process_message(message, gateway)
+            logger.info(f"状态改变数据上报 `{message}` from topic：`{topic}` ")
+        elif cmd == "online":
+            # 只记录内存，写库由写库线程完成
+            gateway_heartbeats.beat(gateway, timezone.localtime(timezone.now()))
+
+    async def run_db(self, func, *args):
+        """在有界线程池中执行数据库操作，排队的任务数不超过线程数的两倍"""
+        async with self._db_slots:
+            return await self.loop.run_in_executor(self._executor, func, *args)
+
+    # ---- 后台任务 ----
+
+    async def _misc_loop(self):
+        """维持心跳，连接断开后按退避间隔重连"""
+        delay = 1
+        while True:
+            await asyncio.sleep(1)
+            if self.client.loop_misc() != mqtt.MQTT_ERR_NO_CONN:
+                delay = 1
+                continue
+            try:
+                # 重连包含DNS解析和TCP连接，在线程中执行，不阻塞其他网关的消息处理
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                self.reconnects += 1
+                delay = 1
+            except Exception as e:
+                logger.error(f"MQTT reconnect error: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    async def _flush_loop(self):
+        """按刷新间隔在线程池中写库，代替写库缓冲的后台线程"""
+        while True:
+            await asyncio.sleep(ingest_pipeline.flush_interval)
+            await asyncio.gather(*(
+                self.run_db(ingest_pipeline.flush_queue, index)
+                for index in range(len(ingest_pipeline.queues))
+            ))
+
+    # ---- 启动与停止 ----
+
+    def start(self, publish_only=False):
+        """
+        启动事件循环线程并连接broker，连接成功返回True
+        :param publish_only: 只发布控制命令，不订阅网关主题也不写库
+        """
+        with self._start_lock:
+            if self.started:
+                return True
+            self.publish_only = publish_only
+            if not publish_only:
+                # 不启动写库缓冲的线程，由本进程负责写入实时状态
+                live_store.attach_writer()
+            self.loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self.db_workers, thread_name_prefix='mqtt-async-db')
+            self._loop_thread = threading.Thread(target=self._run_loop, name='mqtt-asyncio', daemon=True)
+            self._loop_thread.start()
+            try:
+                asyncio.run_coroutine_threadsafe(self._connect(), self.loop).result()
+                self.started = True
+                logger.info(f"Async MQTT client started, consumer mode: "
+                            f"{'publish only' if publish_only else self.consumer_mode}")
+            except Exception as e:
+                logger.error(f"MQTT connection error: {e}")
+                self._close_loop()
+            return self.started
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._loop_thread_id = threading.get_ident()
+        self.loop.run_forever()
+
+    async def _connect(self):
+        self._db_slots = asyncio.Semaphore(self.db_workers * 2)
+        if self.username and self.password:
+            self.client.username_pw_set(self.username, self.password)
+        if not self.publish_only and self.shard is not None:
+            self.shard.set_will()
+            running_time_tracker.owns = self.shard.owns
+        self.client.connect(self.broker, self.port)
+        self._tasks = [self.loop.create_task(self._misc_loop())]
+        if not self.publish_only:
+            self._tasks.append(self.loop.create_task(self._flush_loop()))
+
+    def stop(self, timeout=30):
+        """断开连接并等待处理中的消息完成，队列中剩余的数据由ingest_pipeline.stop()写入"""
+        with self._start_lock:
+            if not self.started:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._shutdown(timeout), self.loop).result(timeout + 5)
+                logger.info("Async MQTT client stopped")
+            except Exception as e:
+                logger.error(f"MQTT disconnect error: {e}")
+            self._close_loop()
+            self.started = False
+
+    async def _shutdown(self, timeout):
+        for task in self._tasks:
+            task.cancel()
+        if self._inflight_tasks:
+            await asyncio.wait(list(self._inflight_tasks), timeout=timeout)
+        if self.shard is not None and not self.publish_only:
+            self.shard.leave()
+        self.client.disconnect()
+        # 等待DISCONNECT报文发出
+        for _ in range(50):
+            if self._sock is None:
+                break
+            await asyncio.sleep(0.1)
+
+    def _close_loop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join()
+        # 等待线程池中正在执行的写库完成，之后再由ingest_pipeline.stop()写入剩余数据
+        self._executor.shutdown(wait=True)
+        self.loop.close()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            'client': 'asyncio',
+            'inflight': len(self._inflight_tasks),
+            'max_inflight': self.max_inflight,
+            'read_pauses': self.read_pauses,
+            'db_workers': self.db_workers,
+            'reconnects': self.reconnects,
+        })
+        return stats
@@ -1,18 +1,39 @@
 import json
 import logging
+import threading
+import time
 
 import paho.mqtt.client as mqtt
 from django.conf import settings
 from django.utils import timezone
 
-from .models import Topic, Device
+from .commands import command_tracker
+from .ingest import ingest_pipeline, gateway_heartbeats
+from .models import Device
+from .outbound import OutboundQueues
+from .poller import status_poller
+from .registry import gateway_registry
+from .runtime import running_time_tracker
+from .sharding import ShardCoordinator
+from .signals import device_discovered
 
 logger = logging.getLogger(__name__)
 
 
 class MQTTClient:
-    def __init__(self):
-        self.client = mqtt.Client()
+    """
+    MQTT接入客户端
+    consumer_mode:
+        all: 订阅所有网关(单进程)
+        shared: 使用broker共享订阅 $share/<group>/<topic>，由broker在多个进程间分发；
+                需要broker按主题固定分配(如EMQX的hash_topic策略)才能保证单个网关的消息顺序
+        hash: broker不支持共享订阅时，按uuid哈希在在线进程间分配网关，成员变化时自动重新分配
+    接入由run_mqtt_ingest进程(或开发环境的runserver)调用start()启动；
+    Web进程只需下发控制命令，首次publish时以只发布方式连接，不订阅任何主题
+    """
+
+    def __init__(self, client=None, consumer_mode=None):
+        self.client = client or mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
 
@@ -21,135 +42,302 @@ class MQTTClient:
         self.username = settings.MQTT_USERNAME
         self.password = settings.MQTT_PASSWORD
 
+        self.consumer_mode = consumer_mode or settings.MQTT_CONSUMER_MODE
+        self.shard = ShardCoordinator(self.client) if self.consumer_mode == 'hash' else None
+        if self.shard is not None:
+            self.shard.on_rebalance = self.rebalance
+        self._subscribed = set()
+        self._watched = {}  # 只发布模式下为确认命令订阅的主题 -> 未结束的命令数
+        self._watch_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._subscribe_lock = threading.Lock()
+        self.started = False
+        self.publish_only = False
+        # 网关下发队列，按网关限速(配置Redis时各进程共用速率)并合并排队中的命令
+        self.outbound = OutboundQueues(self.publish, url=settings.REDIS_URL)
+
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logger.info("Connected to MQTT Broker!")
-            # 订阅所有存在的主题
-            topic_receive_list = list(Topic.objects.values_list('subscribe_topic', flat=True))
-            topic_all = [(i, 0) for i in topic_receive_list]
-            self.client.subscribe(topic_all)
+            if self.publish_only:
+                # 重连后恢复为确认命令而订阅的主题
+                with self._watch_lock:
+                    topics = list(self._watched)
+                if topics:
+                    self.client.subscribe([(topic, 0) for topic in topics])
+                return
+            # 订阅所有存在的主题，连接时重新加载网关路由缓存
+            gateway_registry.load()
+            self._subscribed = set()
+            if self.shard is not None:
+                self.shard.join()
+            self.resubscribe()
         else:
             logger.error(f"Failed to connect, return code {rc}")
 
+    def subscription_topics(self):
+        """按接入模式计算本进程应订阅的主题"""
+        gateways = gateway_registry.gateways()
+        if self.shard is not None:
+            gateways = [gateway for gateway in gateways if self.shard.owns(gateway.uuid)]
+        topics = {gateway.subscribe_topic for gateway in gateways}
+        if self.consumer_mode == 'shared':
+            return {f"$share/{settings.MQTT_SHARE_GROUP}/{topic}" for topic in topics}
+        return topics
+
+    def resubscribe(self):
+        """与当前订阅比较，只订阅新增主题、取消不再负责的主题"""
+        with self._subscribe_lock:
+            topics = self.subscription_topics()
+            added = topics - self._subscribed
+            removed = self._subscribed - topics
+            if removed:
+                self.client.unsubscribe(list(removed))
+            if added:
+                self.client.subscribe([(topic, 0) for topic in added])
+            self._subscribed = topics
+        if added or removed:
+            logger.info(f"Subscriptions updated: +{len(added)} -{len(removed)}, total {len(topics)}")
+
+    def rebalance(self):
+        """
+        hash模式成员变化后，重新订阅并调整运行时间累计的设备
+        成员消息在MQTT网络线程中处理，运行时间的调整需要扫描设备表，交给后台线程执行
+        """
+        threading.Thread(target=self._rebalance, name='mqtt-rebalance', daemon=True).start()
+
+    def _rebalance(self):
+        try:
+            self.resubscribe()
+        except Exception as e:
+            logger.error(f"MQTT resubscribe error: {e}")
+        try:
+            running_time_tracker.rebalance()
+        except Exception as e:
+            logger.error(f"Running time rebalance error: {e}")
+
     def on_message(self, client, userdata, msg):
         """解析上报数据"""
         try:
-            message = json.loads(msg.payload.decode())
-            # 暂时不日志记录所有收到消息
-            topic = msg.topic
-            # logger.info(f"Received `{message}` from `{topic}` topic")
-            uuid_current = message.get("uuid")
-            if not uuid_current:
-                return
-
-            uuid_object = Topic.objects.filter(uuid=uuid_current).first()
-            if uuid_object is None:
-                return
-            cmd = message.get("cmd")
-            if cmd == "status_read":
-                # 所有设备状态上报信息
-                self.process_message(message, uuid_object)
-                # 判断是否有新设备
-                self.create_device(message, uuid_object)
-                logger.info(f"所有数据状态上报 `{message}` from topic：`{topic}` ")
-            elif cmd == "status_report":
-                # 状态改变数据上报
-                self.process_message(message, uuid_object)
-                logger.info(f"状态改变数据上报 `{message}` from topic：`{topic}` ")
-            elif cmd == "online":
-                # 在线状态消息上报，更新时间自动更新
-                # logger.info(f"更新网管状态：{timezone.localtime(timezone.now())}")
-                Topic.objects.filter(uuid=uuid_current).update(online_status=True,
-                                                               updated_at=timezone.localtime(timezone.now()))
-
+            routed = self.route(msg)
+            if routed is not None:
+                self.handle(msg.topic, *routed)
         except Exception as e:
             logger.error(f"MQTT process message error: {e}")
 
+    def route(self, msg):
+        """解析消息并找到所属网关，不需要本进程处理时返回None"""
+        message = self.decode(msg)
+        if message is None:
+            return None
+        gateway = gateway_registry.get_gateway(message["uuid"])
+        self.confirm(gateway, message)
+        if self.publish_only or not self.owns(gateway):
+            return None
+        return message, gateway
+
+    @staticmethod
+    def confirm(gateway, message):
+        """上报与待确认命令匹配"""
+        if gateway is not None and command_tracker.has_pending(gateway.uuid):
+            command_tracker.observe(gateway, message)
+
+    def decode(self, msg):
+        """解析消息内容，成员消息和没有uuid的消息返回None"""
+        if self.shard is not None and self.shard.is_member_message(msg.topic):
+            self.shard.on_member_message(msg)
+            return None
+        message = json.loads(msg.payload.decode())
+        # 暂时不日志记录所有收到消息
+        # logger.info(f"Received `{message}` from `{msg.topic}` topic")
+        if not message.get("uuid"):
+            return None
+        return message
+
+    def owns(self, gateway):
+        """多个网关共用订阅主题时，只处理本进程负责的网关"""
+        if gateway is None:
+            return False
+        return self.shard is None or self.shard.owns(gateway.uuid)
+
+    def handle(self, topic, message, gateway):
+        """按cmd处理网关消息"""
+        cmd = message.get("cmd")
+        # 轮询按网关的上报调整查询间隔
+        status_poller.observe(gateway.uuid, cmd)
+        if cmd == "status_read":
+            # 先判断是否有新设备，保证新设备的首次上报也能写入
+            self.create_device(message, gateway)
+            # 所有设备状态上报信息
+            self.process_message(message, gateway)
+            logger.info(f"所有数据状态上报 `{message}` from topic：`{topic}` ")
+        elif cmd == "status_report":
+            # 状态改变数据上报
+            self.process_message(message, gateway)
+            logger.info(f"状态改变数据上报 `{message}` from topic：`{topic}` ")
+        elif cmd == "online":
+            # 在线状态消息上报，心跳时间在内存中合并后批量写库
+            gateway_heartbeats.beat(gateway, timezone.localtime(timezone.now()))
+
     @staticmethod
-    def process_message(data, uuid_object):
+    def process_message(data, gateway):
         """上传消息解析,更新设备的数据状态"""
         try:
             device_status_info_list = data.get("body", {}).get("inUnitMessages")
-            online_status_dict = {"LOST": False, "": True}  # 为空目前
             if isinstance(device_status_info_list, list) and device_status_info_list:
-                for device_info in device_status_info_list:
-                    device_id = device_info.get("a")
-                    status = device_info.get("o")
-                    set_temp = device_info.get("ts")
-                    mode = device_info.get("w")
-                    fan_speed = device_info.get("fs")
-                    current_tem = device_info.get("rt")
-                    online_status_str = device_info.get("acs")
-                    online_status_code = online_status_dict.get(online_status_str)
-                    MQTTClient.update_data(uuid_object=uuid_object, device_id=device_id, current_tem=current_tem,
-                                           status=status, mode=mode, fan_speed=fan_speed, set_temp=set_temp,
-                                           online_status=online_status_code)
+                if gateway.codec is None:
+                    logger.error(f"网关 {gateway.uuid} 未配置协议转换表")
+                    return
+                last_updated = timezone.localtime(timezone.now())
+                for device_id, update_fields in gateway.codec.decode_units(device_status_info_list):
+                    update_fields['last_updated'] = last_updated
+                    # 交给写库缓冲批量更新，不在MQTT网络线程中访问数据库
+                    ingest_pipeline.submit(gateway.uuid, device_id, update_fields)
         except Exception as e:
             logger.error(f"process_message function error: {e}")
 
     @staticmethod
-    def update_data(uuid_object, device_id, current_tem=None, status=None, mode=None, fan_speed=None, set_temp=None,
-                    online_status=None):
-        try:
-            status_convert_dict = {"fa000001400001240240614000100308": {"status": {"1": "running", "0": "stopped", },
-                                                                        "mode": {"1": "cooling", "2": "heating",
-                                                                                 "3": "fan", "4": "dehumidify",
-                                                                                 "0": "auto"}},
-                                   "fa000001400001240240614000100317": {"status": {"1": "running", "0": "stopped", },
-                                                                        "mode": {"1": "cooling", "2": "heating",
-                                                                                 "3": "fan", "4": "dehumidify",
-                                                                                 "0": "auto"}},
-                                   "fa000001400001240240615000100165": {"status": {"1": "running", "0": "stopped", },
-                                                                        "mode": {"1": "cooling", "2": "heating",
-                                                                                 "3": "fan", "4": "dehumidify",
-                                                                                 "0": "auto"}},
-                                   }
-            status = status_convert_dict[f"{uuid_object.uuid}"]["status"][str(status)] if status else None
-            mode = status_convert_dict[f"{uuid_object.uuid}"]["mode"][str(mode)] if mode else None
-            update_fields = {k: v for k, v in {
-                'current_temp': current_tem,
-                'status': status,
-                'mode': mode,
-                'fan_speed': fan_speed,
-                'set_temp': set_temp,
-                'online_status': online_status,
-                'last_updated': timezone.localtime(timezone.now())
-
-            }.items() if v is not None}
-            Device.objects.filter(uuid=uuid_object, device_id=device_id).update(**update_fields)
-        except Exception as e:
-            logger.error(f"update_data function error: {e}")
+    def new_device_ids(message, gateway):
+        """上报中出现但缓存中还不存在的设备地址"""
+        device_id_dict_list = message.get("body", {}).get("inUnitMessages")
+        if not isinstance(device_id_dict_list, list) or not device_id_dict_list:
+            return set()
+        reported_ids = {i.get("a") for i in device_id_dict_list if i.get("a")}
+        return reported_ids - gateway_registry.get_device_ids(gateway.uuid)
 
-    @staticmethod
-    def create_device(message, uuid_object):
-        """创建设备"""
+    @classmethod
+    def create_device(cls, message, gateway):
+        """自动发现并批量创建新设备"""
         try:
-            device_id_dict_list = message.get("body", {}).get("inUnitMessages")
-            if isinstance(device_id_dict_list, list) and device_id_dict_list:
-                device_id_list = [i.get("a") for i in device_id_dict_list]
-                # 判断这些设备是否都在数据库中 如果不存在的需要通过Device 模型创建
-                for device_id in device_id_list:
-                    if device_id:
-                        device, created = Device.objects.get_or_create(
-                            uuid=uuid_object,
-                            device_id=device_id,
-                            defaults={"name": "未命名设备",
-                                      "room_id": 0}
-                        )
-                        if created:
-                            logger.info(f"Created new device {device.id}")
+            # 与缓存中已知的设备地址比对，只创建真正的新设备
+            new_ids = cls.new_device_ids(message, gateway)
+            if new_ids:
+                # 其他进程可能同时发现同一设备，忽略unique_together冲突
+                Device.objects.bulk_create([
+                    Device(uuid_id=gateway.id, device_id=device_id, name="未命名设备", room_id=0)
+                    for device_id in sorted(new_ids)
+                ], ignore_conflicts=True)
+                devices = list(Device.objects.filter(uuid_id=gateway.id, device_id__in=new_ids)
+                               .values_list('id', 'device_id'))
+                logger.info(f"Discovered {len(devices)} new devices on gateway {gateway.uuid}")
+                device_discovered.send(sender=Device, gateway=gateway, devices=devices)
         except Exception as e:
             logger.error(f"create device function error: {e}")
 
-    def start(self):
-        try:
-            if self.username and self.password:
-                self.client.username_pw_set(self.username, self.password)
-            self.client.connect(self.broker, self.port)
-            self.client.loop_start()  # 使用loop_start而不是loop_forever
-            logger.info("MQTT client started")
-        except Exception as e:
-            logger.error(f"MQTT connection error: {e}")
+    def start(self, publish_only=False):
+        """
+        连接broker，连接成功返回True
+        :param publish_only: 只发布控制命令，不订阅网关主题也不启动写库线程
+        """
+        with self._start_lock:
+            if self.started:
+                return True
+            try:
+                self.publish_only = publish_only
+                if self.username and self.password:
+                    self.client.username_pw_set(self.username, self.password)
+                if not publish_only:
+                    if self.shard is not None:
+                        self.shard.set_will()
+                        running_time_tracker.owns = self.shard.owns
+                    ingest_pipeline.start()
+                self.client.connect(self.broker, self.port)
+                self.client.loop_start()  # 使用loop_start而不是loop_forever
+                self.started = True
+                if publish_only:
+                    logger.info("MQTT client started, publish only")
+                else:
+                    logger.info(f"MQTT client started, consumer mode: {self.consumer_mode}")
+            except Exception as e:
+                logger.error(f"MQTT connection error: {e}")
+            return self.started
+
+    def stop(self):
+        """断开连接，hash模式下先清除在线声明让其他进程接管"""
+        with self._start_lock:
+            if not self.started:
+                return
+            try:
+                if self.shard is not None and not self.publish_only:
+                    self.shard.leave()
+                self.client.disconnect()
+                self.client.loop_stop()
+                logger.info("MQTT client stopped")
+            except Exception as e:
+                logger.error(f"MQTT disconnect error: {e}")
+            self.started = False
+
+    def stats(self):
+        return {
+            'consumer_mode': self.consumer_mode,
+            'started': self.started,
+            'publish_only': self.publish_only,
+            'subscriptions': len(self._subscribed),
+            'watched': len(self._watched),
+            'shard': self.shard.stats() if self.shard is not None else None,
+            'outbound': self.outbound.stats(),
+        }
+
+    def watch(self, gateway, command):
+        """
+        只发布模式下订阅网关的上报主题，只用于确认命令，不处理上报数据
+        该网关的命令全部确认或超时后取消订阅
+        """
+        if not self.publish_only:
+            return
+        topic = gateway.subscribe_topic
+        with self._watch_lock:
+            count = self._watched.get(topic, 0)
+            self._watched[topic] = count + 1
+            if count == 0:
+                self.client.subscribe(topic, 0)
+        command.on_done = lambda done: self.unwatch(topic)
+        self._expire_later(command)
+
+    def unwatch(self, topic):
+        with self._watch_lock:
+            count = self._watched.get(topic, 0) - 1
+            if count > 0:
+                self._watched[topic] = count
+                return
+            self._watched.pop(topic, None)
+            self.client.unsubscribe(topic)
+
+    def _expire_later(self, command):
+        """没有新上报时待确认表不会清理，到期后主动检查超时，命令仍在下发队列中时顺延"""
+        delay = max(command.deadline - time.monotonic(), 0) + 0.1
+        timer = threading.Timer(delay, self._expire, args=(command,))
+        timer.daemon = True
+        timer.start()
+
+    def _expire(self, command):
+        command_tracker.sweep()
+        if not command.done:
+            self._expire_later(command)
+
+    def send_command(self, gateway, cmd, addrs, body=None, expected=None):
+        """
+        登记待确认命令并放入网关的下发队列，由发送线程按速率发出
+        :param addrs: 设备地址列表
+        :param body: addrs以外的命令内容
+        :param expected: 期望的设备字段值，上报达到该值时视为已确认；为空时收到这些设备的上报即确认
+        """
+        if not self.started:
+            self.start(publish_only=True)
+        command = command_tracker.register(gateway.uuid, command_tracker.next_sn(), cmd, addrs, expected)
+        self.watch(gateway, command)
+        self.outbound.enqueue(gateway, cmd, addrs, body, command)
+        return command
+
+    def send_untracked(self, gateway, cmd, addrs, body=None):
+        """
+        只放入网关的下发队列，不登记待确认命令也不订阅网关主题，用于轮询等不需要确认的查询
+        :return: 是否已放入队列
+        """
+        if not self.started:
+            self.start(publish_only=True)
+        self.outbound.enqueue(gateway, cmd, addrs, body)
+        return True
 
     def publish(self, topic, payload, qos=1, retain=False):
         """
@@ -160,6 +348,9 @@ class MQTTClient:
         :param retain: 是否保留消息
         """
         try:
+            if not self.started:
+                # Web进程不运行接入，首次下发命令时建立只发布连接
+                self.start(publish_only=True)
             result = self.client.publish(topic, payload, qos=qos, retain=retain)
             logger.info(f"Published to {topic}: {payload}")
             return result
@@ -167,5 +358,9 @@ class MQTTClient:
             logger.error(f"Publish failed: {e}")
 
 
-# 全局MQTT客户端实例
-mqtt_client = MQTTClient()
+# 全局MQTT客户端实例，MQTT_CLIENT=asyncio时使用AsyncMQTTClient
+if settings.MQTT_CLIENT == 'asyncio':
+    from .mqtt_async import AsyncMQTTClient
+    mqtt_client = AsyncMQTTClient()
+else:
+    mqtt_client = MQTTClient()
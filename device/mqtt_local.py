@@ -0,0 +1,157 @@
+"""
+进程内MQTT broker替身，用于在没有真实broker的环境下验证接入逻辑
+支持通配符订阅、保留消息、遗嘱以及 $share/<group>/<filter> 共享订阅(按主题哈希固定分配，保证单主题顺序)
+用法:
+    broker = LocalBroker()
+    client = MQTTClient(client=broker.client('worker-1'))
+"""
+import threading
+import zlib
+
+import paho.mqtt.client as mqtt
+
+
+class LocalBroker:
+    """消息在publish调用的线程中同步投递"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clients = []
+        self._retained = {}  # topic -> (payload, qos)
+
+    def client(self, client_id=''):
+        return LocalClient(self, client_id)
+
+    def _attach(self, client):
+        with self._lock:
+            if client not in self._clients:
+                self._clients.append(client)
+
+    def _detach(self, client, send_will):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+        if send_will and client.will is not None:
+            self.publish(*client.will)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        payload = _to_bytes(payload)
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    self._retained.pop(topic, None)
+            targets = self._route(topic)
+        for client in targets:
+            client.deliver(topic, payload, qos, False)
+
+    def _route(self, topic):
+        """计算消息的接收者，共享订阅组内按主题哈希选择一个成员"""
+        targets = []
+        groups = {}
+        for client in self._clients:
+            for sub in client.subscriptions:
+                if sub.startswith('$share/'):
+                    _, group, topic_filter = sub.split('/', 2)
+                    if mqtt.topic_matches_sub(topic_filter, topic):
+                        groups.setdefault((group, topic_filter), []).append(client)
+                elif mqtt.topic_matches_sub(sub, topic) and client not in targets:
+                    targets.append(client)
+        for members in groups.values():
+            member = members[zlib.crc32(topic.encode()) % len(members)]
+            if member not in targets:
+                targets.append(member)
+        return targets
+
+    def _retained_for(self, topic_filter):
+        with self._lock:
+            return [(topic, payload, qos) for topic, (payload, qos) in self._retained.items()
+                    if mqtt.topic_matches_sub(topic_filter, topic)]
+
+
+class LocalClient:
+    """实现MQTTClient用到的paho.mqtt.client.Client接口子集"""
+
+    def __init__(self, broker, client_id=''):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.subscriptions = set()
+        self.will = None
+        self.connected = False
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, qos, retain)
+
+    def connect(self, host='localhost', port=1883, keepalive=60):
+        self.connected = True
+        self.subscriptions = set()
+        self.broker._attach(self)
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+        return mqtt.MQTT_ERR_SUCCESS if self.connected else mqtt.MQTT_ERR_NO_CONN
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self):
+        """正常断开，不发送遗嘱"""
+        self.connected = False
+        self.broker._detach(self, send_will=False)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def crash(self):
+        """模拟进程异常退出，broker发送遗嘱"""
+        self.connected = False
+        self.broker._detach(self, send_will=True)
+
+    def subscribe(self, topic, qos=0):
+        topics = [topic] if isinstance(topic, str) else [t[0] if isinstance(t, tuple) else t for t in topic]
+        self.subscriptions.update(topics)
+        for topic_filter in topics:
+            if not topic_filter.startswith('$share/'):
+                for retained_topic, payload, retained_qos in self.broker._retained_for(topic_filter):
+                    self.deliver(retained_topic, payload, retained_qos, True)
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def unsubscribe(self, topic):
+        topics = [topic] if isinstance(topic, str) else list(topic)
+        self.subscriptions.difference_update(topics)
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.publish(topic, payload, qos, retain)
+        info = mqtt.MQTTMessageInfo(0)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        return info
+
+    def deliver(self, topic, payload, qos, retain):
+        if not self.connected or self.on_message is None:
+            return
+        msg = mqtt.MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        msg.qos = qos
+        msg.retain = retain
+        self.on_message(self, None, msg)
+
+
+def _to_bytes(payload):
+    if payload is None:
+        return b''
+    if isinstance(payload, bytes):
+        return payload
+    return str(payload).encode()
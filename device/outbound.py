@@ -0,0 +1,336 @@
+"""
+网关下发队列
+每个网关一个队列，由一个发送线程按令牌桶速率依次发出，避免同时下发的命令冲垮网关的总线。
+排队中的同类命令合并：参数相同的control_write合并为一条，addrs合并；
+同一设备同一属性的新命令覆盖队列中尚未发出的旧命令。
+每条命令的设备数不超过max_addrs、消息长度不超过max_bytes，超出时拆成多条。
+Web的多个worker和接入进程都会下发命令，配置REDIS_URL时令牌桶保存在Redis中，同一网关的速率为所有进程合计
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+
+from .commands import command_tracker
+
+logger = logging.getLogger(__name__)
+
+# 估算消息长度时sn按最大位数计算
+_MAX_SN = 2 ** 31 - 1
+
+
+def _addr_size(addr):
+    """设备地址在addrs列表中占用的字节数，含引号和分隔符"""
+    return len(json.dumps(addr).encode()) + 2
+
+
+class TokenBucket:
+    """令牌桶，rate为每秒补充的令牌数，burst为桶容量"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        """距离下一个令牌的秒数"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+# 按Redis服务器时间补充令牌并尝试取出一个，返回[是否取到, 距离下一个令牌的秒数]
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local taken = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    taken = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+return {taken, tostring(wait)}
+"""
+
+
+class SharedTokenBucket:
+    """
+    保存在Redis中的令牌桶，多个进程共用
+    Redis不可用时退回进程内令牌桶，按退避间隔(最长max_backoff秒)重试Redis，期间不访问Redis
+    """
+
+    def __init__(self, script, key, rate, burst, max_backoff=30):
+        self.script = script
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.max_backoff = max_backoff
+        self.local = TokenBucket(rate, burst)
+        self._ready_at = 0.0  # 本进程估计的下一个令牌时间
+        self._retry_at = 0.0  # 退回进程内令牌桶时，下次尝试Redis的时间
+        self._backoff = 0
+
+    def _fallback(self, now):
+        return now < self._retry_at
+
+    def take(self, now):
+        if self._fallback(now):
+            return self.local.take(now)
+        try:
+            taken, wait = self.script(keys=[self.key], args=[self.rate, self.burst])
+        except Exception as e:
+            self._backoff = min(self._backoff * 2 or 1, self.max_backoff)
+            self._retry_at = now + self._backoff
+            logger.error(f"Shared token bucket error, retry in {self._backoff}s: {e}")
+            return self.local.take(now)
+        self._backoff = 0
+        self._ready_at = now + float(wait)
+        return bool(taken)
+
+    def wait_time(self, now):
+        if self._fallback(now):
+            return self.local.wait_time(now)
+        return max(self._ready_at - now, 0)
+
+
+class _Entry:
+    """队列中的一条待发命令，commands为合并进来的待确认命令"""
+
+    __slots__ = ('cmd', 'params', 'addrs', 'commands')
+
+    def __init__(self, cmd, params, addrs, commands):
+        self.cmd = cmd
+        self.params = params
+        self.addrs = list(addrs)
+        self.commands = list(commands)
+
+
+class OutboundQueues:
+    """各网关的下发队列与发送线程"""
+
+    def __init__(self, publish, rate=None, burst=None, max_addrs=None, max_bytes=None, url=None):
+        self.publish = publish
+        self.rate = rate or settings.MQTT_GATEWAY_RATE
+        self.burst = burst or settings.MQTT_GATEWAY_BURST
+        self.max_addrs = max_addrs or settings.MQTT_COMMAND_MAX_ADDRS
+        self.max_bytes = max_bytes or settings.MQTT_COMMAND_MAX_BYTES
+        self._cond = threading.Condition()
+        self._queues = {}  # uuid -> deque[_Entry]
+        self._buckets = {}  # uuid -> TokenBucket
+        self._topics = {}  # uuid -> publish_topic
+        self._thread = None
+        self._take_script = None
+        if url:
+            import redis
+            self._take_script = redis.Redis.from_url(url).register_script(_TAKE_SCRIPT)
+
+        self.enqueued = 0
+        self.merged = 0
+        self.superseded = 0
+        self.published = 0
+        self.failed = 0
+
+    def enqueue(self, gateway, cmd, addrs, params=None, command=None):
+        """
+        加入网关的下发队列
+        :param params: addrs以外的命令内容
+        :param command: 对应的待确认命令，发出时记录发送时间
+        """
+        params = dict(params or {})
+        commands = [command] if command is not None else []
+        with self._cond:
+            queue = self._queues.setdefault(gateway.uuid, deque())
+            self._topics[gateway.uuid] = gateway.publish_topic
+            self.enqueued += 1
+            if cmd == 'control_write':
+                self._supersede(queue, addrs, params)
+            self._merge(queue, _Entry(cmd, params, addrs, commands), self._budget(gateway.uuid, cmd, params))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='mqtt-outbound', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _supersede(self, queue, addrs, params):
+        """从排队的control_write中去掉被新命令覆盖的设备属性"""
+        targets = set(addrs)
+        result = []
+        for entry in queue:
+            overlap = [addr for addr in entry.addrs if addr in targets] if entry.cmd == 'control_write' else []
+            if not overlap:
+                result.append(entry)
+                continue
+            remaining = {key: value for key, value in entry.params.items() if key not in params}
+            entry.addrs = [addr for addr in entry.addrs if addr not in targets]
+            self.superseded += len(overlap)
+            if entry.addrs:
+                result.append(entry)
+            if remaining:
+                # 未被覆盖的属性仍需下发，原命令继续等待这些设备确认
+                result.append(_Entry('control_write', remaining, overlap, entry.commands))
+            else:
+                # 所有属性都被覆盖，这些设备改由新命令确认
+                for command in entry.commands:
+                    command.supersede(overlap)
+        queue.clear()
+        queue.extend(result)
+
+    def _budget(self, uuid, cmd, params):
+        """addrs列表可用的字节数"""
+        envelope = {"sn": _MAX_SN, "cmd": cmd, "uuid": uuid, "body": dict(params, addrs=[])}
+        return self.max_bytes - len(json.dumps(envelope).encode())
+
+    def _room(self, current, addrs, budget):
+        """addrs中可以追加到current的前几个地址数，受max_addrs和字节数限制"""
+        size = sum(_addr_size(addr) for addr in current)
+        taken = 0
+        for addr in addrs:
+            size += _addr_size(addr)
+            if len(current) + taken >= self.max_addrs or size > budget:
+                break
+            taken += 1
+        return taken
+
+    def _merge(self, queue, new, budget):
+        """与参数相同的排队命令合并addrs，超过max_addrs或max_bytes时另起一条"""
+        for entry in queue:
+            if entry.cmd != new.cmd or entry.params != new.params:
+                continue
+            addrs = [addr for addr in new.addrs if addr not in entry.addrs]
+            room = self._room(entry.addrs, addrs, budget)
+            if addrs and not room:
+                continue
+            entry.addrs.extend(addrs[:room])
+            entry.commands.extend(new.commands)
+            new.addrs = addrs[room:]
+            self.merged += 1
+            if not new.addrs:
+                return
+        while new.addrs:
+            # 单个地址超出字节数时也单独发出
+            room = self._room([], new.addrs, budget) or 1
+            queue.append(_Entry(new.cmd, new.params, new.addrs[:room], new.commands))
+            new.addrs = new.addrs[room:]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                candidates = self._candidates()
+                while not candidates:
+                    self._cond.wait()
+                    candidates = self._candidates()
+                enqueued = self.enqueued
+            # 共享令牌桶需要访问Redis，在锁外取令牌，不阻塞enqueue
+            uuid = self._take(candidates)
+            with self._cond:
+                if uuid is None:
+                    # 取令牌期间有新命令入队时立即重新检查
+                    if self.enqueued == enqueued:
+                        self._cond.wait(self._next_wait())
+                    continue
+                ready = self._pop(uuid)
+            if ready is not None:
+                self._send(uuid, *ready)
+
+    def _candidates(self):
+        """有排队命令的网关及其令牌桶，按轮转顺序"""
+        candidates = []
+        for uuid in list(self._queues):
+            if not self._queues[uuid]:
+                del self._queues[uuid]
+                continue
+            bucket = self._buckets.get(uuid)
+            if bucket is None:
+                bucket = self._buckets[uuid] = self._bucket(uuid)
+            candidates.append((uuid, bucket))
+        return candidates
+
+    @staticmethod
+    def _take(candidates):
+        """轮流检查各网关，返回第一个取到令牌的网关"""
+        now = time.monotonic()
+        for uuid, bucket in candidates:
+            if bucket.take(now):
+                return uuid
+        return None
+
+    def _pop(self, uuid):
+        """取出网关的队首命令，返回(主题, 命令)；取令牌期间队列已被清空时返回None"""
+        queue = self._queues.get(uuid)
+        if not queue:
+            return None
+        entry = queue.popleft()
+        # 移到末尾，下一轮先检查其他网关
+        self._queues[uuid] = self._queues.pop(uuid)
+        return self._topics[uuid], entry
+
+    def _bucket(self, uuid):
+        if self._take_script is None:
+            return TokenBucket(self.rate, self.burst)
+        return SharedTokenBucket(self._take_script, f"bell:outbound:bucket:{uuid}", self.rate, self.burst)
+
+    def _next_wait(self):
+        now = time.monotonic()
+        waits = [self._buckets[uuid].wait_time(now) for uuid in self._queues if uuid in self._buckets]
+        return min(waits) if waits else None
+
+    def _send(self, uuid, topic, entry):
+        # 不需要确认的命令(如轮询)也带上sn，与待确认命令使用同一序列
+        sn = entry.commands[0].sn if entry.commands else command_tracker.next_sn()
+        payload = {"sn": sn, "cmd": entry.cmd, "uuid": uuid, "body": dict(entry.params, addrs=entry.addrs)}
+        for command in entry.commands:
+            command.mark_sent()
+        info = self.publish(topic, json.dumps(payload))
+        # 未连接或发送缓冲区已满时paho返回错误码而不抛出异常
+        if info is None or info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.failed += 1
+            for command in entry.commands:
+                command.fail()
+            return
+        self.published += 1
+
+    def stats(self):
+        with self._cond:
+            gateways = {
+                uuid: {'queued': len(queue), 'addrs': sum(len(entry.addrs) for entry in queue)}
+                for uuid, queue in self._queues.items() if queue
+            }
+        return {
+            'queued': sum(gateway['queued'] for gateway in gateways.values()),
+            'gateways': gateways,
+            'enqueued': self.enqueued,
+            'merged': self.merged,
+            'superseded': self.superseded,
+            'published': self.published,
+            'failed': self.failed,
+            'rate': self.rate,
+            'burst': self.burst,
+            'shared': self._take_script is not None,
+            'max_addrs': self.max_addrs,
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,80 @@
+"""
+基于(时间, id)的游标分页
+游标为上一页最后一条记录的(时间, id)编码，查询时直接定位到该位置之后，翻到第几页代价都相同
+"""
+import base64
+import json
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def parse_time_range(params, default_span=timedelta(days=1)):
+    """解析start/end查询参数(ISO8601，不带时区按本地时间)，缺省为截止当前的default_span"""
+    def parse(name):
+        value = params.get(name)
+        if not value:
+            return None
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError(f"invalid {name} parameter")
+        return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+    end = parse('end') or timezone.now()
+    start = parse('start') or end - default_span
+    if start >= end:
+        raise ValueError("start must be earlier than end")
+    return start, end
+
+
+def encode_cursor(timestamp, pk):
+    raw = json.dumps([timestamp.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解析游标，格式不正确时抛出ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, pk = json.loads(raw)
+        timestamp = parse_datetime(value)
+    except (TypeError, ValueError):
+        raise ValueError("invalid cursor")
+    if timestamp is None or not isinstance(pk, int):
+        raise ValueError("invalid cursor")
+    return timestamp, pk
+
+
+def parse_limit(value):
+    if not value:
+        return DEFAULT_LIMIT
+    limit = int(value)
+    if limit <= 0:
+        raise ValueError("limit must be positive")
+    return min(limit, MAX_LIMIT)
+
+
+def keyset_page(queryset, time_field, cursor=None, limit=DEFAULT_LIMIT):
+    """
+    按(time_field, id)倒序取一页，返回(记录列表, 下一页游标)
+    queryset可以是values()结果，记录需要包含time_field和id
+    """
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(**{f'{time_field}__lt': timestamp})
+                                   | Q(**{time_field: timestamp, 'id__lt': pk}))
+    rows = list(queryset.order_by(f'-{time_field}', '-id')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if isinstance(last, dict):
+            next_cursor = encode_cursor(last[time_field], last['id'])
+        else:
+            next_cursor = encode_cursor(getattr(last, time_field), last.pk)
+    return rows, next_cursor
@@ -0,0 +1,151 @@
+"""
+DeviceStatus按月分区(MySQL RANGE分区)
+分区按 TO_DAYS(timestamp) 划分，每月一个分区 pYYYYMM，另有 pmax 接收超出范围的数据；
+新月份通过拆分 pmax 提前创建，过期数据整分区删除，不需要DELETE大量记录。
+timestamp以UTC保存，分区边界为UTC月初。其他数据库不支持，相关函数不做任何操作。
+已有数据的表由 manage.py manage_status_partitions 在维护窗口中改为分区表，迁移和定时任务都不重写整张表
+"""
+import logging
+from datetime import date, datetime
+
+from django.db import connection as default_connection
+from django.utils import timezone
+
+from .models import DeviceStatus, DeviceStatusRollupWatermark
+from .rollups import WATERMARK_NAME
+
+logger = logging.getLogger(__name__)
+
+MAX_PARTITION = 'pmax'
+
+
+def is_supported(connection=None):
+    return (connection or default_connection).vendor == 'mysql'
+
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def current_month():
+    now = timezone.now()
+    return date(now.year, now.month, 1)
+
+
+def list_partitions(connection=None):
+    """返回 [(分区名, 分区月份或None)]，表未分区时返回空列表"""
+    connection = connection or default_connection
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION",
+            [DeviceStatus._meta.db_table],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    return [(name, _parse_month(name)) for name in names]
+
+
+def _parse_month(name):
+    if len(name) == 7 and name[0] == 'p' and name[1:].isdigit():
+        return date(int(name[1:5]), int(name[5:7]), 1)
+    return None
+
+
+def _partition_sql(month):
+    return f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{add_months(month, 1):%Y-%m-%d}'))"
+
+
+def partition_table(ahead, connection=None, execute=True):
+    """
+    把未分区的DeviceStatus表改为按月分区，从最早一条记录所在月份建到ahead个月之后
+    需要重写整张表，数据量大时应在维护窗口执行。返回执行的SQL
+    """
+    connection = connection or default_connection
+    if not is_supported(connection) or list_partitions(connection):
+        return []
+    table = connection.ops.quote_name(DeviceStatus._meta.db_table)
+    column = connection.ops.quote_name('timestamp')
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MIN({column}) FROM {table}")
+        first = cursor.fetchone()[0]
+    start = date(first.year, first.month, 1) if first else current_month()
+    months = []
+    month = start
+    while month <= add_months(current_month(), ahead):
+        months.append(month)
+        month = add_months(month, 1)
+    partitions = ',\n    '.join([_partition_sql(month) for month in months]
+                                + [f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE"])
+    statements = [
+        # 分区表的主键必须包含分区列
+        f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, {column})",
+        f"ALTER TABLE {table} PARTITION BY RANGE (TO_DAYS({column})) (\n    {partitions}\n)",
+    ]
+    _execute(connection, statements, execute)
+    return statements
+
+
+def add_partitions(ahead, connection=None, execute=True):
+    """拆分pmax，保证当前月之后ahead个月的分区已存在。返回执行的SQL"""
+    connection = connection or default_connection
+    partitions = list_partitions(connection)
+    months = [month for _, month in partitions if month]
+    if not is_supported(connection) or not months:
+        return []
+    target = add_months(current_month(), ahead)
+    missing = []
+    month = add_months(max(months), 1)
+    while month <= target:
+        missing.append(month)
+        month = add_months(month, 1)
+    if not missing:
+        return []
+    table = connection.ops.quote_name(DeviceStatus._meta.db_table)
+    partitions_sql = ',\n    '.join([_partition_sql(month) for month in missing]
+                                    + [f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE"])
+    statements = [f"ALTER TABLE {table} REORGANIZE PARTITION {MAX_PARTITION} INTO (\n    {partitions_sql}\n)"]
+    _execute(connection, statements, execute)
+    return statements
+
+
+def drop_partitions(retention_months, connection=None, execute=True):
+    """
+    删除超过保留月数的分区(保留当前月及之前retention_months-1个月)
+    尚未被聚合任务处理的分区不删除。返回执行的SQL
+    """
+    connection = connection or default_connection
+    if not is_supported(connection) or retention_months <= 0:
+        return []
+    cutoff = add_months(current_month(), 1 - retention_months)
+    watermark = DeviceStatusRollupWatermark.objects.filter(name=WATERMARK_NAME).values_list(
+        'processed_until', flat=True).first()
+    expired = []
+    for name, month in list_partitions(connection):
+        if month is None or month >= cutoff:
+            continue
+        month_end = add_months(month, 1)
+        if watermark is None or datetime(month_end.year, month_end.month, 1, tzinfo=timezone.utc) > watermark:
+            logger.warning(f"Partition {name} not rolled up yet, skip dropping")
+            continue
+        expired.append(name)
+    if not expired:
+        return []
+    table = connection.ops.quote_name(DeviceStatus._meta.db_table)
+    statements = [f"ALTER TABLE {table} DROP PARTITION {', '.join(expired)}"]
+    _execute(connection, statements, execute)
+    return statements
+
+
+def _execute(connection, statements, execute):
+    if not execute:
+        return
+    with connection.cursor() as cursor:
+        for sql in statements:
+            logger.info(f"Partition maintenance: {sql}")
+            cursor.execute(sql)
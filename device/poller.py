@@ -0,0 +1,167 @@
+"""
+设备状态轮询
+每个网关按各自的到期时间查询已知设备的状态，首次查询的时间在一个间隔内随机分布，
+之后每次间隔加随机抖动，所有网关的查询均匀分散，不会同时下发。
+间隔按网关的上报自适应：上一周期有状态改变上报的网关缩短间隔，没有变化的逐步延长，
+查询后一直没有任何消息的网关(离线)按最大间隔查询
+"""
+import heapq
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from .registry import gateway_registry
+
+logger = logging.getLogger(__name__)
+
+
+# 网关整体查询地址，网关返回其下所有设备的状态，用于尚未发现设备的网关
+GATEWAY_QUERY_ADDR = "1-3-1-0"
+
+
+def poll_gateway(client, gateway):
+    """
+    查询网关下所有已知设备的状态，由下发队列按消息长度拆分；
+    没有已知设备时按网关整体查询，上报的新设备由接入进程自动创建；
+    上报由接入进程正常处理，不需要登记待确认命令
+    """
+    addrs = sorted(gateway_registry.get_device_ids(gateway.uuid)) or [GATEWAY_QUERY_ADDR]
+    return client.send_untracked(gateway, "status_read", addrs, body={"cmd": "addrs"})
+
+
+class _Slot:
+    """一个网关的轮询状态"""
+
+    __slots__ = ('uuid', 'interval', 'due', 'polled_at', 'message_at', 'changes')
+
+    def __init__(self, uuid, interval, due):
+        self.uuid = uuid
+        self.interval = interval
+        self.due = due
+        self.polled_at = None
+        self.message_at = None
+        self.changes = 0  # 上次查询以来的状态改变上报数
+
+
+class StatusPoller:
+    """网关状态轮询线程，由接入进程启动，只查询本进程负责的网关"""
+
+    def __init__(self, interval=None, min_interval=None, max_interval=None, jitter=None):
+        self.interval = settings.DEVICE_POLL_INTERVAL if interval is None else interval
+        self.min_interval = min_interval or settings.DEVICE_POLL_MIN_INTERVAL
+        self.max_interval = max_interval or settings.DEVICE_POLL_MAX_INTERVAL
+        self.jitter = settings.DEVICE_POLL_JITTER if jitter is None else jitter
+        self.client = None
+        self._cond = threading.Condition()
+        self._slots = {}  # uuid -> _Slot
+        self._heap = []  # (到期时间, uuid)
+        self._rescan_at = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.polls = 0
+        self.skipped = 0
+
+    def start(self, client):
+        """开始轮询，client为下发命令的MQTT客户端"""
+        if self.interval <= 0:
+            logger.info("Status polling disabled")
+            return
+        self.client = client
+        self._stopped.clear()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='status-poller', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify()
+
+    def observe(self, uuid, cmd):
+        """收到网关消息时调用，status_report计为一次状态改变"""
+        slot = self._slots.get(uuid)
+        if slot is None:
+            return
+        slot.message_at = time.monotonic()
+        if cmd == "status_report":
+            slot.changes += 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                now = time.monotonic()
+                if now >= self._rescan_at:
+                    self._rescan(now)
+                with self._cond:
+                    wait = min(self._rescan_at, self._heap[0][0] if self._heap else self._rescan_at) - now
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    due, uuid = heapq.heappop(self._heap)
+                    slot = self._slots.get(uuid)
+                # 网关删除后重新加入时，旧的到期时间已作废
+                if slot is not None and slot.due == due:
+                    self._poll(slot)
+            except Exception as e:
+                logger.error(f"Status poller error: {e}")
+                self._stopped.wait(1)
+
+    def _rescan(self, now):
+        """按网关缓存增删轮询的网关，新网关的首次查询在一个间隔内随机分布"""
+        self._rescan_at = now + self.min_interval
+        owned = {gateway.uuid for gateway in gateway_registry.gateways() if self.client.owns(gateway)}
+        with self._cond:
+            for uuid in set(self._slots) - owned:
+                del self._slots[uuid]
+            for uuid in owned - set(self._slots):
+                slot = self._slots[uuid] = _Slot(uuid, self.interval, now + random.uniform(0, self.interval))
+                heapq.heappush(self._heap, (slot.due, uuid))
+
+    def _poll(self, slot):
+        gateway = gateway_registry.get_gateway(slot.uuid, fallback=False)
+        if gateway is not None and poll_gateway(self.client, gateway) is not None:
+            self.polls += 1
+        else:
+            self.skipped += 1
+        now = time.monotonic()
+        slot.interval = self._next_interval(slot)
+        slot.polled_at = now
+        slot.changes = 0
+        slot.due = now + slot.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        with self._cond:
+            if self._slots.get(slot.uuid) is slot:
+                heapq.heappush(self._heap, (slot.due, slot.uuid))
+
+    def _next_interval(self, slot):
+        if slot.polled_at is None:
+            return slot.interval
+        if slot.message_at is None or slot.message_at < slot.polled_at:
+            # 上次查询后没有任何消息，网关可能离线
+            return self.max_interval
+        if slot.changes:
+            return max(self.min_interval, slot.interval / 2)
+        return min(self.max_interval, slot.interval * 1.5)
+
+    def stats(self):
+        with self._cond:
+            intervals = [slot.interval for slot in self._slots.values()]
+            next_due = self._heap[0][0] - time.monotonic() if self._heap else None
+        return {
+            'running': self._thread is not None and self._thread.is_alive() and not self._stopped.is_set(),
+            'gateways': len(intervals),
+            'polls': self.polls,
+            'skipped': self.skipped,
+            'interval': self.interval,
+            'min_interval': min(intervals) if intervals else None,
+            'max_interval': max(intervals) if intervals else None,
+            'avg_interval': round(sum(intervals) / len(intervals), 1) if intervals else None,
+            'next_due_in': round(max(next_due, 0), 3) if next_due is not None else None,
+        }
+
+
+# 全局状态轮询实例
+status_poller = StatusPoller()
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import threading
+from collections import namedtuple, defaultdict
+
+from django.conf import settings
+
+from .codec import compile_codec, load_codecs
+from .models import Topic, Device
+from .versions import SharedVersion
+
+logger = logging.getLogger(__name__)
+
+# 网关路由信息
+Gateway = namedtuple('Gateway', ['id', 'uuid', 'subscribe_topic', 'publish_topic', 'codec'])
+
+
+class GatewayRegistry:
+    """
+    进程内网关/设备路由缓存
+    启动时一次性加载 uuid -> 网关信息(含预编译的协议转换表)、(uuid, device_id) -> 设备主键，
+    上报解析与命令下发的路由查询不再访问数据库；Topic/Device/GatewayCodec保存时由signals增量刷新，
+    同时增加共享版本号，其他进程(各Web worker、接入进程)在查询时发现版本号变化后重新加载
+    """
+
+    _TOPIC_FIELDS = ('id', 'uuid', 'subscribe_topic', 'publish_topic', 'codec_id')
+    # 重新加载时整体替换的路由表
+    _TABLES = ('_gateways', '_gateway_uuids', '_devices', '_device_keys', '_gateway_devices', '_unknown',
+               '_codecs', '_gateway_codec_ids')
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self.version = SharedVersion('registry')
+        self._gateways = {}  # uuid -> Gateway
+        self._gateway_uuids = {}  # Topic主键 -> uuid
+        self._devices = {}  # (uuid, device_id) -> 设备主键
+        self._device_keys = {}  # 设备主键 -> (uuid, device_id)，未绑定网关的设备uuid为None
+        self._gateway_devices = defaultdict(set)  # uuid -> {device_id}
+        self._unknown = set()  # 已确认不存在的uuid，避免未知网关的消息反复查库
+        self._codecs = {}  # GatewayCodec主键 -> CompiledCodec
+        self._gateway_codec_ids = {}  # uuid -> Topic上配置的GatewayCodec主键
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """从数据库全量加载路由信息，加载完成后整体替换，加载期间的查询仍使用原来的路由表"""
+        version = self.version.current()
+        fresh = GatewayRegistry()
+        fresh._codecs = load_codecs()
+        for topic in Topic.objects.values(*self._TOPIC_FIELDS):
+            fresh._add_gateway(topic)
+        for pk, uuid_id, device_id in Device.objects.values_list('id', 'uuid_id', 'device_id'):
+            fresh._add_device(pk, fresh._gateway_uuids.get(uuid_id), device_id)
+        with self._lock:
+            for table in self._TABLES:
+                setattr(self, table, getattr(fresh, table))
+            self._loaded = True
+            self.version.synced(version)
+        logger.info(f"Gateway registry loaded: {len(self._gateways)} gateways, {len(self._devices)} devices")
+
+    def ensure_loaded(self):
+        """首次使用时加载，之后按检查间隔确认其他进程是否修改过网关或设备"""
+        if self._loaded:
+            # AsyncMQTTClient的事件循环中不访问数据库，由线程池中的查询重新加载
+            if not _in_event_loop() and self.version.stale():
+                self.load()
+            return
+        with self._lock:
+            if not self._loaded:
+                self.load()
+
+    def get_gateway(self, uuid, fallback=True):
+        """
+        根据uuid获取网关路由信息，不存在返回None
+        :param fallback: 缓存未命中(包括尚未加载)时是否查询数据库
+        """
+        if fallback:
+            self.ensure_loaded()
+        gateway = self._gateways.get(uuid)
+        if gateway is not None:
+            self.hits += 1
+            return gateway
+        self.misses += 1
+        if not fallback or uuid in self._unknown:
+            return None
+        topic = Topic.objects.filter(uuid=uuid).values(*self._TOPIC_FIELDS).first()
+        with self._lock:
+            if topic is None:
+                self._unknown.add(uuid)
+                return None
+            return self._add_gateway(topic)
+
+    def get_device_pk(self, uuid, device_id, fallback=True):
+        """
+        根据(uuid, device_id)获取设备主键，不存在返回None
+        :param fallback: 缓存未命中时是否回查数据库
+        """
+        self.ensure_loaded()
+        pk = self._devices.get((uuid, device_id))
+        if pk is not None:
+            self.hits += 1
+            return pk
+        self.misses += 1
+        if not fallback:
+            return None
+        pk = Device.objects.filter(uuid__uuid=uuid, device_id=device_id).values_list('id', flat=True).first()
+        if pk is not None:
+            with self._lock:
+                self._add_device(pk, uuid, device_id)
+        return pk
+
+    def get_device_key(self, pk):
+        """根据设备主键获取(uuid, device_id)，设备不存在返回None"""
+        self.ensure_loaded()
+        pk = int(pk)
+        key = self._device_keys.get(pk)
+        if key is not None:
+            self.hits += 1
+            return key
+        self.misses += 1
+        row = Device.objects.filter(id=pk).values_list('uuid__uuid', 'device_id').first()
+        if row is not None:
+            with self._lock:
+                self._add_device(pk, *row)
+        return row
+
+    def get_device_ids(self, uuid):
+        """获取网关下所有已知的设备地址"""
+        self.ensure_loaded()
+        return self._gateway_devices.get(uuid, set())
+
+    def gateways(self):
+        """所有网关的路由信息"""
+        self.ensure_loaded()
+        return list(self._gateways.values())
+
+    def refresh_gateway(self, topic):
+        """Topic保存后刷新对应网关"""
+        with self._lock:
+            old_uuid = self._gateway_uuids.get(topic.id)
+            if old_uuid is not None and old_uuid != topic.uuid:
+                self._gateways.pop(old_uuid, None)
+                self._gateway_codec_ids.pop(old_uuid, None)
+                for device_id in self._gateway_devices.pop(old_uuid, set()):
+                    pk = self._devices.pop((old_uuid, device_id), None)
+                    if pk is not None:
+                        self._add_device(pk, topic.uuid, device_id)
+            self._unknown.discard(topic.uuid)
+            self._add_gateway({
+                'id': topic.id,
+                'uuid': topic.uuid,
+                'subscribe_topic': topic.subscribe_topic,
+                'publish_topic': topic.publish_topic,
+                'codec_id': topic.codec_id,
+            })
+        self.version.bump()
+
+    def remove_gateway(self, topic):
+        """Topic删除后移除网关，其下设备的uuid会被置空"""
+        with self._lock:
+            uuid = self._gateway_uuids.pop(topic.id, topic.uuid)
+            self._gateways.pop(uuid, None)
+            self._gateway_codec_ids.pop(uuid, None)
+            for device_id in self._gateway_devices.pop(uuid, set()):
+                pk = self._devices.pop((uuid, device_id), None)
+                if pk is not None:
+                    self._device_keys[pk] = (None, device_id)
+        self.version.bump()
+
+    def refresh_codec(self, codec):
+        """GatewayCodec保存后重新编译，并更新使用它的网关"""
+        with self._lock:
+            self._codecs[codec.id] = compile_codec(codec)
+            self._rebind_codecs()
+        self.version.bump()
+
+    def remove_codec(self, codec):
+        """GatewayCodec删除后，使用它的网关回退到默认协议"""
+        with self._lock:
+            self._codecs.pop(codec.id, None)
+            for uuid, codec_id in self._gateway_codec_ids.items():
+                if codec_id == codec.id:
+                    self._gateway_codec_ids[uuid] = None
+            self._rebind_codecs()
+        self.version.bump()
+
+    def refresh_device(self, device):
+        """Device保存后刷新对应设备"""
+        with self._lock:
+            self._discard_device(device.pk)
+            uuid = self._gateway_uuids.get(device.uuid_id)
+            if uuid is None and device.uuid_id is not None:
+                uuid = Topic.objects.filter(id=device.uuid_id).values_list('uuid', flat=True).first()
+            self._add_device(device.pk, uuid, device.device_id)
+        self.version.bump()
+
+    def add_devices(self, uuid, devices):
+        """
+        批量登记自动发现的设备
+        :param devices: [(设备主键, 设备地址)]
+        """
+        with self._lock:
+            for pk, device_id in devices:
+                self._add_device(pk, uuid, device_id)
+        self.version.bump()
+
+    def remove_device(self, device):
+        """Device删除后移除对应设备"""
+        with self._lock:
+            self._discard_device(device.pk)
+        self.version.bump()
+
+    def _add_gateway(self, topic):
+        gateway = Gateway(
+            id=topic['id'],
+            uuid=topic['uuid'],
+            subscribe_topic=topic['subscribe_topic'],
+            publish_topic=topic['publish_topic'],
+            codec=self._resolve_codec(topic['codec_id']),
+        )
+        self._gateways[gateway.uuid] = gateway
+        self._gateway_uuids[gateway.id] = gateway.uuid
+        self._gateway_codec_ids[gateway.uuid] = topic['codec_id']
+        return gateway
+
+    def _resolve_codec(self, codec_id):
+        """网关未配置协议时使用默认协议"""
+        codec = self._codecs.get(codec_id)
+        if codec is not None:
+            return codec
+        for codec in self._codecs.values():
+            if codec.model == settings.MQTT_DEFAULT_GATEWAY_CODEC:
+                return codec
+        return None
+
+    def _rebind_codecs(self):
+        for uuid, gateway in list(self._gateways.items()):
+            self._gateways[uuid] = gateway._replace(codec=self._resolve_codec(self._gateway_codec_ids.get(uuid)))
+
+    def _add_device(self, pk, uuid, device_id):
+        self._device_keys[pk] = (uuid, device_id)
+        if uuid is not None:
+            self._devices[(uuid, device_id)] = pk
+            self._gateway_devices[uuid].add(device_id)
+
+    def _discard_device(self, pk):
+        key = self._device_keys.pop(pk, None)
+        if key is None or key[0] is None:
+            return
+        uuid, device_id = key
+        if self._devices.get(key) == pk:
+            del self._devices[key]
+            self._gateway_devices[uuid].discard(device_id)
+
+    def stats(self):
+        """缓存命中指标"""
+        return {
+            'loaded': self._loaded,
+            'gateways': len(self._gateways),
+            'devices': len(self._devices),
+            'codecs': len(self._codecs),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+# 全局网关路由缓存实例
+gateway_registry = GatewayRegistry()
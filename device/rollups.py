@@ -0,0 +1,247 @@
+import logging
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Device, DeviceStatus, DeviceStatusRollup, DeviceStatusRollupWatermark
+
+logger = logging.getLogger(__name__)
+
+# 聚合粒度及时长(秒)，由细到粗
+PERIODS = (('minute', 60), ('hour', 3600), ('day', 86400))
+PERIOD_SECONDS = dict(PERIODS)
+_MINUTE = timedelta(minutes=1)
+
+WATERMARK_NAME = 'device_status'
+
+
+def bucket_start(dt, period):
+    """时间所在聚合时间段的开始，小时和天按本地时区划分"""
+    return _floor(timezone.localtime(dt), period)
+
+
+def _floor(local, period):
+    if period == 'minute':
+        return local.replace(second=0, microsecond=0)
+    if period == 'hour':
+        return local.replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _split(start, end, period):
+    """把本地时间[start, end)按聚合时间段切分，返回(时间段开始, 重叠秒数)"""
+    size = timedelta(seconds=PERIOD_SECONDS[period])
+    bucket = _floor(start, period)
+    while True:
+        next_bucket = bucket + size
+        yield bucket, max((min(end, next_bucket) - max(start, bucket)).total_seconds(), 0)
+        if next_bucket >= end:
+            break
+        bucket = next_bucket
+
+
+class _Aggregate:
+    """一个(设备, 粒度, 时间段)在本次处理窗口内的统计"""
+
+    __slots__ = ('seconds', 'samples', 'temp_min', 'temp_max', 'temp_sum',
+                 'set_min', 'set_max', 'set_sum', 'status_seconds', 'mode_seconds')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.samples = 0
+        self.temp_min = self.temp_max = self.set_min = self.set_max = None
+        self.temp_sum = self.set_sum = 0.0
+        self.status_seconds = defaultdict(float)
+        self.mode_seconds = defaultdict(float)
+
+    def add(self, state, seconds, sample):
+        """累加一段持续seconds秒的状态"""
+        current_temp, set_temp, status, mode = state
+        self.seconds += seconds
+        self.samples += sample
+        self.temp_min = _min(self.temp_min, current_temp)
+        self.temp_max = _max(self.temp_max, current_temp)
+        self.temp_sum += current_temp * seconds
+        self.set_min = _min(self.set_min, set_temp)
+        self.set_max = _max(self.set_max, set_temp)
+        self.set_sum += set_temp * seconds
+        self.status_seconds[status] += seconds
+        self.mode_seconds[mode] += seconds
+
+    def merge_into(self, rollup):
+        rollup.seconds += self.seconds
+        rollup.samples += self.samples
+        rollup.current_temp_min = _min(rollup.current_temp_min, self.temp_min)
+        rollup.current_temp_max = _max(rollup.current_temp_max, self.temp_max)
+        rollup.current_temp_sum += self.temp_sum
+        rollup.set_temp_min = _min(rollup.set_temp_min, self.set_min)
+        rollup.set_temp_max = _max(rollup.set_temp_max, self.set_max)
+        rollup.set_temp_sum += self.set_sum
+        rollup.status_seconds = _merge_seconds(rollup.status_seconds, self.status_seconds)
+        rollup.mode_seconds = _merge_seconds(rollup.mode_seconds, self.mode_seconds)
+
+
+def rollup_device_status(now=None):
+    """
+    增量聚合水位之后的DeviceStatus记录，由定时任务调用，返回处理的记录数
+    每条记录的状态持续到该设备的下一条记录；没有新记录的设备按水位处的状态继续累计小时和天的时长，
+    分钟粒度只保存有记录的分钟。最近DEVICE_ROLLUP_LAG秒内的记录留给下次处理，等待历史写入完成
+    """
+    now = now or timezone.now()
+    upto = bucket_start(now - timedelta(seconds=settings.DEVICE_ROLLUP_LAG), 'minute')
+    if not DeviceStatusRollupWatermark.objects.filter(name=WATERMARK_NAME).exists():
+        first = DeviceStatus.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+        if first is None:
+            return 0
+        DeviceStatusRollupWatermark.objects.get_or_create(
+            name=WATERMARK_NAME, defaults={'processed_until': bucket_start(first, 'minute')})
+
+    window = timedelta(seconds=settings.DEVICE_ROLLUP_WINDOW)
+    total = 0
+    while True:
+        with transaction.atomic():
+            # 锁定水位行后再读取，多个进程同时运行时后到的等前者提交，从推进后的水位继续，同一窗口只聚合一次
+            watermark = DeviceStatusRollupWatermark.objects.select_for_update().get(name=WATERMARK_NAME)
+            if watermark.processed_until >= upto:
+                break
+            total += _rollup_window(watermark, min(upto, watermark.processed_until + window))
+    if total:
+        logger.info(f"Rolled up {total} device status rows until {watermark.processed_until}")
+    return total
+
+
+def _rollup_window(watermark, end):
+    """聚合[processed_until, end)内的记录并推进水位，在锁定水位行的事务中调用"""
+    start = timezone.localtime(watermark.processed_until)
+    end = timezone.localtime(end)
+    carry = {int(pk): tuple(state) for pk, state in watermark.carry.items()}
+    timelines = defaultdict(list)
+    rows = (DeviceStatus.objects.filter(timestamp__gte=start, timestamp__lt=end)
+            .order_by('timestamp', 'id')
+            .values_list('device_id', 'timestamp', 'current_temp', 'set_temp', 'status', 'mode'))
+    count = 0
+    for device_id, timestamp, *state in rows.iterator(chunk_size=5000):
+        timelines[device_id].append((timezone.localtime(timestamp), tuple(state), True))
+        count += 1
+
+    alive = set(Device.objects.values_list('id', flat=True))
+    aggregates = {}
+    new_carry = {}
+    for device_id in carry.keys() | timelines.keys():
+        if device_id not in alive:
+            continue
+        points = timelines.get(device_id, [])
+        if device_id in carry:
+            points.insert(0, (start, carry[device_id], False))
+        active_minutes = sorted({_floor(timestamp, 'minute') for timestamp, _, sample in points if sample})
+        for i, (timestamp, state, sample) in enumerate(points):
+            segment_end = points[i + 1][0] if i + 1 < len(points) else end
+            _accrue(aggregates, device_id, state, timestamp, segment_end, sample, active_minutes)
+        new_carry[device_id] = points[-1][1]
+
+    _save(aggregates)
+    watermark.processed_until = end
+    watermark.carry = {str(pk): list(state) for pk, state in new_carry.items()}
+    watermark.save()
+    return count
+
+
+def _accrue(aggregates, device_id, state, start, end, sample, active_minutes):
+    if start >= end and not sample:
+        # 窗口开始时刻恰好有新记录，延续的状态没有持续时间
+        return
+    # 分钟粒度只累计到有记录的分钟
+    first_minute = _floor(start, 'minute')
+    for bucket in active_minutes[bisect_left(active_minutes, first_minute):]:
+        if bucket > first_minute and bucket >= end:
+            break
+        seconds = max((min(end, bucket + _MINUTE) - max(start, bucket)).total_seconds(), 0)
+        _aggregate(aggregates, device_id, 'minute', bucket).add(state, seconds, sample and bucket == first_minute)
+    for period in ('hour', 'day'):
+        first = True
+        for bucket, seconds in _split(start, end, period):
+            _aggregate(aggregates, device_id, period, bucket).add(state, seconds, sample and first)
+            first = False
+
+
+def _aggregate(aggregates, device_id, period, bucket):
+    key = (device_id, period, bucket)
+    aggregate = aggregates.get(key)
+    if aggregate is None:
+        aggregate = aggregates[key] = _Aggregate()
+    return aggregate
+
+
+def _save(aggregates):
+    """
+    与已有聚合行合并后写入
+    已有行在内存中合并后删除重建，避免bulk_update逐行生成CASE表达式
+    """
+    by_period = defaultdict(set)
+    for device_id, period, bucket in aggregates:
+        by_period[period].add(bucket)
+    existing = {}
+    for period, buckets in by_period.items():
+        for rollup in DeviceStatusRollup.objects.filter(period=period, bucket__in=buckets):
+            existing[(rollup.device_id, rollup.period, rollup.bucket)] = rollup
+
+    rollups, replaced = [], []
+    for (device_id, period, bucket), aggregate in aggregates.items():
+        rollup = existing.get((device_id, period, bucket))
+        if rollup is None:
+            rollup = DeviceStatusRollup(device_id=device_id, period=period, bucket=bucket,
+                                        status_seconds={}, mode_seconds={})
+        else:
+            replaced.append(rollup.pk)
+            rollup.pk = None
+        aggregate.merge_into(rollup)
+        rollups.append(rollup)
+    for i in range(0, len(replaced), 1000):
+        DeviceStatusRollup.objects.filter(pk__in=replaced[i:i + 1000]).delete()
+    DeviceStatusRollup.objects.bulk_create(rollups, batch_size=1000)
+
+
+def choose_period(start, end, resolution=None, max_points=None):
+    """
+    选择能满足查询范围和分辨率的最粗聚合粒度，返回None表示需要读取原始记录
+    :param resolution: 期望的点间隔(秒)，选择不超过该间隔的最粗粒度
+    :param max_points: 未指定resolution时，选择点数不超过max_points的最细粒度
+    """
+    if resolution is None:
+        max_points = max_points or settings.DEVICE_ROLLUP_MAX_POINTS
+        span = (end - start).total_seconds()
+        for period, seconds in PERIODS:
+            if span / seconds <= max_points:
+                return period
+        return PERIODS[-1][0]
+    chosen = None
+    for period, seconds in PERIODS:
+        if seconds <= resolution:
+            chosen = period
+    return chosen
+
+
+def query_rollups(device, start, end, period):
+    """读取设备在[start, end)内的聚合数据"""
+    return (DeviceStatusRollup.objects
+            .filter(device=device, period=period, bucket__gte=bucket_start(start, period), bucket__lt=end)
+            .order_by('bucket'))
+
+
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def _merge_seconds(stored, seconds):
+    merged = dict(stored or {})
+    for key, value in seconds.items():
+        merged[key] = round(merged.get(key, 0) + value, 3)
+    return merged
@@ -0,0 +1,7 @@
+from django.urls import path
+
+from .consumers import DeviceStateConsumer
+
+websocket_urlpatterns = [
+    path('ws/devices/', DeviceStateConsumer.as_asgi()),
+]
@@ -0,0 +1,226 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, F, FloatField, Q, Value, When
+from django.utils import timezone
+
+from .live import live_store
+from .models import Device, DeviceStatus
+from .state import device_state
+
+logger = logging.getLogger(__name__)
+
+# 计入运行时间的运行状态
+RUNNING_STATUSES = ('running',)
+
+
+def is_running(state):
+    return bool(state) and state.get('status') in RUNNING_STATUSES
+
+
+class RunningTimeTracker:
+    """
+    设备运行时间累计
+    写库线程在设备运行状态变化时调用observe，运行中的设备从开始运行的时间累计秒数，
+    每隔flush_interval秒把累计值用一条UPDATE ... CASE语句加到running_time(小时)上
+    hash模式下多个接入进程分担网关，owns为判断网关uuid是否由本进程负责的函数，只累计本进程负责的设备。
+    累计状态变化后通过publish写入实时状态存储，Web进程用live_running_time计算当前运行时间
+    """
+
+    def __init__(self, flush_interval=None):
+        self.flush_interval = settings.DEVICE_RUNTIME_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._since = {}  # 运行中的设备主键 -> 已累计到的时间
+        self._pending = {}  # 设备主键 -> 待写库的运行秒数
+        self._changes = {}  # 设备主键 -> 待发布到实时状态存储的累计字段
+        self._next_flush = time.monotonic() + self.flush_interval
+        self.owns = None  # 网关uuid -> 是否由本进程负责，None时累计所有设备
+
+        self.flushed_rows = 0
+        self.rebalances = 0
+
+    def _owned(self, uuid):
+        return self.owns is None or (uuid is not None and self.owns(uuid))
+
+    def ensure_loaded(self):
+        """启动时数据库中处于运行状态、由本进程负责的设备从当前时间开始累计"""
+        if self._loaded:
+            return
+        now = timezone.now()
+        running = Device.objects.filter(status__in=RUNNING_STATUSES).values_list('id', 'uuid__uuid')
+        with self._lock:
+            if not self._loaded:
+                self._since = {pk: now for pk, uuid in running if self._owned(uuid)}
+                self._loaded = True
+                for pk in self._since:
+                    self._changed(pk)
+        self.publish()
+
+    def rebalance(self):
+        """
+        网关重新分配后调用：不再负责的设备累计到当前时间后停止累计，
+        新分配到的运行中设备从当前时间开始累计
+        """
+        if not self._loaded:
+            return
+        now = timezone.now()
+        devices = Device.objects.values_list('id', 'uuid__uuid', 'status')
+        released = acquired = 0
+        with self._lock:
+            for pk, uuid, status in devices:
+                since = self._since.get(pk)
+                if not self._owned(uuid):
+                    if since is not None:
+                        del self._since[pk]
+                        self._accrue(pk, since, now)
+                        released += 1
+                elif since is None and status in RUNNING_STATUSES:
+                    self._since[pk] = now
+                    self._changed(pk)
+                    acquired += 1
+        # 移交的设备不发布，避免覆盖接管进程发布的累计开始时间
+        self.publish()
+        self.rebalances += 1
+        logger.info(f"Running time tracking rebalanced: -{released} +{acquired}, tracking {len(self._since)}")
+
+    def observe(self, pk, at):
+        """设备状态写库后调用，根据最新状态开始或结束累计"""
+        self.ensure_loaded()
+        running = is_running(device_state.get(pk))
+        with self._lock:
+            since = self._since.get(pk)
+            if running and since is None:
+                self._since[pk] = at
+                self._changed(pk)
+            elif not running and since is not None:
+                del self._since[pk]
+                self._accrue(pk, since, at)
+                self._changed(pk)
+
+    def _accrue(self, pk, since, until):
+        seconds = (until - since).total_seconds()
+        if seconds > 0:
+            self._pending[pk] = self._pending.get(pk, 0.0) + seconds
+
+    def _changed(self, pk, since=True):
+        """记录需要发布的累计字段，调用方持有_lock"""
+        fields = self._changes.setdefault(pk, {})
+        if since:
+            fields['running_since'] = self._since.get(pk)
+        fields['running_pending'] = self._pending.get(pk, 0.0)
+
+    def publish(self):
+        """把累计状态的变化写入实时状态存储，写库线程在每批状态写入后调用"""
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        if not changes:
+            return
+        try:
+            live_store.write(changes)
+        except Exception as e:
+            logger.error(f"Running time publish error: {e}")
+
+    def forget(self, pk):
+        with self._lock:
+            self._since.pop(pk, None)
+            self._pending.pop(pk, None)
+            self._changes.pop(pk, None)
+
+    def due(self):
+        return time.monotonic() >= self._next_flush
+
+    def flush(self):
+        """把运行中设备截至当前的时长与已结束的时长一起写库"""
+        self._next_flush = time.monotonic() + self.flush_interval
+        if not self._loaded:
+            return
+        now = timezone.now()
+        with self._lock:
+            for pk, since in self._since.items():
+                self._accrue(pk, since, now)
+                self._since[pk] = now
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        items = list(pending.items())
+        written = 0
+        try:
+            for i in range(0, len(items), 500):
+                chunk = items[i:i + 500]
+                Device.objects.filter(id__in=[pk for pk, _ in chunk]).update(running_time=Case(
+                    *[When(id=pk, then=F('running_time') + Value(seconds / 3600)) for pk, seconds in chunk],
+                    output_field=FloatField(),
+                ))
+                written += len(chunk)
+        except Exception as e:
+            logger.error(f"Running time flush error: {e}")
+            connection.close()
+            # 未写入的部分留到下次
+            with self._lock:
+                for pk, seconds in items[written:]:
+                    self._pending[pk] = self._pending.get(pk, 0.0) + seconds
+        with self._lock:
+            # 已写库的秒数从发布的累计值中扣除，运行中的设备从本次写库的时间重新累计；
+            # 已停止的设备只更新秒数，不覆盖可能已由其他进程接管后发布的开始时间
+            for pk, _ in items:
+                self._changed(pk, since=pk in self._since)
+        self.publish()
+        self.flushed_rows += written
+
+    def stats(self):
+        return {
+            'running': len(self._since),
+            'pending': len(self._pending),
+            'flushed_rows': self.flushed_rows,
+            'rebalances': self.rebalances,
+            'flush_interval': self.flush_interval,
+        }
+
+
+def live_running_time(stored, since=None, pending=None, now=None):
+    """
+    设备当前运行时间(小时)
+    :param stored: 数据库中的running_time
+    :param since: 接入进程发布的本段开始累计的时间，未运行时为None
+    :param pending: 接入进程已累计但尚未写库的秒数
+    """
+    seconds = pending or 0.0
+    if since is not None:
+        seconds += max(((now or timezone.now()) - since).total_seconds(), 0)
+    return (stored or 0.0) + seconds / 3600
+
+
+def backfill_running_time(device, until=None, chunk_size=5000):
+    """
+    根据DeviceStatus历史重新计算设备的运行时间(小时)
+    每条记录的状态持续到下一条记录，最后一条持续到until(默认当前时间)
+    """
+    until = until or timezone.now()
+    history = (DeviceStatus.objects.filter(device=device, timestamp__lt=until)
+               .order_by('timestamp', 'id').values_list('id', 'timestamp', 'status'))
+    seconds = 0.0
+    previous = None
+    last = None
+    while True:
+        chunk = history
+        if last:
+            chunk = chunk.filter(Q(timestamp__gt=last[1]) | Q(timestamp=last[1], id__gt=last[0]))
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            if previous is not None and previous[2] in RUNNING_STATUSES:
+                seconds += (row[1] - previous[1]).total_seconds()
+            previous = row
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1]
+    if previous is not None and previous[2] in RUNNING_STATUSES:
+        seconds += (until - previous[1]).total_seconds()
+    return seconds / 3600
+
+
+# 全局运行时间累计实例
+running_time_tracker = RunningTimeTracker()
@@ -1,5 +1,19 @@
 from rest_framework import serializers
-from .models import Device, DeviceStatus, Building, Floor, Company, Department, Topic
+from .live import load_live
+from .models import Device, DeviceStatus, DeviceStatusRollup, Building, Floor, Company, Department, Topic
+
+
+class LiveStateListSerializer(serializers.ListSerializer):
+    """列表序列化前一次设置所有设备的实时字段"""
+
+    def to_representation(self, data):
+        items = load_live(data.all() if hasattr(data, 'all') else data)
+        self.child.live_loaded = True
+        try:
+            return super().to_representation(items)
+        finally:
+            self.child.live_loaded = False
+
 
 class CompanySerializer(serializers.ModelSerializer):
     class Meta:
@@ -22,10 +36,18 @@ class DeviceSerializer(serializers.ModelSerializer):
     uuid_value = serializers.CharField(source='uuid.uuid', read_only=True)
     gateway_online = serializers.BooleanField(source='uuid.online_status', read_only=True)
     actual_online_status = serializers.SerializerMethodField()
+    live_loaded = False
     
     class Meta:
         model = Device
         fields = '__all__'
+        list_serializer_class = LiveStateListSerializer
+
+    def to_representation(self, instance):
+        """实时字段使用实时状态存储中的值"""
+        if not self.live_loaded:
+            load_live([instance])
+        return super().to_representation(instance)
 
     def get_uuid_info(self, obj):
         if obj.uuid:
@@ -49,6 +71,17 @@ class DeviceStatusSerializer(serializers.ModelSerializer):
     class Meta:
         model = DeviceStatus
         fields = '__all__'
+
+class DeviceStatusRollupSerializer(serializers.ModelSerializer):
+    current_temp_avg = serializers.FloatField(read_only=True)
+    set_temp_avg = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = DeviceStatusRollup
+        fields = ['bucket', 'seconds', 'samples',
+                  'current_temp_min', 'current_temp_max', 'current_temp_avg',
+                  'set_temp_min', 'set_temp_max', 'set_temp_avg',
+                  'status_seconds', 'mode_seconds']
         
 class DeviceCreateSerializer(serializers.ModelSerializer):
     uuid = serializers.CharField(write_only=True)  # 用于接收uuid字符串
@@ -169,7 +202,8 @@ class BuildingTreeSerializer(serializers.ModelSerializer):
         return 'building'
     
     def get_children(self, obj):
-        floors = obj.floors.all().order_by('floor_number')
+        # 在预取结果上排序，不再为每个建筑查询楼层
+        floors = sorted(obj.floors.all(), key=lambda floor: floor.floor_number)
         result = []
         
         for floor in floors:
@@ -197,7 +231,7 @@ class CompanyTreeSerializer(serializers.ModelSerializer):
         return 'company'
     
     def get_children(self, obj):
-        departments = obj.departments.all()
+        departments = sorted(obj.departments.all(), key=lambda dept: dept.id)
         return [{
             'id': dept.id,
             'label': dept.name,
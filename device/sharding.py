@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import socket
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id():
+    """未配置MQTT_WORKER_ID时使用 主机名-进程号"""
+    return settings.MQTT_WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def rendezvous_owner(key, members):
+    """最高随机权重(rendezvous)哈希：成员增减时只有落在该成员上的网关会迁移"""
+    if not members:
+        return None
+    return max(members, key=lambda member: _weight(member, key))
+
+
+def _weight(member, key):
+    return int.from_bytes(hashlib.md5(f"{member}:{key}".encode()).digest()[:8], 'big')
+
+
+class ShardCoordinator:
+    """
+    按uuid哈希在多个接入进程间分配网关
+    每个进程在 <MQTT_MEMBERS_TOPIC>/<worker_id> 发布保留消息声明在线，并设置同一主题的空遗嘱；
+    所有进程订阅 <MQTT_MEMBERS_TOPIC>/+ 得到成员列表，用rendezvous哈希计算各自负责的网关。
+    同一网关只由一个进程订阅和处理，保证单个网关的消息顺序
+    """
+
+    def __init__(self, client, worker_id=None, members_topic=None):
+        self.client = client
+        self.worker_id = worker_id or default_worker_id()
+        self.members_topic = (members_topic or settings.MQTT_MEMBERS_TOPIC).rstrip('/')
+        self.on_rebalance = None  # 成员变化后的回调
+
+        self._lock = threading.Lock()
+        self._members = frozenset([self.worker_id])
+        self._owned = {}  # uuid -> 是否由本进程负责，成员变化时清空
+        self.rebalances = 0
+
+    @property
+    def presence_topic(self):
+        return f"{self.members_topic}/{self.worker_id}"
+
+    def set_will(self):
+        """连接前设置遗嘱，进程异常退出时由broker清除在线声明"""
+        self.client.will_set(self.presence_topic, b'', qos=1, retain=True)
+
+    def join(self):
+        """连接成功后声明在线并订阅成员列表"""
+        self.client.subscribe(f"{self.members_topic}/+", qos=1)
+        self.client.publish(self.presence_topic, self.worker_id, qos=1, retain=True)
+
+    def leave(self):
+        """正常退出前清除在线声明，其他进程随即接管本进程的网关"""
+        self.client.publish(self.presence_topic, b'', qos=1, retain=True)
+
+    def is_member_message(self, topic):
+        return topic.startswith(f"{self.members_topic}/")
+
+    def on_member_message(self, msg):
+        """处理成员上下线消息"""
+        worker_id = msg.topic[len(self.members_topic) + 1:]
+        with self._lock:
+            if msg.payload:
+                members = self._members | {worker_id}
+            elif worker_id != self.worker_id:
+                members = self._members - {worker_id}
+            else:
+                members = self._members
+            if members == self._members:
+                return
+            self._members = members
+            self._owned = {}
+            self.rebalances += 1
+        logger.info(f"Ingest members changed: {sorted(members)}")
+        if self.on_rebalance is not None:
+            self.on_rebalance()
+
+    def owns(self, uuid):
+        """网关是否由本进程负责"""
+        owned = self._owned.get(uuid)
+        if owned is None:
+            owned = rendezvous_owner(uuid, self._members) == self.worker_id
+            self._owned[uuid] = owned
+        return owned
+
+    def members(self):
+        return sorted(self._members)
+
+    def stats(self):
+        return {
+            'worker_id': self.worker_id,
+            'members': self.members(),
+            'rebalances': self.rebalances,
+        }
@@ -0,0 +1,372 @@
+"""
+共享内存实时状态表
+同一台主机上的接入进程与各个gunicorn worker共用一块multiprocessing.shared_memory，按列存放定长数据：
+    头部: magic, 容量, 已分配行数, 序号(seqlock)
+    pk(int64) current_temp(float64) set_temp(float64) status(int8) mode(int8) fan_speed(int16) online(int8) last_seen(float64)
+    running_since(float64) running_pending(float64)
+每台设备占一行，行号在首次写入时按顺序分配，pk列记录行对应的设备主键，读取方扫描新分配的行建立索引。
+接入进程创建共享内存并负责上报状态的写入(attach_writer)，持有锁文件<临时目录>/<名称>.lock的排他锁，同一主机上只有一个；
+Web、调度等其他进程删除设备、标记离线时也直接修改，所有写入都持有锁文件<名称>.mutex，序号的增加与行分配不会冲突。
+写入前后各把序号加一，读取方在序号为偶数且前后一致时才采用读到的数据；
+批量读取时先把各列整体复制出来(一次内存拷贝)再解码，不会被写入打断太多次。
+未写入过的字段保存为空值(NaN、0或-1)，读取时跳过，接口使用数据库中的值
+"""
+import atexit
+import contextlib
+import fcntl
+import logging
+import math
+import os
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from multiprocessing import resource_tracker, shared_memory
+
+from .models import Device
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'BELLLIV2'
+_HEADER = struct.Struct('<8sQQQ')
+_HEADER_SIZE = 64
+
+STATUS_CODES = {value: code for code, (value, _) in enumerate(Device.STATUS_CHOICES, start=1)}
+MODE_CODES = {value: code for code, (value, _) in enumerate(Device.MODE_CHOICES, start=1)}
+_STATUS_VALUES = {code: value for value, code in STATUS_CODES.items()}
+_MODE_VALUES = {code: value for value, code in MODE_CODES.items()}
+
+# 列名 -> (struct格式, 空值)
+COLUMNS = (
+    ('pk', 'q', 0),
+    ('current_temp', 'd', math.nan),
+    ('set_temp', 'd', math.nan),
+    ('status', 'b', 0),
+    ('mode', 'b', 0),
+    ('fan_speed', 'h', -1),
+    ('online_status', 'b', -1),
+    ('last_updated', 'd', 0.0),
+    ('running_since', 'd', 0.0),
+    ('running_pending', 'd', math.nan),
+)
+
+# 批量读取超过该设备数时复制整列再解码
+_SNAPSHOT_THRESHOLD = 1000
+
+
+def _layout(capacity):
+    """各列在共享内存中的偏移，每列按8字节对齐"""
+    offsets = {}
+    offset = _HEADER_SIZE
+    for name, fmt, _ in COLUMNS:
+        offsets[name] = offset
+        size = struct.calcsize(fmt) * capacity
+        offset += (size + 7) // 8 * 8
+    return offsets, offset
+
+
+_EMPTY = {name: empty for name, _, empty in COLUMNS}
+
+
+def _encode(field, value):
+    if value is None:
+        return _EMPTY[field]
+    if field == 'status':
+        return STATUS_CODES.get(value, 0)
+    if field == 'mode':
+        return MODE_CODES.get(value, 0)
+    if field == 'online_status':
+        return 1 if value else 0
+    if field in ('last_updated', 'running_since'):
+        return value.timestamp()
+    if field in ('current_temp', 'set_temp', 'running_pending'):
+        return float(value)
+    return int(value)
+
+
+def _decode(field, value):
+    """返回解码后的值，空值返回None"""
+    if field in ('current_temp', 'set_temp', 'running_pending'):
+        return None if math.isnan(value) else value
+    if field == 'status':
+        return _STATUS_VALUES.get(value)
+    if field == 'mode':
+        return _MODE_VALUES.get(value)
+    if field == 'fan_speed':
+        return None if value < 0 else value
+    if field == 'online_status':
+        return None if value < 0 else bool(value)
+    if field in ('last_updated', 'running_since'):
+        return datetime.fromtimestamp(value, tz=dt_timezone.utc) if value else None
+    return value
+
+
+class SharedMemoryLiveStore:
+    """共享内存实时状态，接口与LocalLiveStore相同"""
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self.offsets, self.size = _layout(capacity)
+        self._lock = threading.RLock()
+        self._shm = None
+        self._columns = {}
+        self._writer = False
+        self._lock_file = None
+        self._mutex_file = None
+        self._slots = {}  # 设备主键 -> 行号
+        self._scanned = 0
+        self._next_attach = 0
+
+        self.overflow = 0
+        self.retries = 0
+
+    # ---- 共享内存 ----
+
+    def attach_writer(self):
+        """接入进程调用，创建共享内存或接管已有的共享内存，之后本进程负责写入"""
+        with self._lock:
+            if self._writer:
+                return
+            if not self._acquire_writer_lock():
+                return
+            try:
+                shm = shared_memory.SharedMemory(name=self.name, create=True, size=self.size)
+                shm.buf[:_HEADER_SIZE] = _HEADER.pack(_MAGIC, self.capacity, 0, 0).ljust(_HEADER_SIZE, b'\0')
+                logger.info(f"Shared live state created: {self.name}, capacity {self.capacity}")
+            except FileExistsError:
+                shm = shared_memory.SharedMemory(name=self.name)
+            # 接入进程重启后继续使用原来的数据，不随进程退出删除
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            try:
+                self._map(shm)
+            except Exception:
+                self._release_writer_lock()
+                raise
+            if self._header[3] & 1:
+                # 上一个写入进程在写入中途退出，序号恢复为偶数，否则读取方一直认为正在写入
+                self._header[3] += 1
+            self._scan()
+            self._writer = True
+
+    def _acquire_writer_lock(self):
+        """取得写入锁，已有其他写入进程时返回False"""
+        path = os.path.join(tempfile.gettempdir(), f"{self.name}.lock")
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            logger.error(f"Shared live state {self.name} already has a writer, this process will not write it")
+            return False
+        self._lock_file = lock_file
+        return True
+
+    @contextlib.contextmanager
+    def _mutating(self):
+        """修改共享内存期间持有跨进程互斥锁"""
+        with self._lock:
+            if self._mutex_file is None:
+                self._mutex_file = open(os.path.join(tempfile.gettempdir(), f"{self.name}.mutex"), 'a')
+            fcntl.flock(self._mutex_file, fcntl.LOCK_EX)
+            try:
+                if self._header[3] & 1:
+                    # 持有锁时序号仍为奇数，说明其他进程在写入中途退出
+                    self._header[3] += 1
+                # 其他进程可能分配了新行，先建立索引，避免同一设备分配两行
+                self._scan()
+                yield
+            finally:
+                fcntl.flock(self._mutex_file, fcntl.LOCK_UN)
+
+    def _release_writer_lock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _attach_reader(self):
+        """Web进程按需映射，共享内存尚未创建时每隔几秒重试"""
+        if self._shm is not None or time.monotonic() < self._next_attach:
+            return self._shm is not None
+        with self._lock:
+            if self._shm is not None:
+                return True
+            try:
+                shm = shared_memory.SharedMemory(name=self.name)
+            except FileNotFoundError:
+                self._next_attach = time.monotonic() + 5
+                return False
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            self._map(shm)
+        return True
+
+    def _map(self, shm):
+        magic, capacity, _, _ = _HEADER.unpack_from(shm.buf, 0)
+        if magic != _MAGIC or capacity != self.capacity:
+            shm.close()
+            raise ValueError(f"shared memory {self.name} has a different layout, unlink it or change DEVICE_SHM_NAME")
+        self._columns = {
+            name: shm.buf[self.offsets[name]:self.offsets[name] + struct.calcsize(fmt) * self.capacity].cast(fmt)
+            for name, fmt, _ in COLUMNS
+        }
+        self._header = shm.buf[:_HEADER_SIZE].cast('Q')
+        self._shm = shm
+        atexit.register(self.close)
+
+    def close(self):
+        """解除映射，不删除共享内存"""
+        with self._lock:
+            if self._shm is None:
+                return
+            for view in self._columns.values():
+                view.release()
+            self._header.release()
+            self._columns = {}
+            self._shm.close()
+            self._shm = None
+            self._writer = False
+            self._release_writer_lock()
+            if self._mutex_file is not None:
+                self._mutex_file.close()
+                self._mutex_file = None
+
+    # header按8字节读写: [magic, capacity, used, seq]
+
+    @property
+    def _used(self):
+        return self._header[2]
+
+    @property
+    def _seq(self):
+        return self._header[3]
+
+    # ---- 写入 ----
+
+    def _attached(self):
+        """写入进程已映射；其他进程按需映射，共享内存尚未创建时没有需要修改的数据"""
+        return self._writer or self._attach_reader()
+
+    def write(self, states):
+        if not states or not self._attached():
+            return
+        columns = self._columns
+        with self._mutating():
+            self._header[3] += 1
+            try:
+                for pk, fields in states.items():
+                    slot = self._slot(pk)
+                    if slot is None:
+                        continue
+                    for field, value in fields.items():
+                        if field in columns and field != 'pk':
+                            columns[field][slot] = _encode(field, value)
+            finally:
+                self._header[3] += 1
+
+    def _slot(self, pk):
+        """设备对应的行号，新设备分配下一行"""
+        slot = self._slots.get(pk)
+        if slot is not None:
+            return slot
+        used = self._used
+        if used >= self.capacity:
+            self.overflow += 1
+            return None
+        for name, _, empty in COLUMNS:
+            self._columns[name][used] = empty
+        self._columns['pk'][used] = pk
+        self._header[2] = used + 1
+        self._slots[pk] = used
+        self._scanned = used + 1
+        return used
+
+    def remove(self, pk):
+        """清空设备的实时状态，行号保留"""
+        if not self._attached():
+            return
+        with self._mutating():
+            slot = self._slots.get(pk)
+            if slot is None:
+                return
+            self._header[3] += 1
+            for name, _, empty in COLUMNS[1:]:
+                self._columns[name][slot] = empty
+            self._header[3] += 1
+
+    # ---- 读取 ----
+
+    def _scan(self):
+        """读取方为新分配的行建立索引"""
+        used = self._used
+        if used > self._scanned:
+            pks = self._columns['pk']
+            with self._lock:
+                for slot in range(self._scanned, used):
+                    self._slots[pks[slot]] = slot
+                self._scanned = used
+
+    def read(self, pks):
+        pks = list(pks)
+        if not pks or not self._attach_reader():
+            return {}
+        self._scan()
+        slots = [(pk, self._slots[pk]) for pk in pks if pk in self._slots]
+        if not slots:
+            return {}
+        columns = self._consistent_read(slots)
+        if columns is None:
+            # 持续写入时放弃本次读取，使用数据库中的值
+            return {}
+        states = {}
+        for pk, slot in slots:
+            state = {}
+            for name, _, _ in COLUMNS[1:]:
+                value = _decode(name, columns[name][slot])
+                if value is not None:
+                    state[name] = value
+            if state:
+                states[pk] = state
+        return states
+
+    def _consistent_read(self, slots):
+        """在两次写入之间读取，返回{列名: 行号 -> 值}"""
+        for _ in range(50):
+            seq = self._seq
+            if seq & 1:
+                # 正在写入，稍后重试
+                self.retries += 1
+                time.sleep(0.001)
+                continue
+            if len(slots) > _SNAPSHOT_THRESHOLD:
+                columns = self._snapshot()
+            else:
+                columns = {name: {slot: self._columns[name][slot] for _, slot in slots} for name, _, _ in COLUMNS[1:]}
+            if self._seq == seq:
+                return columns
+            self.retries += 1
+        return None
+
+    def _snapshot(self):
+        """复制各列，之后的解码不受写入影响"""
+        used = self._used
+        return {
+            name: memoryview(bytes(self._columns[name][:used])).cast(fmt)
+            for name, fmt, _ in COLUMNS[1:]
+        }
+
+    def get(self, pk):
+        return self.read([pk]).get(pk)
+
+    def stats(self):
+        attached = self._shm is not None or self._attach_reader()
+        return {
+            'backend': 'shm',
+            'name': self.name,
+            'writer': self._writer,
+            'capacity': self.capacity,
+            'devices': self._used if attached else None,
+            'seq': self._seq if attached else None,
+            'overflow': self.overflow,
+            'retries': self.retries,
+        }
@@ -0,0 +1,80 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
+
+from .models import Topic, Device, GatewayCodec, Building, Floor, Company, Department
+from .ingest import gateway_heartbeats
+from .broadcast import state_broadcaster
+from .history import history_writer
+from .live import live_store
+from .registry import gateway_registry
+from .runtime import running_time_tracker
+from .state import device_state
+from .trees import DEVICES, ORG
+from .versions import version_counter
+
+# 自动发现新设备，参数: gateway(网关路由信息), devices([(设备主键, 设备地址)])
+device_discovered = Signal()
+
+
+@receiver(post_save, sender=Topic)
+def topic_saved(sender, instance, **kwargs):
+    gateway_registry.refresh_gateway(instance)
+    gateway_heartbeats.set_online(instance.id, instance.online_status)
+    version_counter.bump(DEVICES)
+
+
+@receiver(post_delete, sender=Topic)
+def topic_deleted(sender, instance, **kwargs):
+    gateway_registry.remove_gateway(instance)
+    version_counter.bump(DEVICES)
+
+
+@receiver(post_save, sender=GatewayCodec)
+def codec_saved(sender, instance, **kwargs):
+    gateway_registry.refresh_codec(instance)
+
+
+@receiver(post_delete, sender=GatewayCodec)
+def codec_deleted(sender, instance, **kwargs):
+    gateway_registry.remove_codec(instance)
+
+
+@receiver(post_save, sender=Device)
+def device_saved(sender, instance, **kwargs):
+    gateway_registry.refresh_device(instance)
+    device_state.refresh(instance)
+    state_broadcaster.forget(instance.pk)
+    # 接口修改设备后以数据库为准
+    live_store.remove(instance.pk)
+    version_counter.bump(DEVICES)
+
+
+@receiver(post_delete, sender=Device)
+def device_deleted(sender, instance, **kwargs):
+    gateway_registry.remove_device(instance)
+    device_state.remove(instance.pk)
+    history_writer.forget(instance.pk)
+    running_time_tracker.forget(instance.pk)
+    state_broadcaster.forget(instance.pk)
+    live_store.remove(instance.pk)
+    version_counter.bump(DEVICES)
+
+
+@receiver(device_discovered)
+def devices_discovered(sender, gateway, devices, **kwargs):
+    gateway_registry.add_devices(gateway.uuid, devices)
+    device_state.add([pk for pk, _ in devices])
+    version_counter.bump(DEVICES)
+
+
+@receiver(post_save, sender=Building)
+@receiver(post_delete, sender=Building)
+@receiver(post_save, sender=Floor)
+@receiver(post_delete, sender=Floor)
+@receiver(post_save, sender=Company)
+@receiver(post_delete, sender=Company)
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+def organization_changed(sender, **kwargs):
+    # 树中的建筑、楼层、公司、部门已变化
+    version_counter.bump(ORG)
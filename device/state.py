@@ -0,0 +1,147 @@
+import logging
+import threading
+
+from django.conf import settings
+
+from .models import Device
+from .versions import SharedVersion
+
+logger = logging.getLogger(__name__)
+
+# 参与变化检测的设备状态字段
+STATE_FIELDS = ('current_temp', 'set_temp', 'status', 'mode', 'fan_speed', 'online_status')
+
+# 新建设备的状态
+DEFAULT_STATE = {field: Device._meta.get_field(field).get_default() for field in STATE_FIELDS}
+
+_FIELD_TYPES = {
+    'current_temp': float,
+    'set_temp': float,
+    'fan_speed': int,
+    'online_status': bool,
+}
+
+
+class DeviceStateTable:
+    """
+    设备最新状态表，按设备主键保存最近一次写入数据库的状态
+    上报数据先与之比较，只把真正变化的字段交给写库；当前温度变化小于死区时视为未变化。
+    接口保存设备或批量修改状态后增加共享版本号，接入进程在下一次比较前重新加载
+    """
+
+    def __init__(self, temp_deadband=None):
+        self.temp_deadband = settings.MQTT_TEMP_DEADBAND if temp_deadband is None else temp_deadband
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._states = {}  # 设备主键 -> {字段: 值}
+        self._last_seen = {}  # 设备主键 -> 最近一次上报时间
+        self.version = SharedVersion('device_state')
+
+        self.changed_fields = 0
+        self.suppressed_fields = 0
+
+    def load(self):
+        """从数据库加载所有设备的当前状态"""
+        version = self.version.current()
+        states = {row.pop('id'): row for row in Device.objects.values('id', *STATE_FIELDS)}
+        with self._lock:
+            self._states = states
+            self._loaded = True
+            self.version.synced(version)
+        logger.info(f"Device state table loaded: {len(self._states)} devices")
+
+    def ensure_loaded(self):
+        if self._loaded:
+            # 其他进程修改过数据库中的状态
+            if self.version.stale():
+                self.load()
+            return
+        with self._lock:
+            if not self._loaded:
+                self.load()
+
+    def diff(self, pk, fields):
+        """返回与当前状态相比发生变化的字段"""
+        self.ensure_loaded()
+        state = self._states.get(pk, {})
+        changes = {}
+        for field, value in fields.items():
+            value = _normalize(field, value)
+            old = state.get(field)
+            if old is not None and old == value:
+                self.suppressed_fields += 1
+                continue
+            if (field == 'current_temp' and isinstance(value, float) and old is not None
+                    and abs(value - old) < self.temp_deadband):
+                self.suppressed_fields += 1
+                continue
+            changes[field] = value
+        self.changed_fields += len(changes)
+        return changes
+
+    def add(self, pks):
+        """自动发现的设备按字段默认值(即刚创建时数据库中的值)登记，保证状态完整"""
+        with self._lock:
+            for pk in pks:
+                self._states.setdefault(pk, dict(DEFAULT_STATE))
+
+    def apply(self, pk, changes):
+        """写库成功后更新状态"""
+        with self._lock:
+            self._states.setdefault(pk, {}).update(changes)
+
+    def refresh(self, device):
+        """设备通过接口或后台修改后同步状态"""
+        with self._lock:
+            self._states[device.pk] = {field: getattr(device, field) for field in STATE_FIELDS}
+        self.version.bump()
+
+    def updated(self, pks, fields):
+        """数据库中的状态被批量修改(queryset.update)后调用"""
+        with self._lock:
+            for pk in pks:
+                state = self._states.get(pk)
+                if state is not None:
+                    state.update(fields)
+        self.version.bump()
+
+    def remove(self, pk):
+        with self._lock:
+            self._states.pop(pk, None)
+            self._last_seen.pop(pk, None)
+        self.version.bump()
+
+    def get(self, pk):
+        """获取设备当前状态"""
+        self.ensure_loaded()
+        return self._states.get(pk)
+
+    def touch(self, pk, seen_at):
+        """记录设备最近一次上报时间"""
+        self._last_seen[pk] = seen_at
+
+    def last_seen(self, pk):
+        return self._last_seen.get(pk)
+
+    def stats(self):
+        return {
+            'devices': len(self._states),
+            'changed_fields': self.changed_fields,
+            'suppressed_fields': self.suppressed_fields,
+            'temp_deadband': self.temp_deadband,
+        }
+
+
+def _normalize(field, value):
+    """统一上报值的类型，便于与数据库中的值比较"""
+    cast = _FIELD_TYPES.get(field)
+    if cast is None or value is None:
+        return value
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return value
+
+
+# 全局设备状态表实例
+device_state = DeviceStateTable()
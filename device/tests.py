@@ -1,3 +1,783 @@
-from django.test import TestCase
+import os
+import threading
+import time
+from datetime import timedelta
+from importlib import import_module
+from multiprocessing import shared_memory
+from unittest import mock
 
-# Create your tests here.
+import paho.mqtt.client as mqtt
+from django.apps import apps
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from .broadcast import StateBroadcaster, group_name, state_broadcaster
+from .codec import compile_codec
+from .commands import CommandTracker, parse_wait
+from .control import check_stale_jobs
+from .history import history_writer
+from .ingest import GatewayHeartbeats, IngestPipeline
+from .live import LocalLiveStore, live_store
+from .metrics import IngestMetrics
+from .models import Building, Company, ControlJob, Department, Device, DeviceStatus, DeviceStatusRollup, Floor, Topic
+from .mqtt_client import MQTTClient
+from .mqtt_local import LocalBroker
+from .outbound import OutboundQueues, SharedTokenBucket
+from .pagination import keyset_page
+from .poller import GATEWAY_QUERY_ADDR, poll_gateway
+from .registry import GatewayRegistry
+from .rollups import rollup_device_status
+from .runtime import RunningTimeTracker, running_time_tracker
+from .sharding import ShardCoordinator, rendezvous_owner
+from .shm import SharedMemoryLiveStore
+from .state import DeviceStateTable, device_state
+from .trees import TreeCache, build_building_tree, build_company_tree, build_device_tree, build_gateway_tree
+from .versions import version_counter
+from .views import DeviceViewSet
+
+
+class GatewayRegistryTests(TestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(uuid='gw1', subscribe_topic='up/1', publish_topic='down/1')
+        Device.objects.create(uuid=self.topic, device_id='1', name='d1', room_id=0)
+        self.registry = GatewayRegistry()
+        self.registry.version.interval = 0
+
+    def test_reload_after_change_in_other_process(self):
+        """其他进程修改后增加版本号，本进程查询时重新加载"""
+        self.assertEqual(self.registry.get_gateway('gw1').publish_topic, 'down/1')
+        # 不经过本进程的signals修改，模拟Web进程中的修改
+        Topic.objects.filter(id=self.topic.id).update(publish_topic='down/2')
+        self.assertEqual(self.registry.get_gateway('gw1').publish_topic, 'down/1')
+        version_counter.bump('registry')
+        self.assertEqual(self.registry.get_gateway('gw1').publish_topic, 'down/2')
+
+    def test_own_change_does_not_reload(self):
+        """本进程的修改已增量更新，不重新加载"""
+        self.registry.ensure_loaded()
+        self.topic.publish_topic = 'down/3'
+        self.registry.refresh_gateway(self.topic)
+        Topic.objects.filter(id=self.topic.id).update(publish_topic='down/4')
+        self.assertEqual(self.registry.get_gateway('gw1').publish_topic, 'down/3')
+
+    def test_device_lookup(self):
+        pk = Device.objects.get(device_id='1').pk
+        self.assertEqual(self.registry.get_device_pk('gw1', '1'), pk)
+        self.assertEqual(self.registry.get_device_key(pk), ('gw1', '1'))
+        self.assertEqual(self.registry.get_device_ids('gw1'), {'1'})
+
+
+class GatewayCodecMigrationTests(TestCase):
+    def test_example_0_keeps_inverted_onoff(self):
+        """原send_command中example_0的开关编码相反，迁移后绑定相反的协议"""
+        migration = import_module('device.migrations.0003_gateway_codec')
+        inverted = Topic.objects.create(uuid='example_0', subscribe_topic='up/0', publish_topic='down/0')
+        normal = Topic.objects.create(uuid='gw1', subscribe_topic='up/1', publish_topic='down/1')
+        migration.create_default_codec(apps, None)
+        inverted.refresh_from_db()
+        normal.refresh_from_db()
+        codec = compile_codec(inverted.codec)
+        self.assertEqual((codec.encode('onOff', 'running'), codec.encode('onOff', 'stopped')), (0, 1))
+        self.assertEqual(codec.decode({'o': 0}), {'status': 'running'})
+        codec = compile_codec(normal.codec)
+        self.assertEqual((codec.encode('onOff', 'running'), codec.encode('onOff', 'stopped')), (1, 0))
+
+
+class DeviceStateTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_id='1', name='d1', room_id=0, online_status=True)
+        self.state = DeviceStateTable(temp_deadband=0.2)
+        self.state.version.interval = 0
+
+    def test_batch_update_is_not_suppressed(self):
+        """定时任务批量置为离线后，设备再次上报在线要写库"""
+        self.assertEqual(self.state.diff(self.device.pk, {'online_status': True}), {})
+        Device.objects.filter(id=self.device.pk).update(online_status=False)
+        self.state.updated([self.device.pk], {'online_status': False})
+        self.assertEqual(self.state.diff(self.device.pk, {'online_status': True}), {'online_status': True})
+
+    def test_reload_after_change_in_other_process(self):
+        self.state.ensure_loaded()
+        Device.objects.filter(id=self.device.pk).update(online_status=False)
+        version_counter.bump('device_state')
+        self.assertEqual(self.state.diff(self.device.pk, {'online_status': True}), {'online_status': True})
+
+    def test_temp_deadband(self):
+        self.assertEqual(self.state.diff(self.device.pk, {'current_temp': 25.1}), {})
+        self.assertEqual(self.state.diff(self.device.pk, {'current_temp': '26'}), {'current_temp': 26.0})
+
+
+class IngestPipelineTests(TestCase):
+    def test_flush_seen_keeps_each_device_time(self):
+        """未变化设备的last_updated使用各自的上报时间"""
+        first = Device.objects.create(device_id='1', name='d1', room_id=0)
+        second = Device.objects.create(device_id='2', name='d2', room_id=0)
+        pipeline = IngestPipeline(seen_interval=60, workers=1)
+        now = timezone.now()
+        pipeline._seen = {first.pk: now - timedelta(minutes=5), second.pk: now}
+        pipeline.flush_seen()
+        self.assertEqual(Device.objects.get(id=first.pk).last_updated, now - timedelta(minutes=5))
+        self.assertEqual(Device.objects.get(id=second.pk).last_updated, now)
+
+    def test_reports_coalesce_into_one_write(self):
+        """同一批中同一设备的多次上报合并为一次写入，字段相同的设备共用一条bulk_update"""
+        topic = Topic.objects.create(uuid='gw1', subscribe_topic='up/1', publish_topic='down/1')
+        first = Device.objects.create(uuid=topic, device_id='1', name='d1', room_id=0)
+        second = Device.objects.create(uuid=topic, device_id='2', name='d2', room_id=0)
+        device_state.ensure_loaded()
+        pipeline = IngestPipeline(seen_interval=60, workers=2)
+        pipeline.submit('gw1', '1', {'current_temp': 21.0, 'status': 'running'})
+        pipeline.submit('gw1', '1', {'current_temp': 22.0})
+        pipeline.submit('gw1', '1', {'current_temp': 23.0})
+        pipeline.submit('gw1', '2', {'current_temp': 24.0, 'status': 'running'})
+        # 同一网关的上报进入同一个队列，保持顺序
+        self.assertEqual(sorted(q.qsize() for q in pipeline.queues), [0, 4])
+        with mock.patch.object(Device.objects, 'bulk_update', wraps=Device.objects.bulk_update) as bulk_update:
+            pipeline.drain()
+        self.assertEqual(bulk_update.call_count, 1)
+        self.assertEqual(len(bulk_update.call_args.args[0]), 2)
+        first.refresh_from_db()
+        self.assertEqual((first.current_temp, first.status), (23.0, 'running'))
+        self.assertEqual(Device.objects.get(id=second.pk).current_temp, 24.0)
+
+    def test_partial_state_does_not_abort_batch(self):
+        """状态表中只有部分字段的设备不影响同一批其他设备的后续步骤"""
+        topic = Topic.objects.create(uuid='gw1', subscribe_topic='up/1', publish_topic='down/1')
+        partial = Device.objects.create(uuid=topic, device_id='1', name='d1', room_id=0)
+        other = Device.objects.create(uuid=topic, device_id='2', name='d2', room_id=0)
+        device_state.ensure_loaded()
+        device_state.remove(partial.pk)
+        device_state.apply(partial.pk, {'current_temp': 20.0})
+        pipeline = IngestPipeline(seen_interval=60, workers=1)
+        skipped = history_writer.incomplete
+        with mock.patch.object(state_broadcaster, 'record', side_effect=[RuntimeError('boom'), None]):
+            pipeline.write({('gw1', '1'): {'current_temp': 30.0}, ('gw1', '2'): {'current_temp': 31.0}})
+        self.assertEqual(Device.objects.get(id=partial.pk).current_temp, 30.0)
+        self.assertEqual(Device.objects.get(id=other.pk).current_temp, 31.0)
+        self.assertEqual(device_state.get(other.pk)['current_temp'], 31.0)
+        self.assertEqual(live_store.get(other.pk)['current_temp'], 31.0)
+        self.assertEqual(history_writer.incomplete, skipped + 1)
+        self.assertEqual(pipeline.hook_errors, 1)
+
+
+class StateBroadcasterTests(TestCase):
+    def test_groups_follow_device_version(self):
+        """其他进程修改设备所属范围并增加版本号后，推送分组重新加载"""
+        first = Building.objects.create(name='b1', code='b1')
+        second = Building.objects.create(name='b2', code='b2')
+        device = Device.objects.create(device_id='1', name='d1', room_id=0, building=first)
+        broadcaster = StateBroadcaster(interval=1)
+        self.assertIn(group_name('building', first.pk), broadcaster._resolve({device.pk: {}})[device.pk])
+        # update()不触发signals，相当于其他进程的修改
+        Device.objects.filter(pk=device.pk).update(building=second)
+        self.assertIn(group_name('building', first.pk), broadcaster._resolve({device.pk: {}})[device.pk])
+        version_counter.bump('devices')
+        groups = broadcaster._resolve({device.pk: {}})[device.pk]
+        self.assertIn(group_name('building', second.pk), groups)
+        self.assertNotIn(group_name('building', first.pk), groups)
+
+
+class CommandWatchTests(TestCase):
+    def test_unsubscribe_after_commands_finish(self):
+        """只发布模式下为确认命令订阅的主题在命令全部结束后取消订阅"""
+        client = MQTTClient(client=mock.Mock())
+        client.publish_only = client.started = True
+        client.outbound = mock.Mock()
+        gateway = mock.Mock(uuid='gw1', subscribe_topic='up/1')
+        tracker = CommandTracker(timeout=60)
+        with mock.patch('device.mqtt_client.command_tracker', tracker):
+            first = client.send_command(gateway, 'control_write', ['1'])
+            second = client.send_command(gateway, 'control_write', ['2'])
+        client.client.subscribe.assert_called_once_with('up/1', 0)
+        tracker.release(first, ['1'])
+        client.client.unsubscribe.assert_not_called()
+        second.fail()
+        client.client.unsubscribe.assert_called_once_with('up/1')
+        self.assertEqual(client.stats()['watched'], 0)
+
+
+class OutboundQueueTests(TestCase):
+    def setUp(self):
+        self.queues = OutboundQueues(mock.Mock(), rate=1, burst=1, max_addrs=10, max_bytes=1024)
+        # 不启动发送线程，只检查队列内容
+        self.queues._thread = mock.Mock(is_alive=lambda: True)
+        self.gateway = mock.Mock(uuid='gw1', publish_topic='down/1')
+        self.tracker = CommandTracker(timeout=60)
+
+    def enqueue(self, addrs, params):
+        command = self.tracker.register('gw1', self.tracker.next_sn(), 'control_write', addrs)
+        self.queues.enqueue(self.gateway, 'control_write', addrs, params, command)
+        return command
+
+    def queued(self):
+        return [(entry.params, entry.addrs) for entry in self.queues._queues['gw1']]
+
+    def test_merge_same_params(self):
+        first = self.enqueue(['1'], {'onOff': 1})
+        second = self.enqueue(['2'], {'onOff': 1})
+        self.assertEqual(self.queued(), [({'onOff': 1}, ['1', '2'])])
+        self.assertEqual(self.queues._queues['gw1'][0].commands, [first, second])
+
+    def test_split_by_max_addrs(self):
+        self.queues.max_addrs = 2
+        self.enqueue(['1', '2', '3'], {'onOff': 1})
+        self.assertEqual(self.queued(), [({'onOff': 1}, ['1', '2']), ({'onOff': 1}, ['3'])])
+
+    def test_fully_superseded_addrs_are_released(self):
+        old = self.enqueue(['1', '2'], {'tempSet': 24})
+        self.enqueue(['1'], {'tempSet': 26})
+        self.assertEqual(self.queued(), [({'tempSet': 24}, ['2']), ({'tempSet': 26}, ['1'])])
+        self.assertEqual(old.waiting, {'2'})
+
+    def test_partially_superseded_addrs_keep_waiting(self):
+        """旧命令还有未被覆盖的属性要下发时，继续等待这些设备确认"""
+        old = self.enqueue(['1', '2'], {'onOff': 1, 'tempSet': 24})
+        self.enqueue(['1'], {'tempSet': 26})
+        self.assertEqual(self.queued(), [
+            ({'onOff': 1, 'tempSet': 24}, ['2']), ({'onOff': 1}, ['1']), ({'tempSet': 26}, ['1']),
+        ])
+        self.assertEqual(old.waiting, {'1', '2'})
+
+    def test_publish_error_fails_commands(self):
+        """paho返回错误码(未连接、缓冲区满)时命令直接失败，不等待超时"""
+        command = self.enqueue(['1'], {'onOff': 1})
+        info = mqtt.MQTTMessageInfo(0)
+        info.rc = mqtt.MQTT_ERR_NO_CONN
+        self.queues.publish.return_value = info
+        topic, entry = self.queues._pop('gw1')
+        self.queues._send('gw1', topic, entry)
+        self.assertTrue(command.failed)
+        self.assertEqual(self.queues.failed, 1)
+
+    def test_shared_bucket_falls_back_with_backoff(self):
+        """Redis不可用时使用进程内令牌桶，退避期间不再访问Redis"""
+        script = mock.Mock(side_effect=ConnectionError('redis down'))
+        bucket = SharedTokenBucket(script, 'bucket', rate=1, burst=1)
+        now = time.monotonic()
+        self.assertTrue(bucket.take(now))
+        self.assertFalse(bucket.take(now + 0.1))
+        self.assertAlmostEqual(bucket.wait_time(now + 0.1), 0.9)
+        self.assertEqual(script.call_count, 1)
+        # 退避结束后重新使用Redis
+        script.side_effect = None
+        script.return_value = [1, '0.5']
+        self.assertTrue(bucket.take(now + 1.5))
+        self.assertEqual(script.call_count, 2)
+        self.assertAlmostEqual(bucket.wait_time(now + 1.5), 0.5)
+
+
+class PollGatewayTests(TestCase):
+    def test_gateway_without_known_devices(self):
+        """没有已知设备的网关按网关整体查询"""
+        client = mock.Mock()
+        gateway = mock.Mock(uuid='gw-unknown')
+        with mock.patch('device.poller.gateway_registry') as registry:
+            registry.get_device_ids.return_value = set()
+            poll_gateway(client, gateway)
+            registry.get_device_ids.return_value = {'2', '1'}
+            poll_gateway(client, gateway)
+        self.assertEqual([call.args[2] for call in client.send_untracked.call_args_list],
+                         [[GATEWAY_QUERY_ADDR], ['1', '2']])
+        client.send_command.assert_not_called()
+
+    def test_poll_is_not_tracked(self):
+        """轮询不登记待确认命令，只发布模式下也不订阅网关主题"""
+        client = MQTTClient(client=mock.Mock())
+        client.publish_only = client.started = True
+        client.outbound = mock.Mock()
+        gateway = mock.Mock(uuid='gw1', subscribe_topic='up/1')
+        tracker = CommandTracker(timeout=60)
+        with mock.patch('device.mqtt_client.command_tracker', tracker), \
+                mock.patch('device.poller.gateway_registry') as registry:
+            registry.get_device_ids.return_value = {'1'}
+            self.assertTrue(poll_gateway(client, gateway))
+        client.outbound.enqueue.assert_called_once_with(gateway, 'status_read', ['1'], {'cmd': 'addrs'})
+        self.assertFalse(tracker.has_pending('gw1'))
+        client.client.subscribe.assert_not_called()
+
+
+class LiveDeviceReadTests(TestCase):
+    def setUp(self):
+        topic = Topic.objects.create(uuid='gw1', subscribe_topic='up/1', publish_topic='down/1')
+        building = Building.objects.create(name='b1', code='b1')
+        self.devices = [
+            Device.objects.create(uuid=topic, building=building, device_id=str(i), name=f'd{i}', room_id=0,
+                                  current_temp=20.0)
+            for i in range(3)
+        ]
+        self.store = LocalLiveStore()
+        patcher = mock.patch('device.live.live_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.list = DeviceViewSet.as_view({'get': 'list'})
+
+    def get_list(self):
+        return self.list(APIRequestFactory().get('/api/devices/'))
+
+    def test_hot_fields_come_from_store(self):
+        self.store.write({device.pk: dict(current_temp=30.0, **{field: getattr(device, field) for field in
+                                          ('set_temp', 'status', 'mode', 'fan_speed', 'online_status',
+                                           'last_updated')})
+                          for device in self.devices})
+        # 只有一条带关联对象的设备查询，不逐行查库
+        with self.assertNumQueries(1):
+            response = self.get_list()
+        self.assertEqual([row['current_temp'] for row in response.data], [30.0] * 3)
+        self.assertEqual(response.data[0]['building_name'], 'b1')
+
+    def test_devices_missing_from_store_load_in_one_query(self):
+        self.store.write({self.devices[0].pk: {'current_temp': 30.0}})
+        with self.assertNumQueries(2):
+            response = self.get_list()
+        self.assertEqual(sorted(row['current_temp'] for row in response.data), [20.0, 20.0, 30.0])
+
+    def test_status_running_time_published_by_ingest(self):
+        """Web进程不累计运行时间，从接入进程发布的累计状态计算当前运行时间"""
+        device = self.devices[0]
+        Device.objects.filter(pk=device.pk).update(status='running')
+        tracker = RunningTimeTracker(flush_interval=60)
+        now = timezone.now()
+        with mock.patch('device.runtime.live_store', self.store), \
+                mock.patch('device.runtime.timezone.now') as clock:
+            clock.return_value = now - timedelta(hours=2)
+            tracker.ensure_loaded()
+            # 写库一小时后，已写库的部分不再计入发布的累计值
+            clock.return_value = now - timedelta(hours=1)
+            tracker.flush()
+        device.refresh_from_db()
+        self.assertAlmostEqual(device.running_time, 1.0)
+        status = DeviceViewSet.as_view({'get': 'status'})
+        response = status(APIRequestFactory().get(f'/api/devices/{device.pk}/status/'), pk=device.pk)
+        self.assertAlmostEqual(response.data['running_time'], 2.0, places=2)
+
+
+class SharedMemoryLiveStoreTests(TestCase):
+    def setUp(self):
+        self.name = f"bell_test_{os.getpid()}"
+        self.stores = []
+        self.addCleanup(self.cleanup)
+
+    def store(self):
+        store = SharedMemoryLiveStore(self.name, 16)
+        self.stores.append(store)
+        return store
+
+    def cleanup(self):
+        for store in self.stores:
+            store.close()
+        try:
+            shared_memory.SharedMemory(name=self.name).unlink()
+        except FileNotFoundError:
+            pass
+
+    def test_reader_sees_writes(self):
+        writer, reader = self.store(), self.store()
+        writer.attach_writer()
+        writer.write({7: {'current_temp': 25.5, 'status': 'running', 'online_status': True}})
+        self.assertEqual(reader.get(7), {'current_temp': 25.5, 'status': 'running', 'online_status': True})
+        self.assertEqual(writer._seq % 2, 0)
+
+    def test_reader_skips_torn_write(self):
+        """序号为奇数(写入中)时读取方放弃读取"""
+        writer, reader = self.store(), self.store()
+        writer.attach_writer()
+        writer.write({7: {'current_temp': 25.5}})
+        writer._header[3] += 1
+        self.assertEqual(reader.read([7]), {})
+        self.assertGreater(reader.retries, 0)
+
+    def test_new_writer_resets_odd_seq(self):
+        """写入进程在写入中途退出后，新的写入进程把序号恢复为偶数"""
+        writer, reader = self.store(), self.store()
+        writer.attach_writer()
+        writer.write({7: {'current_temp': 25.5}})
+        writer._header[3] += 1
+        writer.close()
+        successor = self.store()
+        successor.attach_writer()
+        self.assertEqual(successor._seq % 2, 0)
+        self.assertEqual(reader.get(7), {'current_temp': 25.5})
+
+    def test_single_writer(self):
+        first, second = self.store(), self.store()
+        first.attach_writer()
+        second.attach_writer()
+        self.assertTrue(first._writer)
+        self.assertFalse(second._writer)
+
+    def test_non_writer_changes_are_visible(self):
+        """Web进程删除设备、调度进程标记离线时直接修改共享内存，读取方不再看到旧值"""
+        writer, other, reader = self.store(), self.store(), self.store()
+        writer.attach_writer()
+        writer.write({7: {'current_temp': 25.5, 'online_status': True}, 8: {'current_temp': 20.0}})
+        other.write({7: {'online_status': False}})
+        self.assertEqual(reader.get(7), {'current_temp': 25.5, 'online_status': False})
+        other.remove(8)
+        self.assertIsNone(reader.get(8))
+        # 其他进程分配的行，写入进程之后继续使用同一行
+        other.write({9: {'current_temp': 18.0}})
+        writer.write({9: {'current_temp': 19.0}})
+        self.assertEqual(reader.get(9), {'current_temp': 19.0})
+        self.assertEqual(writer._used, 3)
+        self.assertEqual(writer._seq % 2, 0)
+
+
+class TreeCacheTests(TestCase):
+    def setUp(self):
+        building = Building.objects.create(name='b1', code='b1')
+        self.device = Device.objects.create(building=building, device_id='1', name='d1', room_id=101,
+                                            current_temp=20.0)
+        self.store = LocalLiveStore()
+        patcher = mock.patch('device.live.live_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = TreeCache(ttl=60)
+
+    def get(self):
+        return self.cache.get('device', build_device_tree, live=True)
+
+    def test_live_fields_do_not_rebuild(self):
+        """设备状态变化只覆盖缓存的结构，不重新构建"""
+        first = self.get()
+        self.assertIn(b'"current_temp": 20.0', first.body)
+        etag = first.etag
+        self.store.write({self.device.pk: {'current_temp': 26.5}})
+        with self.assertNumQueries(0):
+            second = self.get()
+        self.assertEqual(self.cache.builds, 1)
+        self.assertIn(b'"current_temp": 26.5', second.body)
+        self.assertNotEqual(second.etag, etag)
+
+    def test_version_change_rebuilds(self):
+        self.get()
+        version_counter.bump('devices')
+        self.get()
+        self.assertEqual(self.cache.builds, 2)
+
+    def test_ttl_only_without_shared_versions(self):
+        self.cache.ttl = 0
+        with mock.patch.object(type(version_counter), 'shared', new_callable=mock.PropertyMock) as shared:
+            shared.return_value = True
+            self.get()
+            self.get()
+            self.assertEqual(self.cache.builds, 1)
+            shared.return_value = False
+            self.get()
+            self.assertEqual(self.cache.builds, 2)
+
+
+class DeviceTreeTests(TestCase):
+    def setUp(self):
+        self.building = Building.objects.create(name='b1', code='b1')
+        for room in (302, 101, 205):
+            Device.objects.create(building=self.building, device_id=str(room), name=f'd{room}', room_id=room)
+        self.view = DeviceViewSet.as_view({'get': 'tree'})
+
+    def test_rooms_are_ordered(self):
+        tree, nodes = build_device_tree(depth=3)
+        self.assertEqual(nodes, {})
+        rooms = [room['name'] for room in tree[0]['children'][0]['children']]
+        self.assertEqual(rooms, ['房间101', '房间205', '房间302'])
+
+    def test_unknown_building(self):
+        response = self.view(APIRequestFactory().get('/api/devices/tree/', {'building_id': self.building.pk + 1}))
+        self.assertEqual(response.status_code, 404)
+        response = self.view(APIRequestFactory().get('/api/devices/tree/', {'building_id': self.building.pk}))
+        self.assertEqual(response.status_code, 200)
+
+
+class TreeBuilderTests(TestCase):
+    def test_building_tree(self):
+        for i in range(2):
+            building = Building.objects.create(name=f'b{i}', code=f'b{i}')
+            for number in (3, 1, 2):
+                Floor.objects.create(building=building, name=f'{number}F', floor_number=number)
+        with self.assertNumQueries(2):
+            tree = build_building_tree()
+        self.assertEqual([node['label'] for node in tree], ['b0', 'b1'])
+        self.assertEqual([floor['floor_number'] for floor in tree[0]['children']], [1, 2, 3])
+
+    def test_company_tree(self):
+        for i in range(2):
+            company = Company.objects.create(name=f'c{i}', code=f'c{i}')
+            Department.objects.create(company=company, name='d', code=f'd{i}')
+        with self.assertNumQueries(2):
+            tree = build_company_tree()
+        self.assertEqual([len(node['children']) for node in tree], [1, 1])
+
+    def test_gateway_tree(self):
+        for uuid in ('gw1', 'gw2'):
+            topic = Topic.objects.create(uuid=uuid, subscribe_topic=f'up/{uuid}', publish_topic=f'down/{uuid}')
+            for device_id in ('1', '2'):
+                Device.objects.create(uuid=topic, device_id=device_id, name='', room_id=0)
+        Device.objects.create(device_id='9', name='unbound', room_id=0)
+        with self.assertNumQueries(1):
+            tree, nodes = build_gateway_tree()
+        self.assertEqual([(node['id'], len(node['children'])) for node in tree], [('gw1', 2), ('gw2', 2)])
+        self.assertEqual(len(nodes), 4)
+        self.assertEqual(tree[0]['children'][0]['label'], '1')
+
+
+class GatewayHeartbeatTests(TestCase):
+    def test_beat_does_not_touch_database(self):
+        """心跳在MQTT网络线程中只记录内存，离线->在线由写库线程尽快写入"""
+        topic = Topic.objects.create(uuid='gw1', subscribe_topic='up/1', publish_topic='down/1')
+        heartbeats = GatewayHeartbeats(flush_interval=60)
+        now = timezone.now()
+        with self.assertNumQueries(0):
+            heartbeats.beat(topic, now)
+        self.assertTrue(heartbeats.due())
+        heartbeats.flush()
+        self.assertTrue(Topic.objects.get(id=topic.id).online_status)
+        # 已在线的网关按间隔批量写入
+        heartbeats.beat(topic, now + timedelta(seconds=30))
+        self.assertFalse(heartbeats.due())
+
+
+class ShardingTests(TestCase):
+    def test_rendezvous_moves_only_keys_of_new_member(self):
+        keys = [f'gw{i}' for i in range(200)]
+        before = {key: rendezvous_owner(key, ['a', 'b']) for key in keys}
+        after = {key: rendezvous_owner(key, ['a', 'b', 'c']) for key in keys}
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(after[key] == 'c' for key in moved))
+        self.assertIsNone(rendezvous_owner('gw1', []))
+
+    def test_member_changes_rebalance(self):
+        shard = ShardCoordinator(mock.Mock(), worker_id='a', members_topic='bell/members')
+        shard.on_rebalance = mock.Mock()
+        self.assertTrue(all(shard.owns(f'gw{i}') for i in range(20)))
+        shard.on_member_message(mock.Mock(topic='bell/members/b', payload=b'b'))
+        self.assertEqual(shard.members(), ['a', 'b'])
+        owned = [f'gw{i}' for i in range(20) if shard.owns(f'gw{i}')]
+        self.assertEqual(owned, [f'gw{i}' for i in range(20) if rendezvous_owner(f'gw{i}', ['a', 'b']) == 'a'])
+        # 其他进程下线后重新接管全部网关，自己的下线消息不影响成员列表
+        shard.on_member_message(mock.Mock(topic='bell/members/b', payload=b''))
+        shard.on_member_message(mock.Mock(topic='bell/members/a', payload=b''))
+        self.assertEqual(shard.members(), ['a'])
+        self.assertEqual(shard.on_rebalance.call_count, 2)
+        self.assertTrue(shard.owns('gw1'))
+
+
+class LocalBrokerShardingTests(TestCase):
+    """多个hash模式的接入客户端连接同一个进程内broker"""
+
+    def setUp(self):
+        self.uuids = [f'gw{i}' for i in range(20)]
+        for uuid in self.uuids:
+            Topic.objects.create(uuid=uuid, subscribe_topic=f'up/{uuid}', publish_topic=f'down/{uuid}')
+        self.broker = LocalBroker()
+        self.handled = []  # (worker_id, uuid, sn)
+        patcher = mock.patch.object(running_time_tracker, 'rebalance')
+        self.tracker_rebalance = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, worker_id):
+        with self.settings(MQTT_WORKER_ID=worker_id):
+            client = MQTTClient(client=self.broker.client(worker_id), consumer_mode='hash')
+        client.handle = lambda topic, message, gateway: self.handled.append(
+            (worker_id, gateway.uuid, message['sn']))
+        client.shard.set_will()
+        client.client.connect()
+        return client
+
+    @staticmethod
+    def wait_rebalanced():
+        for thread in threading.enumerate():
+            if thread.name == 'mqtt-rebalance':
+                thread.join(5)
+
+    def report(self, sn):
+        for uuid in self.uuids:
+            self.broker.publish(f'up/{uuid}', f'{{"uuid": "{uuid}", "cmd": "status_report", "sn": {sn}}}')
+
+    def test_gateways_split_and_taken_over(self):
+        a, b = self.connect('a'), self.connect('b')
+        self.wait_rebalanced()
+        self.assertEqual(a.shard.members(), ['a', 'b'])
+        self.assertEqual(b.shard.members(), ['a', 'b'])
+        # 两个进程的订阅不重叠且覆盖全部网关
+        self.assertFalse(a._subscribed & b._subscribed)
+        self.assertEqual(a._subscribed | b._subscribed, {f'up/{uuid}' for uuid in self.uuids})
+        self.assertTrue(a._subscribed and b._subscribed)
+
+        self.report(1)
+        owners = {uuid: worker_id for worker_id, uuid, _ in self.handled}
+        self.assertEqual(len(self.handled), len(self.uuids))
+        self.assertEqual(owners, {uuid: rendezvous_owner(uuid, ['a', 'b']) for uuid in self.uuids})
+
+        # b异常退出，broker发送遗嘱后a接管b的网关
+        b.client.crash()
+        self.wait_rebalanced()
+        self.assertEqual(a.shard.members(), ['a'])
+        self.assertEqual(a._subscribed, {f'up/{uuid}' for uuid in self.uuids})
+        self.assertTrue(self.tracker_rebalance.called)
+
+        self.report(2)
+        self.report(3)
+        for uuid in self.uuids:
+            sns = [sn for worker_id, handled_uuid, sn in self.handled if handled_uuid == uuid]
+            # 每个网关的上报只处理一次且保持顺序
+            self.assertEqual(sns, [1, 2, 3])
+        self.assertEqual({worker_id for worker_id, _, sn in self.handled if sn > 1}, {'a'})
+
+
+class IngestMetricsTests(TestCase):
+    def test_local_fallback(self):
+        """未配置Redis时返回本进程的指标和心跳"""
+        metrics = IngestMetrics(url=None, interval=10)
+        workers = metrics.read()
+        self.assertEqual(len(workers), 1)
+        self.assertIn('pipeline', next(iter(workers.values())))
+        self.assertEqual(metrics.last_seen('unknown'), {'unknown': None})
+
+
+
+class RunningTimeTrackerTests(TestCase):
+    def setUp(self):
+        self.gw1 = Topic.objects.create(uuid='gw1', subscribe_topic='up/1', publish_topic='down/1')
+        self.gw2 = Topic.objects.create(uuid='gw2', subscribe_topic='up/2', publish_topic='down/2')
+        self.d1 = Device.objects.create(uuid=self.gw1, device_id='1', name='d1', room_id=0, status='running')
+        self.d2 = Device.objects.create(uuid=self.gw2, device_id='1', name='d2', room_id=0, status='running')
+        self.tracker = RunningTimeTracker(flush_interval=60)
+
+    def test_only_tracks_owned_gateways(self):
+        """hash模式下只累计本进程负责的网关下的设备"""
+        owned = {'gw1'}
+        self.tracker.owns = lambda uuid: uuid in owned
+        self.tracker.ensure_loaded()
+        self.assertEqual(set(self.tracker._since), {self.d1.pk})
+        self.tracker._since[self.d1.pk] = timezone.now() - timedelta(minutes=1)
+
+        owned = {'gw2'}
+        self.tracker.rebalance()
+        self.assertEqual(set(self.tracker._since), {self.d2.pk})
+        # 移交的设备已累计的时间仍会写库
+        self.assertGreaterEqual(self.tracker._pending[self.d1.pk], 60)
+
+    def test_tracks_all_without_sharding(self):
+        self.tracker.ensure_loaded()
+        self.assertEqual(set(self.tracker._since), {self.d1.pk, self.d2.pk})
+
+
+def _add_history(device, start):
+    """从start开始每10分钟一条记录，运行、停止交替"""
+    DeviceStatus.objects.bulk_create([
+        DeviceStatus(device=device, timestamp=start + timedelta(minutes=10 * i), current_temp=20.0 + i,
+                     set_temp=24.0, status='running' if i % 2 == 0 else 'stopped', mode='cooling')
+        for i in range(6)
+    ])
+
+
+class BatchControlTests(TestCase):
+    def test_invalid_control_is_rejected(self):
+        batch_control = DeviceViewSet.as_view({'post': 'batch_control'})
+        request = APIRequestFactory().post('/api/devices/batch_control/',
+                                           {'device_ids': [1], 'control': {'temp': 'warm'}}, format='json')
+        response = batch_control(request)
+        self.assertEqual(response.status_code, 400)
+
+    def test_parse_wait(self):
+        self.assertEqual(parse_wait(None), 0)
+        self.assertEqual(parse_wait('500'), 0.5)
+        for value in ('soon', -1, [100], {'ms': 100}):
+            with self.assertRaises(ValueError):
+                parse_wait(value)
+
+    def test_stale_jobs_are_checked(self):
+        """下发任务的worker重启后，调度进程补做校验"""
+        topic = Topic.objects.create(uuid='gw1', subscribe_topic='up/1', publish_topic='down/1')
+        device = Device.objects.create(uuid=topic, device_id='1', name='d1', room_id=0, set_temp=26.0)
+        job = ControlJob.objects.create(control={'temp': 26}, total=1, results={str(device.pk): {'state': 'sent'}})
+        self.assertEqual(check_stale_jobs(), 0)
+        ControlJob.objects.filter(pk=job.pk).update(created_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(check_stale_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.results[str(device.pk)], {'state': 'confirmed'})
+
+
+class RollupTests(TestCase):
+    def test_rerun_does_not_double_count(self):
+        device = Device.objects.create(device_id='1', name='d1', room_id=0)
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=3)
+        _add_history(device, start)
+        now = start + timedelta(hours=2)
+        self.assertEqual(rollup_device_status(now), 6)
+        self.assertEqual(rollup_device_status(now), 0)
+        hour = DeviceStatusRollup.objects.get(device=device, period='hour', bucket=start)
+        self.assertEqual(hour.samples, 6)
+        self.assertEqual(hour.seconds, 3600)
+        self.assertEqual(hour.status_seconds, {'running': 1800, 'stopped': 1800})
+
+class StatusHistoryTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_id='1', name='d1', room_id=0)
+        now = timezone.now()
+        # 两条记录时间相同，靠id区分先后
+        DeviceStatus.objects.bulk_create([
+            DeviceStatus(device=self.device, timestamp=now - timedelta(minutes=i // 2),
+                         current_temp=20.0 + i, set_temp=24.0, status='running', mode='cooling')
+            for i in range(5)
+        ])
+        self.view = DeviceViewSet.as_view({'get': 'status_history'})
+
+    def get(self, params=None):
+        request = APIRequestFactory().get('/api/devices/', params or {})
+        return self.view(request, pk=self.device.pk)
+
+    def test_keyset_pages_cover_all_rows_once(self):
+        history = DeviceStatus.objects.filter(device=self.device).values('id', 'timestamp')
+        seen, cursor = [], None
+        while True:
+            rows, cursor = keyset_page(history, 'timestamp', cursor, limit=2)
+            seen.extend(row['id'] for row in rows)
+            if cursor is None:
+                break
+        expected = list(DeviceStatus.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_without_params_keeps_list_response(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response.data, list)
+        self.assertEqual(len(response.data), 5)
+
+    def test_paginated_response(self):
+        response = self.get({'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 3)
+        response = self.get({'limit': 3, 'cursor': response.data['next']})
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.get({'cursor': 'bad'}).status_code, 400)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentRollupTests(TransactionTestCase):
+    def test_concurrent_runs_process_each_window_once(self):
+        """多个进程同时运行聚合任务时，同一窗口只合并一次"""
+        device = Device.objects.create(device_id='1', name='d1', room_id=0)
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=3)
+        _add_history(device, start)
+        now = start + timedelta(hours=2)
+
+        def run():
+            try:
+                rollup_device_status(now)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        hour = DeviceStatusRollup.objects.get(device=device, period='hour', bucket=start)
+        self.assertEqual(hour.samples, 6)
+        self.assertEqual(hour.seconds, 3600)
@@ -0,0 +1,276 @@
+"""
+树形结构构建与缓存
+设备树用一条values()查询取出所需字段后一次遍历组装，建筑、公司树用预取加Python排序，查询数与数据量无关；
+只缓存树的结构，按版本号失效：设备、网关或组织架构变化时增加版本号(见device/versions.py)，之后的请求重新构建。
+设备的运行状态、温度等实时字段不触发重建，每次返回前从实时状态存储一次读取并覆盖到设备节点上，
+有变化时才重新生成JSON和ETag。未配置REDIS_URL时版本号只在进程内计数，缓存最多保留DEVICE_TREE_CACHE_TTL秒
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from itertools import groupby
+
+from django.conf import settings
+from django.db.models import Prefetch, Q
+from django.http import HttpResponse, HttpResponseNotModified
+from rest_framework.utils.encoders import JSONEncoder
+
+from .live import overlay_rows
+from .models import Building, Company, Department, Device, Floor
+from .versions import version_counter
+
+logger = logging.getLogger(__name__)
+
+# 设备与网关的版本号
+DEVICES = 'devices'
+# 建筑、楼层等组织架构的版本号
+ORG = 'org'
+
+# 设备树的层级：建筑、楼层、房间、设备
+DEVICE_TREE_DEPTH = 4
+
+
+class CachedTree:
+    """
+    缓存的树，live_nodes为其中的设备节点{设备主键: 节点}
+    body为JSON，etag按内容计算，各进程构建出相同内容时ETag相同
+    """
+
+    __slots__ = ('data', 'live_nodes', 'body', 'etag', 'version', 'built_at', '_lock')
+
+    def __init__(self, data, version, live_nodes=None):
+        self.data = data
+        self.live_nodes = live_nodes or {}
+        self.version = version
+        self.built_at = time.monotonic()
+        self.body = None
+        self.etag = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """用实时状态覆盖设备节点，有变化时重新生成JSON"""
+        with self._lock:
+            changed = overlay_rows(self.live_nodes) if self.live_nodes else 0
+            if changed or self.body is None:
+                self.body = json.dumps(self.data, cls=JSONEncoder, ensure_ascii=False).encode()
+                self.etag = f'"{hashlib.md5(self.body).hexdigest()}"'
+        return self
+
+
+class TreeCache:
+    """按名称缓存树的结构，依赖的版本号变化后重新构建；版本号不共享时另外最多保留ttl秒"""
+
+    def __init__(self, ttl=None):
+        self.ttl = settings.DEVICE_TREE_CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._trees = {}  # 名称 -> CachedTree
+
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, name, build, depends=(DEVICES,), live=False):
+        """
+        :param build: 构建函数，live为True时返回(树, 设备节点)
+        :param live: 树中包含设备节点，返回前覆盖实时状态
+        """
+        version = version_counter.current(*depends)
+        cached = self._trees.get(name)
+        if cached is not None and cached.version == version and not self._expired(cached):
+            self.hits += 1
+            return cached.refresh()
+        data, live_nodes = build() if live else (build(), None)
+        cached = CachedTree(data, version, live_nodes)
+        with self._lock:
+            self._trees[name] = cached
+            self.builds += 1
+        return cached.refresh()
+
+    def _expired(self, cached):
+        # 共享版本号能同步其他进程的修改，不需要按时间过期
+        return not version_counter.shared and time.monotonic() - cached.built_at >= self.ttl
+
+    def clear(self):
+        with self._lock:
+            self._trees = {}
+
+    def stats(self):
+        return {'trees': len(self._trees), 'hits': self.hits, 'builds': self.builds, 'ttl': self.ttl}
+
+
+def tree_response(request, cached):
+    """返回缓存的JSON，If-None-Match与ETag相同时返回304"""
+    if cached.etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(cached.body, content_type='application/json')
+    response['ETag'] = cached.etag
+    return response
+
+
+GATEWAY_DEVICE_VALUES = ('id', 'name', 'device_id', 'status', 'current_temp', 'set_temp', 'mode', 'fan_speed',
+                         'uuid_id', 'uuid__uuid', 'uuid__subscribe_topic', 'uuid__publish_topic')
+
+
+def build_gateway_tree():
+    """网关-设备树，一条查询按网关排序后分组，没有设备的网关不出现；返回(树, 设备节点)"""
+    rows = (Device.objects.filter(uuid__isnull=False)
+            .order_by('uuid_id', 'id')
+            .values_list(*GATEWAY_DEVICE_VALUES))
+    tree = []
+    device_nodes = {}
+    for _, devices in groupby(rows, key=lambda row: row[8]):
+        devices = list(devices)
+        uuid, subscribe, publish = devices[0][9:12]
+        children = []
+        for pk, name, device_id, status, current_temp, set_temp, mode, fan_speed, *_ in devices:
+            node = {
+                'id': str(pk),
+                'label': name or device_id,
+                'type': 'device',
+                'status': status,
+                'uuid': uuid,
+                'device_id': device_id,
+                'current_temp': current_temp,
+                'set_temp': set_temp,
+                'mode': mode,
+                'fan_speed': fan_speed,
+            }
+            children.append(node)
+            device_nodes[pk] = node
+        tree.append({
+            'id': uuid,
+            'label': f"{uuid}",
+            'type': 'gateway',
+            'topic': {
+                'subscribe': subscribe,
+                'publish': publish,
+            },
+            'children': children,
+        })
+    return tree, device_nodes
+
+
+def gateway_tree():
+    return tree_cache.get('gateway', build_gateway_tree, live=True)
+
+
+def build_device_tree(building_id=None, depth=DEVICE_TREE_DEPTH):
+    """
+    建筑-楼层-房间-设备树，一条查询带出建筑和楼层名称，按整数元组组装
+    只设置了楼层的设备归入楼层所在的建筑，返回(树, 设备节点)
+    :param building_id: 只返回该建筑的子树
+    :param depth: 返回的层数，1只有建筑，4包含设备
+    """
+    devices = Device.objects.all()
+    if building_id is not None:
+        devices = devices.filter(Q(building_id=building_id) | Q(building__isnull=True, floor__building_id=building_id))
+    columns = ['building_id', 'building__name', 'floor__building_id', 'floor__building__name',
+               'floor_id', 'floor__name', 'room_id']
+    if depth >= DEVICE_TREE_DEPTH:
+        rows = devices.order_by('id').values_list(*columns, 'id', 'name', 'device_id', 'status',
+                                                  'current_temp', 'set_temp')
+    else:
+        # 不需要设备时只取各层的键，由数据库去重；按键排序，保证各次构建的顺序相同
+        rows = (devices.order_by('building_id', 'floor__building_id', 'floor_id', 'room_id')
+                .values_list(*columns).distinct())
+
+    result = []
+    buildings = {}
+    floors = {}
+    rooms = {}
+    device_nodes = {}
+    for row in rows:
+        building, building_name, floor_building, floor_building_name, floor, floor_name, room = row[:7]
+        if building is None:
+            building, building_name = floor_building, floor_building_name
+        building_node = buildings.get(building)
+        if building_node is None:
+            building_node = buildings[building] = {
+                'id': f'building_{building}',
+                'name': building_name or f'建筑{building}',
+                'type': 'building',
+                'children': [],
+            }
+            result.append(building_node)
+        if depth < 2:
+            continue
+
+        floor_key = (building, floor)
+        floor_node = floors.get(floor_key)
+        if floor_node is None:
+            floor_node = floors[floor_key] = {
+                'id': f'floor_{building}_{floor}',
+                'name': floor_name or f'{floor}层',
+                'type': 'floor',
+                'children': [],
+            }
+            building_node['children'].append(floor_node)
+        if depth < 3:
+            continue
+
+        room_key = (building, floor, room)
+        room_node = rooms.get(room_key)
+        if room_node is None:
+            # 没有房间表，使用房间号
+            room_node = rooms[room_key] = {
+                'id': f'room_{building}_{floor}_{room}',
+                'name': f'房间{room}',
+                'type': 'room',
+                'children': [],
+            }
+            floor_node['children'].append(room_node)
+        if depth < DEVICE_TREE_DEPTH:
+            continue
+
+        pk, name, device_id, status, current_temp, set_temp = row[7:]
+        device_node = device_nodes[pk] = {
+            'id': f'device_{pk}',
+            'name': name,
+            'device_id': device_id,
+            'type': 'device',
+            'status': status,
+            'current_temp': current_temp,
+            'set_temp': set_temp,
+        }
+        room_node['children'].append(device_node)
+    return result, device_nodes
+
+
+def device_tree(building_id=None, depth=DEVICE_TREE_DEPTH):
+    """按建筑和层数分别缓存的设备树"""
+    return tree_cache.get(
+        f'device:{building_id}:{depth}',
+        lambda: build_device_tree(building_id, depth),
+        depends=(DEVICES, ORG),
+        live=True,
+    )
+
+
+def build_building_tree():
+    """建筑-楼层树，两条查询"""
+    from .serializers import BuildingTreeSerializer
+    buildings = Building.objects.order_by('id').prefetch_related(
+        Prefetch('floors', queryset=Floor.objects.order_by('floor_number', 'id')))
+    return BuildingTreeSerializer(buildings, many=True).data
+
+
+def build_company_tree():
+    """公司-部门树，两条查询"""
+    from .serializers import CompanyTreeSerializer
+    companies = Company.objects.order_by('id').prefetch_related(
+        Prefetch('departments', queryset=Department.objects.order_by('id')))
+    return CompanyTreeSerializer(companies, many=True).data
+
+
+def building_tree():
+    return tree_cache.get('building', build_building_tree, depends=(ORG,))
+
+
+def company_tree():
+    return tree_cache.get('company', build_company_tree, depends=(ORG,))
+
+
+# 全局树缓存实例
+tree_cache = TreeCache()
@@ -4,7 +4,8 @@ from .views import (
     DeviceViewSet, BuildingViewSet, CompanyViewSet, DepartmentViewSet,
     DeviceFilterViewSet, get_building_tree, get_company_tree, get_gateway_tree,
     get_all_trees, search_topic, create_or_update_topic, topic_list, get_uuid_topics, send_command,
-    query_all_device_status, export_devices_excel, FloorViewSet
+    query_all_device_status, export_devices_excel, FloorViewSet, ingest_stats,
+    get_gateway_heartbeats, export_status_history
 )
 
 router = DefaultRouter()
@@ -28,4 +29,7 @@ urlpatterns = [
     path('send/', send_command, name='mqtt-send'),
     path('update_status/', query_all_device_status, name='mqtt-query-all-status'),
     path('export/', export_devices_excel, name='export-devices-excel'),
+    path('export/status_history/', export_status_history, name='export-status-history'),
+    path('ingest/stats/', ingest_stats, name='ingest-stats'),
+    path('gateway/heartbeats/', get_gateway_heartbeats, name='gateway-heartbeats'),
 ]
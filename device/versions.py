@@ -0,0 +1,95 @@
+"""
+跨进程版本号
+进程内缓存(网关路由、设备状态表、树形结构)记录加载时的版本号，修改数据的进程增加版本号，
+其他进程检查到版本号变化后重新加载。配置REDIS_URL时版本号保存在Redis中，
+多个worker、多个节点和接入进程共用；否则只在进程内计数，只能同步本进程的修改
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class VersionCounter:
+    """按名称分别计数的版本号"""
+
+    def __init__(self, url=None):
+        self._local = {}
+        self.client = None
+        if url:
+            import redis
+            self.client = redis.Redis.from_url(url)
+
+    @property
+    def shared(self):
+        return self.client is not None
+
+    def bump(self, name):
+        """增加版本号，返回新的版本号"""
+        self._local[name] = self._local.get(name, 0) + 1
+        if self.client is not None:
+            try:
+                return self.client.incr(f"bell:version:{name}")
+            except Exception as e:
+                logger.error(f"Version bump error: {e}")
+        return self._local[name]
+
+    def current(self, *names):
+        """多个版本号组成的元组，Redis不可用时使用进程内计数"""
+        if self.client is not None:
+            try:
+                return tuple(int(value or 0) for value in
+                             self.client.mget([f"bell:version:{name}" for name in names]))
+            except Exception as e:
+                logger.error(f"Version read error: {e}")
+        return tuple(self._local.get(name, 0) for name in names)
+
+
+class SharedVersion:
+    """
+    一个进程内缓存的版本号，检查间隔内最多读取一次
+    本进程的修改已增量更新到缓存，bump()之后不会让本进程重新加载
+    """
+
+    def __init__(self, name, interval=None):
+        self.name = name
+        self.interval = settings.DEVICE_VERSION_CHECK_INTERVAL if interval is None else interval
+        self._lock = threading.Lock()
+        self._synced = None  # 缓存对应的版本号，尚未加载为None
+        self._next_check = 0.0
+
+    def current(self):
+        return version_counter.current(self.name)[0]
+
+    def synced(self, version):
+        """缓存按version加载完成"""
+        with self._lock:
+            self._synced = version
+            self._next_check = time.monotonic() + self.interval
+
+    def stale(self):
+        """到达检查间隔且版本号已被其他进程修改时返回True，同一次变化只返回一次"""
+        now = time.monotonic()
+        if self._synced is None or now < self._next_check:
+            return False
+        with self._lock:
+            if now < self._next_check:
+                return False
+            self._next_check = now + self.interval
+        return self.current() != self._synced
+
+    def bump(self):
+        """本进程修改数据并已更新缓存后调用"""
+        version = version_counter.bump(self.name)
+        with self._lock:
+            # 期间没有其他进程的修改时，缓存仍是最新的
+            if self._synced is not None and version == self._synced + 1:
+                self._synced = version
+        return version
+
+
+# 全局版本号实例
+version_counter = VersionCounter(settings.REDIS_URL)
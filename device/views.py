@@ -1,7 +1,7 @@
 import json
-import time
+import random
 from copy import deepcopy
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill
 from django.shortcuts import render
@@ -10,13 +10,28 @@ from rest_framework.decorators import action, api_view, authentication_classes,
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from django.db import transaction  # 添加事务导入
-from .models import Device, DeviceStatus, Building, Floor, Company, Department, Topic
+from django.conf import settings
+from django.utils import timezone
+from .models import ControlJob, Device, DeviceStatus, Building, Floor, Company, Department, Topic, GatewayCodec
 from .mqtt_client import mqtt_client, logger
+from .live import LIVE_FIELDS, load_live
+from .runtime import live_running_time
+from .control import deferred, submit_job, job_summary, confirmed_states, expected_state
+from .commands import command_tracker, expected_for, parse_wait
+from .registry import gateway_registry
+from .poller import poll_gateway
+from .rollups import PERIOD_SECONDS, choose_period, query_rollups
+from .pagination import keyset_page, parse_limit, parse_time_range
+from .metrics import ingest_metrics, web_stats
+from .trees import (
+    DEVICE_TREE_DEPTH, building_tree, company_tree, device_tree, gateway_tree, tree_response,
+)
+from . import export
 from django.views.decorators.csrf import csrf_exempt
 from .serializers import (
-    DeviceSerializer, DeviceStatusSerializer, DeviceCreateSerializer,
+    DeviceSerializer, DeviceStatusSerializer, DeviceStatusRollupSerializer, DeviceCreateSerializer,
     DeviceUpdateSerializer, BuildingTreeSerializer, CompanySerializer,
-    DepartmentSerializer, CompanyTreeSerializer, GatewayTreeSerializer,
+    DepartmentSerializer, GatewayTreeSerializer,
     FloorSerializer, BuildingSerializer
 )
 from urllib.parse import quote
@@ -24,6 +39,14 @@ from io import BytesIO
 import xlwt
 
 
+# 状态历史接口返回的字段，直接读取values()不实例化模型
+HISTORY_VALUES = ('id', 'timestamp', 'current_temp', 'set_temp', 'status', 'mode', 'fan_speed')
+# 带任一参数时状态历史接口按游标分页
+HISTORY_PAGE_PARAMS = ('start', 'end', 'limit', 'cursor', 'bucket')
+# 用DeviceSerializer返回设备列表或详情的接口
+DEVICE_READ_ACTIONS = ('list', 'retrieve', 'by_building', 'by_floor', 'by_room', 'by_company', 'by_department')
+
+
 class DeviceViewSet(viewsets.ModelViewSet):
     """设备视图集，提供设备的增删改查功能"""
     queryset = Device.objects.all()
@@ -36,10 +59,20 @@ class DeviceViewSet(viewsets.ModelViewSet):
             return DeviceUpdateSerializer
         return DeviceSerializer
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in DEVICE_READ_ACTIONS:
+            # 序列化用到的关联对象随设备一次查出
+            queryset = queryset.select_related('company', 'department', 'building', 'floor', 'uuid')
+        if self.action in DEVICE_READ_ACTIONS + ('status',):
+            # 实时字段从实时状态存储读取，存储中没有的设备由load_live批量补齐
+            queryset = queryset.defer(*LIVE_FIELDS)
+        return queryset
+
     @action(detail=True, methods=['get'])
     def status(self, request, pk=None):
         """获取设备状态"""
-        device = self.get_object()
+        device = load_live([self.get_object()])[0]
         return Response({
             'id': device.id,
             'name': device.name,
@@ -48,29 +81,90 @@ class DeviceViewSet(viewsets.ModelViewSet):
             'status': device.status,
             'mode': device.mode,
             'fan_speed': device.fan_speed,
-            'running_time': device.running_time,
-            'is_auto': device.is_auto,
+            # 运行时间的累计状态由接入进程发布到实时状态存储，load_live随实时字段一起设置
+            'running_time': round(live_running_time(device.running_time, getattr(device, 'running_since', None),
+                                                    getattr(device, 'running_pending', None)), 4),
             'last_updated': device.last_updated,
         })
 
     @action(detail=True, methods=['get'])
     def status_history(self, request, pk=None):
-        """获取设备状态历史"""
+        """
+        获取设备状态历史
+        不带参数时返回全部记录的列表(原有格式)
+        带start/end/limit/cursor/bucket任一参数时按时间倒序分页，返回{bucket, next, results}:
+        start/end(ISO8601，默认最近一天)，limit(每页条数)，cursor(上一页返回的next)，
+        bucket=minute/hour/day/auto时返回对应粒度的聚合数据
+        """
         device = self.get_object()
-        history = DeviceStatus.objects.filter(device=device)
-        page = self.paginate_queryset(history)
-        if page is not None:
-            serializer = DeviceStatusSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = DeviceStatusSerializer(history, many=True)
-        return Response(serializer.data)
+        if not any(name in request.query_params for name in HISTORY_PAGE_PARAMS):
+            history = DeviceStatus.objects.filter(device=device)
+            page = self.paginate_queryset(history)
+            if page is not None:
+                serializer = DeviceStatusSerializer(page, many=True)
+                return self.get_paginated_response(serializer.data)
+            serializer = DeviceStatusSerializer(history, many=True)
+            return Response(serializer.data)
+        try:
+            start, end = parse_time_range(request.query_params)
+            limit = parse_limit(request.query_params.get('limit'))
+            cursor = request.query_params.get('cursor')
+            bucket = request.query_params.get('bucket')
+            if bucket == 'auto':
+                bucket = choose_period(start, end)
+            elif bucket and bucket not in PERIOD_SECONDS:
+                raise ValueError("bucket must be one of minute, hour, day, auto")
+            if bucket:
+                rollups = query_rollups(device, start, end, bucket)
+                page, next_cursor = keyset_page(rollups, 'bucket', cursor, limit)
+                results = DeviceStatusRollupSerializer(page, many=True).data
+            else:
+                history = (DeviceStatus.objects
+                           .filter(device=device, timestamp__gte=start, timestamp__lt=end)
+                           .values(*HISTORY_VALUES))
+                results, next_cursor = keyset_page(history, 'timestamp', cursor, limit)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'bucket': bucket,
+            'next': next_cursor,
+            'results': results,
+        })
+
+    @action(detail=True, methods=['get'])
+    def status_rollup(self, request, pk=None):
+        """
+        获取设备状态聚合数据
+        参数: start/end(ISO8601，默认最近一天)，resolution(点间隔秒数)或points(最大点数)
+        自动选择满足范围和分辨率的最粗粒度
+        """
+        device = self.get_object()
+        try:
+            start, end = parse_time_range(request.query_params)
+            resolution = request.query_params.get('resolution')
+            resolution = int(resolution) if resolution else None
+            points = request.query_params.get('points')
+            points = int(points) if points else None
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        period = choose_period(start, end, resolution=resolution, max_points=points)
+        if period is None:
+            return Response({"error": "resolution below 60 seconds, use status_history"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        rollups = query_rollups(device, start, end, period)
+        return Response({
+            'period': period,
+            'start': start,
+            'end': end,
+            'results': DeviceStatusRollupSerializer(rollups, many=True).data,
+        })
 
     @action(detail=False, methods=['get'])
     def by_building(self, request):
         """按建筑筛选设备"""
         building_id = request.query_params.get('building_id')
         if building_id:
-            devices = Device.objects.filter(building_id=building_id)
+            devices = self.get_queryset().filter(building_id=building_id)
             serializer = DeviceSerializer(devices, many=True)
             return Response(serializer.data)
         return Response({"error": "missing building_id parameter"}, status=status.HTTP_400_BAD_REQUEST)
@@ -80,7 +174,7 @@ class DeviceViewSet(viewsets.ModelViewSet):
         """按楼层筛选设备"""
         floor_id = request.query_params.get('floor_id')
         if floor_id:
-            devices = Device.objects.filter(floor_id=floor_id)
+            devices = self.get_queryset().filter(floor_id=floor_id)
             serializer = DeviceSerializer(devices, many=True)
             return Response(serializer.data)
         return Response({"error": "missing floor_id parameter"}, status=status.HTTP_400_BAD_REQUEST)
@@ -90,73 +184,31 @@ class DeviceViewSet(viewsets.ModelViewSet):
         """按房间筛选设备"""
         room_id = request.query_params.get('room_id')
         if room_id:
-            devices = Device.objects.filter(room_id=room_id)
+            devices = self.get_queryset().filter(room_id=room_id)
             serializer = DeviceSerializer(devices, many=True)
             return Response(serializer.data)
         return Response({"error": "missing room_id parameter"}, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=False, methods=['get'])
     def tree(self, request):
-        """获取设备树形结构数据"""
-        # 获取所有建筑
-        buildings = {}
-        floors = {}
-        rooms = {}
-
-        # 先获取所有设备
-        devices = Device.objects.all()
-        result = []
-
-        # 构建树形结构
-        for device in devices:
-            # 处理建筑
-            if device.building_id not in buildings:
-                building_data = {
-                    'id': f'building_{device.building_id}',
-                    'name': f'建筑{device.building_id}',  # 这里可以从建筑表获取实际名称
-                    'type': 'building',
-                    'children': []
-                }
-                buildings[device.building_id] = building_data
-                result.append(building_data)
-
-            # 处理楼层
-            floor_key = f"{device.building_id}_{device.floor_id}"
-            if floor_key not in floors:
-                floor_data = {
-                    'id': f'floor_{floor_key}',
-                    'name': f'{device.floor_id}层',  # 这里可以从楼层表获取实际名称
-                    'type': 'floor',
-                    'children': []
-                }
-                floors[floor_key] = floor_data
-                buildings[device.building_id]['children'].append(floor_data)
-
-            # 处理房间
-            room_key = f"{device.building_id}_{device.floor_id}_{device.room_id}"
-            if room_key not in rooms:
-                room_data = {
-                    'id': f'room_{room_key}',
-                    'name': f'房间{device.room_id}',  # 这里可以从房间表获取实际名称
-                    'type': 'room',
-                    'children': []
-                }
-                rooms[room_key] = room_data
-                floors[floor_key]['children'].append(room_data)
-
-            # 添加设备
-            device_data = {
-                'id': f'device_{device.id}',
-                'name': device.name,
-                'device_id': device.device_id,
-                'type': 'device',
-                'status': device.status,
-                'current_temp': device.current_temp,
-                'set_temp': device.set_temp
-            }
-            rooms[room_key]['children'].append(device_data)
-
-        return Response(result)
+        """
+        获取建筑-楼层-房间-设备树形结构，支持If-None-Match
+        building_id: 只返回该建筑的子树
+        depth: 返回的层数，1建筑、2楼层、3房间、4设备(默认)
+        """
+        try:
+            building_id = request.query_params.get('building_id')
+            building_id = int(building_id) if building_id else None
+            depth = int(request.query_params.get('depth') or DEVICE_TREE_DEPTH)
+        except ValueError:
+            return Response({"error": "building_id and depth must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= depth <= DEVICE_TREE_DEPTH:
+            return Response({"error": f"depth must be between 1 and {DEVICE_TREE_DEPTH}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # 树按建筑缓存，不存在的建筑不建缓存
+        if building_id is not None and not Building.objects.filter(id=building_id).exists():
+            return Response({"error": "building not found"}, status=status.HTTP_404_NOT_FOUND)
+        return tree_response(request, device_tree(building_id, depth))
 
     @action(detail=False, methods=['post'], url_path='batch-delete', url_name='batch_delete')
     def batch_delete(self, request):
@@ -178,7 +230,10 @@ class DeviceViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['post'], url_path='batch-control', url_name='batch_control')
     def batch_control(self, request):
-        """批量控制设备"""
+        """
+        批量控制设备，返回任务ID，下发结果与校验结果通过control-jobs查询
+        wait(毫秒)大于0时等待网关上报确认，返回已确认设备的状态
+        """
         logger.info("\n=== 批量控制请求开始 ===")
         logger.info(f"请求数据: {request.data}")
 
@@ -194,148 +249,72 @@ class DeviceViewSet(viewsets.ModelViewSet):
         if not control_data:
             return Response({"error": "没有提供控制参数"}, status=status.HTTP_400_BAD_REQUEST)
 
-        results = {
-            'success': [],
-            'failed': [],
-            'details': {}
-        }
-
         try:
-            # 获取所有需要控制的设备
-            devices = Device.objects.filter(id__in=device_ids).select_related('uuid')
-            logger.info(f"查询到的设备数量: {devices.count()}")
+            wait = parse_wait(request.data.get('wait', request.query_params.get('wait')))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-            if not devices.exists():
-                logger.error(f"未找到指定ID的设备: {device_ids}")
-                return Response({"error": "未找到指定的设备"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            # 控制参数在下发前校验，格式错误不应返回500
+            expected_state(control_data)
+        except (TypeError, ValueError) as e:
+            return Response({"error": f"控制参数无效: {e}"}, status=status.HTTP_400_BAD_REQUEST)
 
-            # 按UUID分组设备，以便批量下发
+        try:
+            # 通过网关路由缓存获取设备所属网关，不查询数据库
             devices_by_uuid = {}
-            for device in devices:
-                logger.info(f"处理设备: ID={device.id}, Name={device.name}, UUID={device.uuid}")
-
-                if not device.uuid:
-                    error_msg = "设备未绑定UUID"
-                    logger.error(f"设备 {device.id} {error_msg}")
-                    results['failed'].append(device.id)
-                    results['details'][device.id] = error_msg
+            failed = {}
+            found = False
+            for device_pk in device_ids:
+                device_key = gateway_registry.get_device_key(device_pk)
+                if device_key is None:
                     continue
+                found = True
+                uuid, device_id = device_key
 
-                if device.uuid.uuid not in devices_by_uuid:
-                    devices_by_uuid[device.uuid.uuid] = {
-                        'publish_topic': device.uuid.publish_topic,
-                        'devices': []
-                    }
-                devices_by_uuid[device.uuid.uuid]['devices'].append(device)
-
-            # 对每个UUID下的设备进行批量控制
-            for uuid, data in devices_by_uuid.items():
-                device_ids_list = [device.device_id for device in data['devices']]
-                publish_topic = data['publish_topic']
-
-                logger.info(f"准备发送控制命令到UUID: {uuid}")
-                logger.info(f"发布主题: {publish_topic}")
-                logger.info(f"设备列表: {device_ids_list}")
-
-                # 构建MQTT payload
-                payload = {
-                    "sn": 12,
-                    "cmd": "control_write",
-                    "uuid": uuid,
-                    "body": {
-                        "addrs": device_ids_list,
-                    }
-                }
-
-                # 根据控制数据添加相应的控制字段
-                device_status_convert_dict = {
-                    "fa000001400001240240614000100308": {
-                        "onOff": {"running": 1, "stopped": 0},
-                        "workMode": {"auto": 0, "cooling": 1, "heating": 2, "fan": 3, "dehumidify": 4},
-                        "fanSpeed": {}
-                    },
-                    "fa000001400001240240614000100317": {
-                        "onOff": {"running": 1, "stopped": 0},
-                        "workMode": {"auto": 0, "cooling": 1, "heating": 2, "fan": 3, "dehumidify": 4},
-                        "fanSpeed": {}
-                    }
-                }
-
-                if uuid not in device_status_convert_dict:
-                    error_msg = f"设备UUID {uuid} 不在状态转换字典中"
-                    logger.error(error_msg)
-                    for device in data['devices']:
-                        results['failed'].append(device.id)
-                        results['details'][device.id] = error_msg
+                gateway = gateway_registry.get_gateway(uuid) if uuid else None
+                if gateway is None:
+                    failed[device_pk] = "设备未绑定UUID"
                     continue
-
-                # 添加控制参数
-                try:
-                    if 'running' in control_data:
-                        payload["body"]["onOff"] = device_status_convert_dict[uuid]["onOff"][
-                            "running" if control_data['running'] else "stopped"]
-                    if 'temp' in control_data:
-                        payload["body"]["tempSet"] = float(control_data['temp'])
-                    if 'mode' in control_data:
-                        payload["body"]["workMode"] = device_status_convert_dict[uuid]["workMode"][control_data['mode']]
-                    if 'fan_speed' in control_data:
-                        payload["body"]["fanSpeed"] = int(control_data['fan_speed'])
-                except Exception as e:
-                    error_msg = f"构建控制参数失败: {str(e)}"
-                    logger.error(error_msg)
-                    for device in data['devices']:
-                        results['failed'].append(device.id)
-                        results['details'][device.id] = error_msg
+                if gateway.codec is None:
+                    failed[device_pk] = f"设备UUID {uuid} 未配置协议转换表"
                     continue
+                devices_by_uuid.setdefault(uuid, (gateway, []))[1].append((device_pk, device_id))
 
-                # 发送MQTT消息
-                try:
-                    logger.info(f"下发批量控制命令: {payload}, topic: {publish_topic}")
-                    mqtt_client.publish(publish_topic, json.dumps(payload))
-
-                    # 添加到成功列表
-                    for device in data['devices']:
-                        results['success'].append(device.id)
-
-                    # 发送状态查询命令
-                    time.sleep(2)  # 等待2秒后查询状态
-                    query_payload = {
-                        "sn": 11,
-                        "cmd": "status_read",
-                        "uuid": uuid,
-                        "body": {
-                            "cmd": "addrs",
-                            "addrs": device_ids_list
-                        }
-                    }
-                    mqtt_client.publish(publish_topic, json.dumps(query_payload))
-
-                except Exception as e:
-                    error_msg = f"MQTT发送失败: {str(e)}"
-                    logger.error(error_msg)
-                    for device in data['devices']:
-                        results['failed'].append(device.id)
-                        results['details'][device.id] = error_msg
-
-            # 获取更新后的设备列表
-            updated_devices = Device.objects.filter(id__in=device_ids)
-            serializer = DeviceSerializer(updated_devices, many=True)
-
-            logger.info("\n=== 批量控制请求完成 ===")
-            logger.info(f"成功: {len(results['success'])}个, 失败: {len(results['failed'])}个")
-            return Response({
-                "message": f"成功发送{len(results['success'])}个设备的控制命令，失败{len(results['failed'])}个设备",
-                "results": results,
-                "devices": serializer.data
-            })
+            if not found:
+                logger.error(f"未找到指定ID的设备: {device_ids}")
+                return Response({"error": "未找到指定的设备"}, status=status.HTTP_404_NOT_FOUND)
+
+            # 各网关的控制命令一次性下发，状态查询与校验由延时任务完成，请求立即返回
+            job, commands = submit_job(control_data, list(devices_by_uuid.values()), failed)
+            summary = job_summary(job)
+            logger.info(f"批量控制任务 {job.id}: {summary['counts']}")
+            sent = summary['counts'].get('sent', 0)
+            data = dict(summary, message=f"成功发送{sent}个设备的控制命令，失败{job.total - sent}个设备")
+            if wait and commands:
+                # 指定wait时等待网关上报确认，返回已确认设备的状态
+                data['confirmed'] = command_tracker.wait_all([command for command, _ in commands], wait)
+                data['states'] = confirmed_states(commands)
+            return Response(data, status=status.HTTP_202_ACCEPTED)
 
         except Exception as e:
             logger.error(f"\n批量控制失败: {str(e)}")
             return Response({
                 "error": f"控制失败：{str(e)}",
-                "results": results
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['get'], url_path=r'control-jobs/(?P<job_id>\d+)', url_name='control_job')
+    def control_job(self, request, job_id=None):
+        """查询批量控制任务状态，detail=1时返回各设备结果"""
+        job = ControlJob.objects.filter(id=job_id).first()
+        if job is None:
+            return Response({"error": "任务不存在"}, status=status.HTTP_404_NOT_FOUND)
+        data = job_summary(job)
+        if request.query_params.get('detail') in ('1', 'true'):
+            data['control'] = job.control
+            data['results'] = job.results
+        return Response(data)
+
     def update(self, request, *args, **kwargs):
         try:
             instance = self.get_object()
@@ -355,7 +334,7 @@ class DeviceViewSet(viewsets.ModelViewSet):
         """按公司筛选设备"""
         company_id = request.query_params.get('company_id')
         if company_id:
-            devices = Device.objects.filter(company_id=company_id)
+            devices = self.get_queryset().filter(company_id=company_id)
             serializer = DeviceSerializer(devices, many=True)
             return Response(serializer.data)
         return Response({"error": "missing company_id parameter"}, status=status.HTTP_400_BAD_REQUEST)
@@ -365,7 +344,7 @@ class DeviceViewSet(viewsets.ModelViewSet):
         """按部门筛选设备"""
         department_id = request.query_params.get('department_id')
         if department_id:
-            devices = Device.objects.filter(department_id=department_id)
+            devices = self.get_queryset().filter(department_id=department_id)
             serializer = DeviceSerializer(devices, many=True)
             return Response(serializer.data)
         return Response({"error": "missing department_id parameter"}, status=status.HTTP_400_BAD_REQUEST)
@@ -402,10 +381,8 @@ class BuildingViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def tree(self, request):
-        """获取建筑和楼层的树形结构"""
-        buildings = Building.objects.prefetch_related('floors').all()
-        serializer = BuildingTreeSerializer(buildings, many=True)
-        return Response(serializer.data)
+        """获取建筑和楼层的树形结构，支持If-None-Match"""
+        return tree_response(request, building_tree())
 
 
 class FloorViewSet(viewsets.ModelViewSet):
@@ -468,61 +445,21 @@ class DepartmentViewSet(viewsets.ModelViewSet):
 
 @api_view(['GET'])
 def get_building_tree(request):
-    """获取楼栋-楼层树形结构"""
-    buildings = Building.objects.all()
-    serializer = BuildingTreeSerializer(buildings, many=True)
-    return Response(serializer.data)
+    """获取楼栋-楼层树形结构，支持If-None-Match"""
+    return tree_response(request, building_tree())
 
 
 @api_view(['GET'])
 def get_company_tree(request):
-    """获取公司-部门树形结构"""
-    companies = Company.objects.all()
-    serializer = CompanyTreeSerializer(companies, many=True)
-    return Response(serializer.data)
+    """获取公司-部门树形结构，支持If-None-Match"""
+    return tree_response(request, company_tree())
 
 
 @api_view(['GET'])
 def get_gateway_tree(request):
-    """获取网关-设备树形结构"""
+    """获取网关-设备树形结构，支持If-None-Match"""
     try:
-        unique_topics = Topic.objects.all()
-        gateway_tree = []
-
-        for topic in unique_topics:
-            devices = Device.objects.filter(uuid=topic)
-            device_count = devices.count()
-
-            if device_count > 0:
-                gateway_node = {
-                    'id': topic.uuid,
-                    'label': f"{topic.uuid}",
-                    'type': 'gateway',
-                    'topic': {
-                        'subscribe': topic.subscribe_topic,
-                        'publish': topic.publish_topic
-                    },
-                    'children': []
-                }
-
-                for device in devices:
-                    device_node = {
-                        'id': str(device.id),
-                        'label': device.name or device.device_id,
-                        'type': 'device',
-                        'status': device.status,
-                        'uuid': topic.uuid,
-                        'device_id': device.device_id,
-                        'current_temp': device.current_temp,
-                        'set_temp': device.set_temp,
-                        'mode': device.mode,
-                        'fan_speed': device.fan_speed
-                    }
-                    gateway_node['children'].append(device_node)
-
-                gateway_tree.append(gateway_node)
-
-        return Response(gateway_tree)
+        return tree_response(request, gateway_tree())
 
     except Exception as e:
         logger.error(f"获取网关树失败: {str(e)}")
@@ -533,52 +470,10 @@ def get_gateway_tree(request):
 def get_all_trees(request):
     """获取所有组织架构树形结构"""
     try:
-        buildings = Building.objects.all()
-        companies = Company.objects.all()
-        unique_topics = Topic.objects.all()
-
-        # 构建网关树
-        gateway_tree = []
-        for topic in unique_topics:
-            devices = Device.objects.filter(uuid=topic)
-            device_count = devices.count()
-
-            if device_count > 0:
-                gateway_node = {
-                    'id': topic.uuid,
-                    'label': f"{topic.uuid}",
-                    'type': 'gateway',
-                    'topic': {
-                        'subscribe': topic.subscribe_topic,
-                        'publish': topic.publish_topic
-                    },
-                    'children': []
-                }
-
-                for device in devices:
-                    device_node = {
-                        'id': str(device.id),
-                        'label': device.name or device.device_id,
-                        'type': 'device',
-                        'status': device.status,
-                        'uuid': topic.uuid,
-                        'device_id': device.device_id,
-                        'current_temp': device.current_temp,
-                        'set_temp': device.set_temp,
-                        'mode': device.mode,
-                        'fan_speed': device.fan_speed
-                    }
-                    gateway_node['children'].append(device_node)
-
-                gateway_tree.append(gateway_node)
-
-        building_tree = BuildingTreeSerializer(buildings, many=True).data
-        company_tree = CompanyTreeSerializer(companies, many=True).data
-
         return Response({
-            'building_tree': building_tree,
-            'company_tree': company_tree,
-            'gateway_tree': gateway_tree
+            'building_tree': building_tree().data,
+            'company_tree': company_tree().data,
+            'gateway_tree': gateway_tree().data
         })
     except Exception as e:
         logger.error(f"获取组织架构数据失败: {str(e)}")
@@ -610,6 +505,7 @@ def create_or_update_topic(request):
     subscribe_topic = request.data.get('subscribe_topic')
     publish_topic = request.data.get('publish_topic')
     description = request.data.get('description')
+    codec_model = request.data.get('codec')
 
     if not uuid or (not subscribe_topic and not publish_topic):
         return Response({
@@ -617,14 +513,23 @@ def create_or_update_topic(request):
         }, status=status.HTTP_400_BAD_REQUEST)
 
     try:
+        defaults = {
+            'subscribe_topic': subscribe_topic,
+            'publish_topic': publish_topic,
+            'description': description
+        }
+        # 可选指定网关协议型号
+        if codec_model:
+            codec = GatewayCodec.objects.filter(model=codec_model).first()
+            if codec is None:
+                return Response({"error": f"Gateway codec {codec_model} not found"},
+                                status=status.HTTP_400_BAD_REQUEST)
+            defaults['codec'] = codec
+
         # 尝试查找现有的Topic
         topic_obj, created = Topic.objects.update_or_create(
             uuid=uuid,
-            defaults={
-                'subscribe_topic': subscribe_topic,
-                'publish_topic': publish_topic,
-                'description': description
-            }
+            defaults=defaults
         )
 
         return Response({
@@ -634,7 +539,8 @@ def create_or_update_topic(request):
                 'uuid': topic_obj.uuid,
                 'subscribe_topic': topic_obj.subscribe_topic,
                 'publish_topic': topic_obj.publish_topic,
-                'description': topic_obj.description
+                'description': topic_obj.description,
+                'codec': topic_obj.codec.model if topic_obj.codec else None
             }
         })
     except Exception as e:
@@ -678,7 +584,7 @@ def get_uuid_topics(request):
 
 @api_view(["POST"])
 def send_command(request):
-    """单个设备、单个属性 下发"""
+    """单个设备、单个属性 下发，wait(毫秒)大于0时等待网关上报确认并返回设备状态"""
     if request.method == 'POST':
         try:
             issue_property = request.data.get('property')
@@ -688,66 +594,29 @@ def send_command(request):
             if not (device_id and uuid):
                 return JsonResponse({"error": "device_id or uuid is missing"}, status=400)
 
-            device_status_convert_dict = {
-                "fa000001400001240240614000100308": {"onOff": {"running": 1, "stopped": 0, },
-                                                     "workMode": {"auto": 0, "cooling": 1, "heating": 2, "fan": 3,
-                                                                  "dehumidify": 4, }, "fanSpeed": {}, },
-                "fa000001400001240240614000100317": {"onOff": {"running": 1, "stopped": 0, },
-                                                     "workMode": {"auto": 0, "cooling": 1, "heating": 2, "fan": 3,
-                                                                  "dehumidify": 4, }, "fanSpeed": {}, },
-                "fa000001400001240240615000100165": {"onOff": {"running": 1, "stopped": 0, },
-                                                     "workMode": {"auto": 0, "cooling": 1, "heating": 2, "fan": 3,
-                                                                  "dehumidify": 4, }, "fanSpeed": {}, },
-                "example_0": {"onOff": {"running": 0, "stopped": 1, },
-                              "workMode": {"auto": 0, "cooling": 1, "heating": 2, "fan": 3, "dehumidify": 4, },
-                              "fanSpeed": {}, }}
-
-            # 检查设备是否存在
+            # 通过网关路由缓存检查设备是否存在
+            gateway = gateway_registry.get_gateway(uuid)
+            if gateway is None or gateway_registry.get_device_pk(uuid, device_id) is None:
+                return JsonResponse({"error": "Device not found"}, status=404)
+            topic = gateway.publish_topic
+
+            if gateway.codec is None:
+                return JsonResponse({"error": f"网关 {uuid} 未配置协议转换表"}, status=400)
             try:
-                device = (
-                    Device.objects
-                    .filter(uuid__uuid=uuid, device_id=device_id)
-                    .select_related('uuid')
-                    .only('uuid__publish_topic', 'name', 'status')
-                    .first()
-                )
-                if not device:
-                    return JsonResponse({"error": "Device not found"}, status=404)
-
-                topic = device.uuid.publish_topic
-            except Exception as e:
-                logger.error(f"查询设备失败: {str(e)}")
-                return JsonResponse({"error": "Failed to query device"}, status=500)
-
-            # 构造控制命令
-            payload = {
-                "sn": 12,
-                "cmd": "control_write",
-                "uuid": uuid,
-                "body": {
-                    "addrs": [f"{device_id}", ],
-                }
-            }
-            if issue_property == "fanSpeed":
-                payload["body"][f"{issue_property}"] = int(value)
-            elif issue_property == "tempSet":
-                payload["body"][f"{issue_property}"] = float(value)
-            else:
-                payload["body"][f"{issue_property}"] = device_status_convert_dict[f"{uuid}"][f"{issue_property}"][
-                    f"{value}"]
-
-            topic_publish = (
-                Device.objects
-                .filter(uuid__uuid=uuid, device_id=device_id)
-                .select_related('uuid')
-                .only('uuid__publish_topic')
-                .first()
-            )
-            topic = topic_publish.uuid.publish_topic
-            logger.info(f"下发命令: {payload}, topic: {topic}")
-            payload_json = json.dumps(payload)
-            mqtt_client.publish(topic, payload_json)
-            return JsonResponse({'status': 'Command has been issued to the device.'})
+                wait = parse_wait(request.data.get('wait', request.query_params.get('wait')))
+            except ValueError as e:
+                return JsonResponse({"error": str(e)}, status=400)
+            body = {f"{issue_property}": gateway.codec.encode(issue_property, value)}
+
+            logger.info(f"下发命令: {body}, device: {uuid}-{device_id}, topic: {topic}")
+            command = mqtt_client.send_command(gateway, "control_write", [f"{device_id}"], body=body,
+                                               expected=expected_for(issue_property, value))
+            data = {'status': 'Command has been issued to the device.', 'sn': command.sn}
+            if wait:
+                data['confirmed'] = command_tracker.wait_all([command], wait)
+                data['state'] = command.states.get(f"{device_id}")
+                data['latency_ms'] = round(command.latency_ms, 3) if command.latency_ms is not None else None
+            return JsonResponse(data)
 
         except Exception as e:
             return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
@@ -755,43 +624,33 @@ def send_command(request):
 
 @api_view(['GET'])
 def query_all_device_status(request):
-    """查询所有设备状态"""
+    """查询所有设备状态，各网关的查询在DEVICE_POLL_SPREAD秒内随机分散下发"""
     try:
-        # 获取所有不重复的UUID
-        uuids = Topic.objects.values_list('uuid', flat=True).distinct()
-
-        for uuid_current in uuids:
-            # 构造消息
-            message = {
-                "sn": 11,  # 序列号
-                "cmd": "status_read",
-                "uuid": uuid_current,
-                "body": {
-                    "cmd": "addrs",
-                    "addrs": ["1-3-1-0"]  # 固定地址格式
-                }
-            }
+        gateways = gateway_registry.gateways()
+        spread = settings.DEVICE_POLL_SPREAD
+        for gateway in gateways:
+            deferred.call_later(random.uniform(0, spread), poll_gateway, mqtt_client, gateway)
+        logger.info(f"正在查询设备状态: {len(gateways)}个网关，{spread}秒内下发")
+        return Response({"message": "状态查询命令已发送", "gateways": len(gateways), "spread": spread})
 
-            # 获取发布主题
-            try:
-                topic = Topic.objects.get(uuid=uuid_current)
-                publish_topic = topic.publish_topic
+    except Exception as e:
+        logger.error(f"查询设备状态失败: {str(e)}")
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-                # 发布消息
-                logger.info(f"正在查询设备状态: UUID={uuid_current}")
-                mqtt_client.publish(publish_topic, message)
 
-            except Topic.DoesNotExist:
-                logger.error(f"找不到UUID对应的Topic: {uuid_current}")
-            except Exception as e:
-                logger.error(f"发送状态查询命令失败: {str(e)}")
-                continue
+@api_view(['GET'])
+def ingest_stats(request):
+    """获取MQTT接入链路的运行指标，ingest为各接入进程发布的指标，web为处理本次请求的进程"""
+    return Response({
+        'ingest': ingest_metrics.read(),
+        'web': web_stats(),
+    })
 
-        return Response({"message": "状态查询命令已发送"})
 
-    except Exception as e:
-        logger.error(f"查询设备状态失败: {str(e)}")
-        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+@api_view(['GET'])
+def get_gateway_heartbeats(request):
+    """获取各网关最近一次心跳时间(接入进程的内存数据，最多延迟MQTT_STATS_INTERVAL秒)"""
+    return Response(ingest_metrics.last_seen(request.query_params.get('uuid')))
 
 
 @api_view(['GET'])
@@ -837,6 +696,35 @@ def export_devices_excel(request):
         return JsonResponse({'error': '导出失败', 'detail': str(e)}, status=500)
 
 
+@api_view(['GET'])
+def export_status_history(request):
+    """
+    流式导出设备状态历史
+    参数: start/end(默认最近一天)，device_id/floor_id/building_id/company_id选择范围，
+    output=csv/arrow/parquet(后两种需要安装pyarrow)
+    """
+    params = request.query_params
+    output = params.get('output', 'csv')
+    try:
+        if output not in export.FORMATS:
+            raise ValueError("output must be one of csv, arrow, parquet")
+        start, end = parse_time_range(params)
+        devices = export.scope_devices(
+            device_id=params.get('device_id'),
+            floor_id=params.get('floor_id'),
+            building_id=params.get('building_id'),
+            company_id=params.get('company_id'),
+        )
+        content = export.stream(output, devices, start, end)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    content_type, extension = export.FORMATS[output]
+    response = StreamingHttpResponse(content, content_type=content_type)
+    filename = f"status_history_{timezone.localtime(start):%Y%m%d%H%M}_{timezone.localtime(end):%Y%m%d%H%M}.{extension}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
 # 重新添加DeviceFilterViewSet
 class DeviceFilterViewSet(viewsets.ModelViewSet):
     """设备筛选视图集"""